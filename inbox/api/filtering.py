@@ -1,9 +1,12 @@
+from itertools import islice
+
 from sqlalchemy import and_, or_, desc, asc, func
 from sqlalchemy.orm import subqueryload, contains_eager
 from inbox.models import (Contact, Event, Calendar, Message,
                           MessageContactAssociation, Thread, Tag,
                           TagItem, Block, Part)
-from inbox.models.event import RecurringEvent
+from inbox.models.event import RecurringEvent, RecurringEventOverride
+from inbox.events.recurring import iter_events, count_events, merge_by_start
 
 
 def threads(namespace_id, subject, from_addr, to_addr, cc_addr, bcc_addr,
@@ -344,7 +347,9 @@ def filter_event_query(query, event_cls, namespace_id, event_public_id,
 
 def recurring_events(filters, starts_before, starts_after, ends_before,
                      ends_after, db_session):
-    # Expands individual recurring events into full instances.
+    # Finds the recurring events to expand into full instances, returning
+    # (event, overrides, start, end) for each: its overrides within the
+    # range, sorted by start time, and the range of start times to expand.
     # If neither starts_before or ends_before is given, the recurring range
     # defaults to now + 1 year (see events/recurring.py)
 
@@ -368,17 +373,56 @@ def recurring_events(filters, starts_before, starts_after, ends_before,
 
     recur_query = recur_query.filter(and_(*after_criteria))
 
-    recur_instances = []
-    for r in recur_query:
+    masters = recur_query.all()
+
+    windows = []
+    for r in masters:
         # the occurrences check only checks starting timestamps
+        start, end = starts_after, starts_before
         if ends_before and not starts_before:
-            starts_before = ends_before - r.length
+            end = ends_before - r.length
         if ends_after and not starts_after:
-            starts_after = ends_after - r.length
-        instances = r.all_events(start=starts_after, end=starts_before)
-        recur_instances.extend(instances)
-
-    return recur_instances
+            start = ends_after - r.length
+        windows.append((start, end))
+
+    # Only load the overrides that fall in some master's range, using the
+    # loosest bounds since `ends_*` shift them per master.
+    starts = [start for start, _ in windows]
+    ends = [end for _, end in windows]
+    overrides = _overrides_by_master(
+        masters, db_session,
+        start=min(starts) if starts and all(starts) else None,
+        end=max(ends) if ends and all(ends) else None)
+
+    series = []
+    for r, (start, end) in zip(masters, windows):
+        # Like RecurringEvent.all_events, only consider the overrides within
+        # the range.
+        series.append((r, [o for o in overrides.get(r.id, [])
+                           if (not start or o.start > start) and
+                           (not end or o.end < end)], start, end))
+
+    return series
+
+
+def _overrides_by_master(masters, db_session, start=None, end=None,
+                         chunk_size=500):
+    # Load the overrides of recurring events that start after `start` and
+    # end before `end`, with a query per `chunk_size` events rather than one
+    # per event.
+    overrides = {}
+    for i in range(0, len(masters), chunk_size):
+        ids = [r.id for r in masters[i:i + chunk_size]]
+        query = db_session.query(RecurringEventOverride). \
+            filter(RecurringEventOverride.master_event_id.in_(ids))
+        if start:
+            query = query.filter(RecurringEventOverride.start > start)
+        if end:
+            query = query.filter(RecurringEventOverride.end < end)
+        query = query.order_by(asc(RecurringEventOverride.start))
+        for o in query:
+            overrides.setdefault(o.master_event_id, []).append(o)
+    return overrides
 
 
 def events(namespace_id, event_public_id, calendar_public_id, title,
@@ -430,20 +474,30 @@ def events(namespace_id, event_public_id, calendar_public_id, title,
     query = query.filter(event_predicate)
 
     if expand_recurring:
-        expanded = recurring_events(filters, starts_before, starts_after,
-                                    ends_before, ends_after, db_session)
-
-        # Combine non-recurring events with expanded recurring ones
-        all_events = query.filter(Event.discriminator == 'event').all() + \
-            expanded
+        non_recurring = query.filter(Event.discriminator == 'event')
+        series = recurring_events(filters, starts_before, starts_after,
+                                  ends_before, ends_after, db_session)
 
         if view == 'count':
-            return {"count": len(all_events)}
+            # Count instances from their start times, without building them.
+            count = non_recurring.with_entities(func.count(Event.id)).scalar()
+            count += sum(count_events(*s) for s in series)
+            return {"count": count}
 
-        all_events = sorted(all_events, key=lambda e: e.start)
+        non_recurring = non_recurring.order_by(asc(Event.start))
         if limit:
             offset = offset or 0
-            all_events = all_events[offset:offset + limit]
+            non_recurring = non_recurring.limit(offset + limit)
+
+        # Combine non-recurring events with expanded recurring ones. Each
+        # stream is in start order, so merge them, and stop once the
+        # requested page is complete: no more events are loaded or expanded
+        # than that.
+        all_events = merge_by_start([non_recurring] +
+                                    [iter_events(*s) for s in series])
+        if limit:
+            all_events = islice(all_events, offset, offset + limit)
+        all_events = list(all_events)
     else:
         if view == 'count':
             return {"count": query.one()[0]}
@@ -1,19 +1,18 @@
 import os
 import base64
 import uuid
-import gevent
 import time
 from inbox.models.session import session_scope
 
 
-from flask import request, g, Blueprint, make_response, Response
+from flask import request, g, Blueprint, Response
 from flask import jsonify as flask_jsonify
 from flask.ext.restful import reqparse
 from sqlalchemy import asc, or_, func
 from sqlalchemy.orm.exc import NoResultFound
 
 from inbox.models import (Message, Block, Part, Thread, Namespace,
-                          Tag, Contact, Calendar, Event, Transaction)
+                          Tag, Contact, Calendar, Event)
 from inbox.api.sending import send_draft
 from inbox.api.kellogs import APIEncoder
 from inbox.api import filtering
@@ -32,8 +31,9 @@ from inbox.log import get_logger
 from inbox.models.constants import MAX_INDEXABLE_LENGTH
 from inbox.models.action_log import schedule_action, ActionError
 from inbox.models.session import InboxSession
-from inbox.search.adaptor import NamespaceSearchEngine, SearchEngineError
+from inbox.search.adaptor import get_search_engine, SearchEngineError
 from inbox.transactions import delta_sync
+from inbox.transactions.notifications import get_notifier
 
 from inbox.api.err import (err, APIException, NotFoundError, InputError,
                            ConflictError)
@@ -323,7 +323,7 @@ def thread_search_api():
     validate_search_sort(sort)
 
     try:
-        search_engine = NamespaceSearchEngine(g.namespace_public_id)
+        search_engine = get_search_engine(g.namespace_public_id)
         results = search_engine.threads.search(query=query,
                                                sort=sort,
                                                max_results=args.limit,
@@ -474,7 +474,7 @@ def message_search_api():
     validate_search_sort(sort)
 
     try:
-        search_engine = NamespaceSearchEngine(g.namespace_public_id)
+        search_engine = get_search_engine(g.namespace_public_id)
         results = search_engine.messages.search(query=query,
                                                 sort=sort,
                                                 max_results=args.limit,
@@ -850,9 +850,41 @@ def file_download_api(public_id):
             # HACK just append the major part of the content type
             name = 'attachment.{0}'.format(ct.split('/')[0])
 
-    # TODO the part.data object should really behave like a stream we can read
-    # & write to
-    response = make_response(f.data)
+    # Blocks are immutable, so their hash makes a strong ETag.
+    if request.if_none_match.contains(f.data_sha256):
+        response = Response(status=304)
+        response.set_etag(f.data_sha256)
+        return response
+
+    start, end = 0, f.size
+    status = 200
+    byte_range = request.range
+    if_range = request.headers.get('If-Range')
+    # Multiple ranges aren't supported, so (as RFC 7233 allows) they're
+    # ignored and the whole file is sent.
+    if byte_range is not None and len(byte_range.ranges) == 1 and \
+            if_range in (None, f.data_sha256, '"{}"'.format(f.data_sha256)):
+        range_for_length = byte_range.range_for_length(f.size)
+        if range_for_length is None:
+            response = Response(status=416)
+            response.headers['Content-Range'] = 'bytes */{}'.format(f.size)
+            return response
+        start, end = range_for_length
+        status = 206
+
+    # Stream the data from the block store rather than loading it all into
+    # memory.
+    chunks = f.stream(start, end)
+    if chunks is None:
+        raise NotFoundError("Couldn't find data for file {0}".format(
+            public_id))
+    response = Response(chunks, status=status, direct_passthrough=True)
+    response.headers['Content-Length'] = str(end - start)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if status == 206:
+        response.headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+            start, end - 1, f.size)
+    response.set_etag(f.data_sha256)
 
     response.headers['Content-Type'] = 'application/octet-stream'  # ct
     response.headers['Content-Disposition'] = \
@@ -1063,22 +1095,18 @@ def sync_deltas():
     args = strict_parse_args(g.parser, request.args)
     exclude_types = args.get('exclude_types')
     cursor = args['cursor']
-    if cursor == '0':
-        start_pointer = 0
-    else:
-        try:
-            start_pointer, = g.db_session.query(Transaction.id). \
-                filter(Transaction.public_id == cursor,
-                       Transaction.namespace_id == g.namespace.id).one()
-        except NoResultFound:
-            raise InputError('Invalid cursor parameter')
+    start_pointer = delta_sync.get_transaction_id_for_cursor(
+        g.namespace.id, cursor, g.db_session)
+    if start_pointer is None:
+        raise InputError('Invalid cursor parameter')
 
     # The client wants us to wait until there are changes
     g.db_session.close()  # hack to close the flask session
-    poll_interval = 1
+    notifier = get_notifier()
 
     start_time = time.time()
     while time.time() - start_time < LONG_POLL_REQUEST_TIMEOUT:
+        generation = notifier.generation(g.namespace.id)
         with session_scope() as db_session:
             deltas, _ = delta_sync.format_transactions_after_pointer(
                 g.namespace.id, start_pointer, db_session, args['limit'],
@@ -1094,7 +1122,9 @@ def sync_deltas():
 
         # No changes. perhaps wait
         elif args['wait']:
-            gevent.sleep(poll_interval)
+            remaining = LONG_POLL_REQUEST_TIMEOUT - (time.time() - start_time)
+            notifier.wait(g.namespace.id, generation,
+                          max(0, min(notifier.poll_interval, remaining)))
         else:  # Return immediately
             response['cursor_end'] = cursor
             return g.encoder.jsonify(response)
@@ -1130,17 +1160,10 @@ def stream_changes():
                           location='args')
     args = strict_parse_args(g.parser, request.args)
     timeout = args['timeout'] or 1800
-    transaction_pointer = None
-    cursor = args['cursor']
-    if cursor == '0':
-        transaction_pointer = 0
-    else:
-        query_result = g.db_session.query(Transaction.id).filter(
-            Transaction.namespace_id == g.namespace.id,
-            Transaction.public_id == cursor).first()
-        if query_result is None:
-            raise InputError('Invalid cursor {}'.format(args['cursor']))
-        transaction_pointer = query_result[0]
+    transaction_pointer = delta_sync.get_transaction_id_for_cursor(
+        g.namespace.id, args['cursor'], g.db_session)
+    if transaction_pointer is None:
+        raise InputError('Invalid cursor {}'.format(args['cursor']))
     exclude_types = args.get('exclude_types')
 
     # Hack to not keep a database session open for the entire (long) request
@@ -1149,5 +1172,6 @@ def stream_changes():
     # TODO make transaction log support the `expand` feature
     generator = delta_sync.streaming_change_generator(
         g.namespace.id, transaction_pointer=transaction_pointer,
-        poll_interval=1, timeout=timeout, exclude_types=exclude_types)
+        poll_interval=get_notifier().poll_interval, timeout=timeout,
+        exclude_types=exclude_types)
     return Response(generator, mimetype='text/event-stream')
@@ -1,8 +1,7 @@
+import time
 from datetime import datetime
 from collections import Counter
 
-from sqlalchemy.orm.exc import NoResultFound
-
 from inbox.log import get_logger
 logger = get_logger()
 from inbox.models import Contact, Account
@@ -20,6 +19,9 @@ CONTACT_SYNC_PROVIDER_MAP = {'gmail': GoogleContactsProvider,
 CONTACT_SYNC_FOLDER_ID = -1
 CONTACT_SYNC_FOLDER_NAME = 'Contacts'
 
+# Number of remote contacts to reconcile (and flush) at a time.
+CONTACT_BATCH_SIZE = 500
+
 
 class ContactSync(BaseSyncMonitor):
     """
@@ -71,47 +73,109 @@ class ContactSync(BaseSyncMonitor):
             account = db_session.query(Account).get(self.account_id)
             last_sync_dt = account.last_synced_contacts
 
+            start = time.time()
             all_contacts = self.provider.get_items(sync_from_dt=last_sync_dt)
+            fetch_time = time.time() - start
 
-            # Do a batch insertion of every 100 contact objects
-            change_counter = Counter()
-            for new_contact in all_contacts:
-                new_contact.namespace = account.namespace
-                assert new_contact.uid is not None, \
-                    'Got remote item with null uid'
-                assert isinstance(new_contact.uid, basestring)
-
-                try:
-                    existing_contact = db_session.query(Contact).filter(
-                        Contact.namespace == account.namespace,
-                        Contact.provider_name == self.provider.PROVIDER_NAME,
-                        Contact.uid == new_contact.uid).one()
-
-                    # If the remote item was deleted, purge the corresponding
-                    # database entries.
-                    if new_contact.deleted:
-                        db_session.delete(existing_contact)
-                        change_counter['deleted'] += 1
-                    else:
-                        # Update fields in our old item with the new.
-                        # Don't save the newly returned item to the database.
-                        existing_contact.merge_from(new_contact)
-                        change_counter['updated'] += 1
-
-                except NoResultFound:
-                    # We didn't know about this before! Add this item.
-                    db_session.add(new_contact)
-                    change_counter['added'] += 1
-
-                # Flush every 100 objects for perf
-                if sum(change_counter.values()) % 100:
-                    db_session.flush()
+            reconciler = ContactReconciler(account.namespace.id,
+                                           self.provider.PROVIDER_NAME,
+                                           db_session)
+            reconciler.reconcile(all_contacts)
 
         # Update last sync
         with session_scope() as db_session:
             account = db_session.query(Account).get(self.account_id)
             account.last_synced_contacts = sync_timestamp
 
-        self.log.info('synced contacts', added=change_counter['added'],
-                      updated=change_counter['updated'],
-                      deleted=change_counter['deleted'])
+        self.log.info('synced contacts', added=reconciler.counts['added'],
+                      updated=reconciler.counts['updated'],
+                      deleted=reconciler.counts['deleted'],
+                      fetch_time=fetch_time, **reconciler.timings)
+
+
+class ContactReconciler(object):
+    """
+    Applies remote contact changes to the contacts of a namespace, in
+    batches of `batch_size`: for each batch, the existing contacts are loaded
+    with a single query, the changes are applied in memory, and the session
+    is flushed once.
+
+    Attributes
+    ----------
+    counts: collections.Counter
+        Number of contacts 'added', 'updated' and 'deleted'.
+    timings: dict
+        Seconds spent loading existing contacts ('prefetch_time'), applying
+        changes ('merge_time') and flushing them ('flush_time').
+
+    """
+    def __init__(self, namespace_id, provider_name, db_session,
+                 batch_size=None):
+        self.namespace_id = namespace_id
+        self.provider_name = provider_name
+        self.db_session = db_session
+        self.batch_size = batch_size or CONTACT_BATCH_SIZE
+        self.counts = Counter()
+        self.timings = Counter()
+
+    def reconcile(self, remote_contacts):
+        batch = []
+        for remote_contact in remote_contacts:
+            batch.append(remote_contact)
+            if len(batch) == self.batch_size:
+                self._reconcile_batch(batch)
+                batch = []
+        if batch:
+            self._reconcile_batch(batch)
+
+    def _reconcile_batch(self, remote_contacts):
+        start = time.time()
+        with self.db_session.no_autoflush:
+            existing = self._load_existing(
+                [c.uid for c in remote_contacts])
+        prefetched = time.time()
+        self.timings['prefetch_time'] += prefetched - start
+
+        for new_contact in remote_contacts:
+            new_contact.namespace_id = self.namespace_id
+            assert new_contact.uid is not None, \
+                'Got remote item with null uid'
+            assert isinstance(new_contact.uid, basestring)
+
+            key = new_contact.uid.lower()
+            existing_contact = existing.get(key)
+            if existing_contact is None:
+                if not new_contact.deleted:
+                    # We didn't know about this before! Add this item.
+                    self.db_session.add(new_contact)
+                    existing[key] = new_contact
+                    self.counts['added'] += 1
+            elif new_contact.deleted:
+                # If the remote item was deleted, purge the corresponding
+                # database entries.
+                if existing_contact in self.db_session.new:
+                    self.db_session.expunge(existing_contact)
+                else:
+                    self.db_session.delete(existing_contact)
+                del existing[key]
+                self.counts['deleted'] += 1
+            else:
+                # Update fields in our old item with the new.
+                # Don't save the newly returned item to the database.
+                existing_contact.merge_from(new_contact)
+                self.counts['updated'] += 1
+        merged = time.time()
+        self.timings['merge_time'] += merged - prefetched
+
+        self.db_session.flush()
+        self.timings['flush_time'] += time.time() - merged
+
+    def _load_existing(self, uids):
+        """Return a dict mapping the (lowercased, since the database compares
+        them case-insensitively) uids of existing contacts among `uids` to
+        the contacts."""
+        contacts = self.db_session.query(Contact).filter(
+            Contact.namespace_id == self.namespace_id,
+            Contact.provider_name == self.provider_name,
+            Contact.uid.in_(set(uids)))
+        return {contact.uid.lower(): contact for contact in contacts}
@@ -17,9 +17,13 @@ imaplib.InternalDate = re.compile(
     r'(?P<sec>[0-9][0-9])'
     r' (?P<zonen>[-+])(?P<zoneh>[0-9][0-9])(?P<zonem>[0-9][0-9])'
     r'"')
+# imaplib doesn't know NOTIFY (RFC 5465), and refuses to send commands it
+# doesn't know.
+imaplib.Commands['NOTIFY'] = ('AUTH', 'SELECTED')
 
 import functools
 import threading
+import time
 from email.parser import HeaderParser
 
 from collections import namedtuple, defaultdict
@@ -59,6 +63,9 @@ RawMessage = namedtuple(
 # access token or the server being temporariliy unavailable.
 MAX_TRANSIENT_ERRORS = 2
 
+# Number of connections in each account's (read-only) connection pool.
+CONNECTION_POOL_SIZE = 3
+
 # Lazily-initialized map of account ids to lock objects.
 # This prevents multiple greenlets from concurrently creating duplicate
 # connection pools for a given account.
@@ -85,7 +92,8 @@ def _get_connection_pool(account_id, pool_size, pool_map, readonly):
             raise GreenletExit()
 
 
-def connection_pool(account_id, pool_size=3, pool_map=dict()):
+def connection_pool(account_id, pool_size=CONNECTION_POOL_SIZE,
+                    pool_map=dict()):
     """ Per-account crispin connection pool.
 
     Use like this:
@@ -113,6 +121,15 @@ def writable_connection_pool(account_id, pool_size=1, pool_map=dict()):
     """
     return _get_connection_pool(account_id, pool_size, pool_map, False)
 
+
+def idle_connection_pool(account_id, pool_size=1, pool_map=dict()):
+    """ Per-account crispin connection pool for watching folders with IDLE
+    (see inbox.mailsync.backends.imap.idle). Its connections are held for
+    as long as folders are watched, so they're kept apart from the
+    connections used for syncing.
+    """
+    return _get_connection_pool(account_id, pool_size, pool_map, True)
+
 CONN_DISCARD_EXC_CLASSES = (socket.error, imaplib.IMAP4.error)
 
 
@@ -445,6 +462,67 @@ class CrispinClient(object):
             full_criteria.append(criteria)
         return sorted([long(uid) for uid in self.conn.search(full_criteria)])
 
+    def idle_responses(self, timeout, check_interval):
+        """Idle for up to `timeout` seconds, yielding the (parsed) untagged
+        responses received every `check_interval` seconds, or as soon as
+        there are some. Closing the generator takes the connection back out of
+        idle mode."""
+        start = time.time()
+        self.conn.idle()
+        try:
+            while time.time() - start < timeout:
+                yield self.conn.idle_check(check_interval)
+        finally:
+            self.conn.idle_done()
+
+    def pending_responses(self):
+        """The (parsed) untagged responses the server has queued up since the
+        last command."""
+        return self.conn.noop()[1]
+
+    def supports_notify(self):
+        return 'NOTIFY' in self.conn.capabilities()
+
+    def notify(self, folders):
+        """ Ask the server to report changes to `folders` (including flag
+        changes) with untagged STATUS responses, which we can then read while
+        idling. See RFC 5465.
+
+        Replaces any folders previously asked for.
+        """
+        mailboxes = ' '.join(self.conn._normalise_folder(f) for f in folders)
+        typ, data = self.conn._imap._simple_command(
+            'NOTIFY', 'SET',
+            '(mailboxes ({}) (MessageNew MessageExpunge FlagChange))'.
+            format(mailboxes))
+        if typ != 'OK':
+            raise imaplib.IMAP4.error('NOTIFY failed: {}'.format(data))
+
+    def selected_status(self):
+        """ The UIDVALIDITY, UIDNEXT and MESSAGES count of the currently
+        selected folder, as a dict.
+
+        Servers include these in the response to SELECT (as UIDVALIDITY,
+        UIDNEXT and EXISTS), so this only issues a STATUS command if UIDNEXT
+        was missing from it.
+        """
+        info = self.selected_folder_info
+        if 'UIDNEXT' in info and 'EXISTS' in info:
+            return {'UIDVALIDITY': long(info['UIDVALIDITY']),
+                    'UIDNEXT': long(info['UIDNEXT']),
+                    'MESSAGES': long(info['EXISTS'])}
+        status = self.conn.folder_status(self.selected_folder_name,
+                                         ('UIDVALIDITY', 'UIDNEXT',
+                                          'MESSAGES'))
+        return {param: long(value) for param, value in status.iteritems()}
+
+    def uids_from(self, uid):
+        """ Fetch the not-deleted UIDs of the currently selected folder that
+        are at least `uid`, sorted in ascending order. """
+        # 'UID n:*' always matches the highest UID, even if it's below n.
+        return [u for u in self.search_uids(['UID', '{}:*'.format(uid)])
+                if u >= uid]
+
     def all_uids(self):
         """ Fetch all UIDs associated with the currently selected folder.
 
@@ -486,6 +564,20 @@ class CrispinClient(object):
         return {uid: Flags(ret['FLAGS'])
                 for uid, ret in data.items() if uid in uid_set}
 
+    def sizes(self, uids):
+        """ RFC822.SIZE for the given UIDs. Cheap to fetch, so we use it to
+        decide how many messages to download in a single FETCH.
+
+        Returns
+        -------
+        dict
+            Mapping of `uid` (long) : size in bytes (int)
+        """
+        data = self.conn.fetch(uids, ['RFC822.SIZE'])
+        uid_set = set(uids)
+        return {uid: ret['RFC822.SIZE']
+                for uid, ret in data.items() if uid in uid_set}
+
     def copy_uids(self, uids, to_folder):
         if not uids:
             return
@@ -5,8 +5,10 @@ import json
 import urllib
 import gevent
 import requests
+from requests.adapters import HTTPAdapter
 
 from inbox.basicauth import AccessNotEnabledError
+from inbox.config import config
 from inbox.log import get_logger
 from inbox.models import Calendar, Account
 from inbox.models.event import Event, EVENT_STATUSES
@@ -17,7 +19,11 @@ from inbox.events.util import (google_to_event_time, parse_google_time,
 
 
 log = get_logger()
-CALENDARS_URL = 'https://www.googleapis.com/calendar/v3/users/me/calendarList'
+# Overridable so that sync can be run against a fake calendar API.
+API_URL = config.get('GOOGLE_CALENDAR_API_URL',
+                     'https://www.googleapis.com/calendar/v3')
+# Maximum number of concurrent requests per account.
+MAX_CONCURRENT_REQUESTS = 4
 STATUS_MAP = {'accepted': 'yes', 'needsAction': 'noreply',
               'declined': 'no', 'tentative': 'maybe'}
 
@@ -39,8 +45,16 @@ class GoogleEventsProvider(object):
     def __init__(self, account_id, namespace_id):
         self.account_id = account_id
         self.namespace_id = namespace_id
+        self.api_url = API_URL
         self.log = log.new(account_id=account_id)
 
+        # Share one session (and its keep-alive connections) between all the
+        # requests for the account, including concurrent ones.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=MAX_CONCURRENT_REQUESTS)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
     def sync_calendars(self):
         """ Fetches data for the user's calendars.
         Returns
@@ -77,21 +91,49 @@ class GoogleEventsProvider(object):
         -------
         SyncResponse
         """
-        deletes = []
-        updates = []
         items = self._get_raw_events(calendar_uid, sync_from_time)
-        for item in items:
-            # We need to instantiate recurring event cancellations as overrides
-            if item.get('status') == 'cancelled' and not \
-                    item.get('recurringEventId'):
-                deletes.append(item['id'])
-            else:
-                updates.append(parse_event_response(item))
-        return SyncResponse(deletes, updates)
+        return _parse_event_items(items)
+
+    def sync_events_incrementally(self, calendar_uid, sync_token=None):
+        """ Fetches the changes to the events of an individual calendar since
+        the sync that returned `sync_token`, or all of its events if
+        `sync_token` is None. If Google has invalidated the sync token, all
+        events are fetched again. A full listing leaves out the events
+        deleted in the meantime, so in that case the caller must delete the
+        local events that aren't listed.
+
+        Returns
+        -------
+        (SyncResponse, string, bool)
+            The changes, the sync token to pass next time, and whether the
+            sync token was invalidated and the changes are a full listing
+            instead.
+        """
+        url = self._events_url(calendar_uid)
+        if sync_token is not None:
+            try:
+                items, next_sync_token = self._get_resource_list_and_token(
+                    url, syncToken=sync_token)
+                return _parse_event_items(items), next_sync_token, False
+            except requests.exceptions.HTTPError as exc:
+                if exc.response.status_code != 410:
+                    raise
+                self.log.info('Sync token invalidated; fetching all events',
+                              calendar_uid=calendar_uid)
+                items, next_sync_token = self._get_resource_list_and_token(
+                    url)
+                return _parse_event_items(items), next_sync_token, True
+        items, next_sync_token = self._get_resource_list_and_token(url)
+        return _parse_event_items(items), next_sync_token, False
+
+    def _events_url(self, calendar_uid):
+        return '{}/calendars/{}/events'.format(self.api_url,
+                                               urllib.quote(calendar_uid))
 
     def _get_raw_calendars(self):
         """Gets raw data for the user's calendars."""
-        return self._get_resource_list(CALENDARS_URL)
+        return self._get_resource_list(
+            '{}/users/me/calendarList'.format(self.api_url))
 
     def _get_raw_events(self, calendar_uid, sync_from_time=None):
         """ Gets raw event data for the given calendar.
@@ -112,8 +154,7 @@ class GoogleEventsProvider(object):
             # Note explicit offset is required by Google calendar API.
             sync_from_time = datetime.datetime.isoformat(sync_from_time) + 'Z'
 
-        url = 'https://www.googleapis.com/calendar/v3/' \
-              'calendars/{}/events'.format(urllib.quote(calendar_uid))
+        url = self._events_url(calendar_uid)
         try:
             return self._get_resource_list(url, updatedMin=sync_from_time)
         except requests.exceptions.HTTPError as exc:
@@ -134,6 +175,12 @@ class GoogleEventsProvider(object):
 
     def _get_resource_list(self, url, **params):
         """Handles response pagination."""
+        items, _ = self._get_resource_list_and_token(url, **params)
+        return items
+
+    def _get_resource_list_and_token(self, url, **params):
+        """Handles response pagination. Returns the items, and the sync token
+        returned with the last page (or None)."""
         token = self._get_access_token()
         items = []
         next_page_token = None
@@ -141,13 +188,13 @@ class GoogleEventsProvider(object):
         while True:
             if next_page_token is not None:
                 params['pageToken'] = next_page_token
-            r = requests.get(url, params=params, auth=OAuth(token))
+            r = self.session.get(url, params=params, auth=OAuth(token))
             if r.status_code == 200:
                 data = r.json()
                 items += data['items']
                 next_page_token = data.get('nextPageToken')
                 if next_page_token is None:
-                    return items
+                    return items, data.get('nextSyncToken')
             else:
                 self.log.warning(
                     'HTTP error making Google Calendar API request', url=r.url,
@@ -183,11 +230,10 @@ class GoogleEventsProvider(object):
                             **kwargs):
         """Makes a POST/PUT/DELETE request for a particular event."""
         event_uid = event_uid or ''
-        url = 'https://www.googleapis.com/calendar/v3/' \
-              'calendars/{}/events/{}'.format(urllib.quote(calendar_uid),
-                                              urllib.quote(event_uid))
+        url = '{}/{}'.format(self._events_url(calendar_uid),
+                             urllib.quote(event_uid))
         token = self._get_access_token()
-        r = requests.request(method, url, auth=OAuth(token), **kwargs)
+        r = self.session.request(method, url, auth=OAuth(token), **kwargs)
         r.raise_for_status()
         return r
 
@@ -205,6 +251,19 @@ class GoogleEventsProvider(object):
         self._make_event_request('delete', calendar_uid, event_uid)
 
 
+def _parse_event_items(items):
+    deletes = []
+    updates = []
+    for item in items:
+        # We need to instantiate recurring event cancellations as overrides
+        if item.get('status') == 'cancelled' and not \
+                item.get('recurringEventId'):
+            deletes.append(item['id'])
+        else:
+            updates.append(parse_event_response(item))
+    return SyncResponse(deletes, updates)
+
+
 def parse_calendar_response(calendar):
     """
     Constructs a Calendar object from a Google calendarList resource (a
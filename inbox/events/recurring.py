@@ -1,8 +1,14 @@
+import heapq
+from bisect import bisect_left
+from collections import OrderedDict
+
 import arrow
 from dateutil.rrule import (rrulestr, rrule, rruleset,
                             MO, TU, WE, TH, FR, SA, SU)
 
-from inbox.models.event import RecurringEvent, RecurringEventOverride
+from inbox.config import config
+from inbox.models.event import (RecurringEvent, RecurringEventOverride,
+                                InflatedEvent)
 from inbox.events.util import parse_rrule_datetime
 
 from inbox.log import get_logger
@@ -11,6 +17,13 @@ log = get_logger()
 # How far in the future to expand recurring events
 EXPAND_RECURRING_YEARS = 1
 
+# Maximum number of uids to look up per query when linking events in bulk.
+LINK_CHUNK_SIZE = 500
+
+# Maximum number of recurring events whose expansions `expansion_cache`
+# remembers.
+EXPANSION_CACHE_SIZE = config.get('RECURRENCE_EXPANSION_CACHE_SIZE', 1000)
+
 
 def link_events(db_session, event):
     if isinstance(event, RecurringEvent):
@@ -49,6 +62,48 @@ def link_master(db_session, event):
     return event.master  # This may be None.
 
 
+def link_all_events(db_session, events):
+    """
+    Like link_events, for a batch of events: link each RecurringEvent to its
+    overrides and each RecurringEventOverride to its master, with one query
+    per LINK_CHUNK_SIZE events rather than one per event. The events must
+    have been flushed.
+
+    """
+    masters = [e for e in events if isinstance(e, RecurringEvent)]
+    orphans = [e for e in events if isinstance(e, RecurringEventOverride) and
+               not e.master and e.master_event_uid]
+
+    masters_by_key = {(e.namespace_id, e.uid, e.source): e for e in masters}
+    for chunk in _chunks(masters):
+        overrides = db_session.query(RecurringEventOverride).filter(
+            RecurringEventOverride.namespace_id.in_(
+                {e.namespace_id for e in chunk}),
+            RecurringEventOverride.master_event_uid.in_(
+                {e.uid for e in chunk}))
+        for o in overrides:
+            master = masters_by_key.get((o.namespace_id, o.master_event_uid,
+                                         o.source))
+            if master is not None and not o.master:
+                o.master = master
+
+    for chunk in _chunks([o for o in orphans if not o.master]):
+        candidates = db_session.query(RecurringEvent).filter(
+            RecurringEvent.namespace_id.in_({o.namespace_id for o in chunk}),
+            RecurringEvent.uid.in_({o.master_event_uid for o in chunk}))
+        found = {(e.namespace_id, e.uid, e.source): e for e in candidates}
+        for o in chunk:
+            master = found.get((o.namespace_id, o.master_event_uid,
+                                o.source))
+            if master is not None:
+                o.master = master
+
+
+def _chunks(items):
+    for i in range(0, len(items), LINK_CHUNK_SIZE):
+        yield items[i:i + LINK_CHUNK_SIZE]
+
+
 def parse_rrule(event):
     # Parse the RRULE string and return a dateutil.rrule.rrule object
     if event.rrule is not None:
@@ -82,6 +137,122 @@ def parse_exdate(event):
     return excl_dates
 
 
+class Expansion(object):
+    """
+    The start times of a recurring event's instances, expanded incrementally.
+
+    Start times are generated in order from the event's recurrence rules as
+    far as the latest window asked for, and remembered, so a window that has
+    already been covered is looked up by bisection without touching the
+    rules again.
+
+    """
+    def __init__(self, rrules, all_day):
+        self.all_day = all_day
+        self._rule_times = iter(rrules)
+        self._exhausted = False
+        # The start times as generated by dateutil (naive for all-day
+        # events), to search, and converted to UTC, to return.
+        self._raw = []
+        self._times = []
+
+    def between(self, start, end):
+        """Return the start times between the arrow datetimes `start` and
+        `end`, including `start` and `end` themselves if they obey the
+        rule."""
+        return list(self.iter_between(start, end))
+
+    def iter_between(self, start, end):
+        """Like between, but generate the start times in order, expanding
+        only as far as they are consumed."""
+        if self.all_day:
+            # compare naive times, since date handling in rrulestr is naive
+            # when UNTIL takes the form YYYYMMDD
+            start = start.to('utc').naive
+            end = end.to('utc').naive
+        else:
+            start = start.datetime
+            end = end.datetime
+        if self._raw and self._raw[-1] >= start:
+            i = bisect_left(self._raw, start)
+        else:
+            while self._expand_one() and self._raw[-1] < start:
+                pass
+            i = len(self._raw) - 1 if self._raw else 0
+        while i < len(self._raw) or self._expand_one():
+            if self._raw[i] > end:
+                return
+            if self._raw[i] >= start:
+                yield self._times[i]
+            i += 1
+
+    def _expand_one(self):
+        if self._exhausted:
+            return False
+        try:
+            t = next(self._rule_times)
+        except StopIteration:
+            self._exhausted = True
+            return False
+        self._raw.append(t)
+        # Convert back to UTC, which covers daylight savings differences
+        self._times.append(arrow.get(t).to('utc'))
+        return True
+
+
+class ExpansionCache(object):
+    """
+    A bounded LRU mapping of recurring event ids to their Expansions.
+
+    Entries are keyed on the event's recurrence as well as its id, so that
+    a changed event gets a fresh expansion rather than a stale one.
+
+    """
+    def __init__(self, max_size=EXPANSION_CACHE_SIZE):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, event):
+        if event.id is None:
+            self.misses += 1
+            return _expand(event)
+        key = _recurrence_key(event)
+        entry = self._cache.pop(event.id, None)
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = (key, _expand(event))
+        self._cache[event.id] = entry
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return entry[1]
+
+
+expansion_cache = ExpansionCache()
+
+
+def _recurrence_key(event):
+    return (event.rrule, event.exdate, event.start, event.start_timezone,
+            event.all_day, event.last_modified)
+
+
+def _expand(event):
+    rrules = parse_rrule(event)
+    if not rrules:
+        return None
+
+    excl_dates = parse_exdate(event)
+
+    if len(excl_dates) > 0:
+        if not isinstance(rrules, rruleset):
+            rrules = rruleset().rrule(rrules)
+        map(rrules.exdate, excl_dates)
+    return Expansion(rrules, event.all_day)
+
+
 def get_start_times(event, start=None, end=None):
     # Expands the rrule on event to return a list of arrow datetimes
     # representing start times for its recurring instances.
@@ -89,6 +260,12 @@ def get_start_times(event, start=None, end=None):
     # otherwise defaults to the event start date and now + 1 year;
     # this can return a lot of instances if the event recurs more frequently
     # than weekly!
+    return list(iter_start_times(event, start, end))
+
+
+def iter_start_times(event, start=None, end=None):
+    # Like get_start_times, but generates the start times in order, only
+    # expanding the rrule as far as they are consumed.
 
     if isinstance(event, RecurringEvent):
         # Localize first so that expansion covers DST
@@ -104,35 +281,72 @@ def get_start_times(event, start=None, end=None):
         else:
             end = arrow.get(end)
 
-        rrules = parse_rrule(event)
-        if not rrules:
+        expansion = expansion_cache.get(event)
+        if expansion is None:
             log.warn('Tried to expand a non-recurring event',
                      event_id=event.id)
-            return [event.start]
+            yield event.start
+            return
 
-        excl_dates = parse_exdate(event)
+        for t in expansion.iter_between(start, end):
+            yield t
+        return
 
-        if len(excl_dates) > 0:
-            if not isinstance(rrules, rruleset):
-                rrules = rruleset().rrule(rrules)
-            map(rrules.exdate, excl_dates)
+    yield event.start
 
-        # Return all start times between start and end, including start and
-        # end themselves if they obey the rule.
-        if event.all_day:
-            # compare naive times, since date handling in rrulestr is naive
-            # when UNTIL takes the form YYYYMMDD
-            start = start.to('utc').naive
-            end = end.to('utc').naive
 
-        start_times = rrules.between(start, end, inc=True)
+def instance_uid(event, start):
+    # The uid of the instance of a recurring event starting at `start`, as
+    # given to InflatedEvents and to the overrides that replace them.
+    return '{}_{}'.format(event.uid, start.strftime("%Y%m%dT%H%M%SZ"))
 
-        # Convert back to UTC, which covers daylight savings differences
-        start_times = [arrow.get(t).to('utc') for t in start_times]
 
-        return start_times
+def merge_by_start(event_iterables):
+    """
+    Merge iterables of events that are each sorted by start time into a
+    single generator, sorted by start time, which only consumes each iterable
+    as far as needed.
+
+    """
+    # The iterable's index breaks ties, so that events are never compared.
+    def keyed(i, events):
+        for e in events:
+            yield e.start, i, e
+    merged = heapq.merge(*[keyed(i, events)
+                           for i, events in enumerate(event_iterables)])
+    return (e for start, i, e in merged)
+
+
+def iter_events(event, overrides, start=None, end=None):
+    """
+    Generate the instances of a recurring event between `start` and `end` in
+    start order, like RecurringEvent.all_events, but only expanding as many
+    as are consumed.
+
+    Parameters
+    ----------
+    event: RecurringEvent
+    overrides: list of RecurringEventOverride
+        The event's overrides in the window, sorted by start time.
+
+    """
+    uids = {o.uid for o in overrides}
+    # Remove cancellations from the override set, and leave out the inflated
+    # instances that overrides replace (they have the same uid).
+    inflated = (InflatedEvent(event, t) for t in
+                iter_start_times(event, start, end)
+                if instance_uid(event, t) not in uids)
+    return merge_by_start([[o for o in overrides if not o.cancelled],
+                           inflated])
+
 
-    return [event.start]
+def count_events(event, overrides, start=None, end=None):
+    """ The number of events iter_events would generate, computed from the
+    start times alone. """
+    uids = {o.uid for o in overrides}
+    return len([o for o in overrides if not o.cancelled]) + \
+        sum(1 for t in iter_start_times(event, start, end)
+            if instance_uid(event, t) not in uids)
 
 
 # rrule constant values
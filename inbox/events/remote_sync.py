@@ -1,5 +1,8 @@
 from datetime import datetime
 
+from gevent.pool import Pool
+
+from inbox.config import config
 from inbox.log import get_logger
 logger = get_logger()
 
@@ -10,13 +13,21 @@ from inbox.models.event import RecurringEvent, RecurringEventOverride
 from inbox.util.debug import bind_context
 from inbox.models.session import session_scope
 
-from inbox.events.recurring import link_events
+from inbox.events.recurring import link_all_events
 from inbox.events.google import GoogleEventsProvider
 
 
 EVENT_SYNC_FOLDER_ID = -2
 EVENT_SYNC_FOLDER_NAME = 'Events'
 
+# Maximum number of event uids to look up per query.
+EVENT_LOAD_CHUNK_SIZE = 1000
+# Maximum number of calendars to fetch events for at once.
+MAX_CONCURRENT_CALENDAR_SYNCS = 4
+# Whether to fetch events with per-calendar sync tokens (only the changes
+# since the last sync) rather than by last modification time.
+INCREMENTAL_EVENT_SYNC = config.get('INCREMENTAL_EVENT_SYNC', False)
+
 
 class EventSync(BaseSyncMonitor):
     """Per-account event sync engine."""
@@ -64,14 +75,47 @@ class EventSync(BaseSyncMonitor):
                                                             db_session)
             db_session.commit()
 
-        for (uid, id_) in calendar_uids_and_ids:
-            deleted_uids, event_changes = self.provider.sync_events(
-                uid, sync_from_time=last_sync)
+            sync_tokens = dict(db_session.query(Calendar.id,
+                                                Calendar.sync_token).
+                               filter(Calendar.namespace_id ==
+                                      self.namespace_id))
+
+        def fetch_events(calendar_uid_and_id):
+            uid, id_ = calendar_uid_and_id
+            if INCREMENTAL_EVENT_SYNC:
+                changes, sync_token, token_invalidated = \
+                    self.provider.sync_events_incrementally(
+                        uid, sync_tokens.get(id_))
+            else:
+                changes = self.provider.sync_events(uid,
+                                                    sync_from_time=last_sync)
+                sync_token = None
+                token_invalidated = False
+            return id_, changes, sync_token, token_invalidated
+
+        # Fetch events for several calendars at once, and persist the changes
+        # to each as soon as they come in.
+        pool = Pool(MAX_CONCURRENT_CALENDAR_SYNCS)
+        for id_, (deleted_uids, event_changes), sync_token, \
+                token_invalidated in pool.imap_unordered(
+                    fetch_events, calendar_uids_and_ids):
             with session_scope() as db_session:
+                if token_invalidated:
+                    # The changes are a full listing of the calendar, without
+                    # the events deleted since the last sync.
+                    deleted_uids = deleted_uids + _unlisted_event_uids(
+                        self.namespace_id, id_,
+                        deleted_uids + [e.uid for e in event_changes],
+                        db_session)
                 handle_event_deletes(self.namespace_id, id_, deleted_uids,
                                      self.log, db_session)
                 handle_event_updates(self.namespace_id, id_, event_changes,
                                      self.log, db_session)
+                if sync_token is not None:
+                    # Bulk update, so that no transaction is created.
+                    db_session.query(Calendar).filter(Calendar.id == id_). \
+                        update({'sync_token': sync_token},
+                               synchronize_session=False)
                 db_session.commit()
 
         with session_scope() as db_session:
@@ -148,20 +192,24 @@ def handle_event_deletes(namespace_id, calendar_id, deleted_event_uids,
 
 
 def handle_event_updates(namespace_id, calendar_id, events, log, db_session):
-    """Persists new or updated Event objects to the database."""
+    """Persists new or updated Event objects to the database.
+
+    Existing events are loaded up front, EVENT_LOAD_CHUNK_SIZE uids per
+    query, and recurring events and overrides are linked in a single pass
+    once everything has been flushed, so a large calendar doesn't take a
+    query (and a flush) per event.
+
+    """
     added_count = 0
     updated_count = 0
+    local_events = _load_events_by_uid(namespace_id, calendar_id,
+                                       [event.uid for event in events],
+                                       db_session)
+    recurring = []
     for event in events:
         assert event.uid is not None, 'Got remote item with null uid'
 
-        # Note: we could bulk-load previously existing events instead of
-        # loading them one-by-one. This would make the first sync faster, and
-        # probably not really affect anything else.
-        local_event = db_session.query(Event).filter(
-            Event.namespace_id == namespace_id,
-            Event.calendar_id == calendar_id,
-            Event.uid == event.uid).first()
-
+        local_event = local_events.get(event.uid.lower())
         if local_event is not None:
             local_event.update(event)
             updated_count += 1
@@ -170,16 +218,48 @@ def handle_event_updates(namespace_id, calendar_id, events, log, db_session):
             local_event.namespace_id = namespace_id
             local_event.calendar_id = calendar_id
             db_session.add(local_event)
+            # The same uid may come up again later in the batch.
+            local_events[event.uid.lower()] = local_event
             added_count += 1
 
         # If we just updated/added a recurring event or override, make sure
         # we link it to the right master event.
-        if isinstance(event, RecurringEvent) or \
-                isinstance(event, RecurringEventOverride):
-            db_session.flush()
-            link_events(db_session, event)
+        if isinstance(local_event, (RecurringEvent, RecurringEventOverride)):
+            recurring.append(local_event)
+
+    if recurring:
+        db_session.flush()
+        link_all_events(db_session, recurring)
 
     log.info('synced added and updated events',
              calendar_id=calendar_id,
              added=added_count,
              updated=updated_count)
+
+
+def _unlisted_event_uids(namespace_id, calendar_id, listed_uids,
+                         db_session):
+    """Return the uids of the calendar's events that aren't in
+    `listed_uids`. Uids are compared case-insensitively, like the database
+    does."""
+    listed_uids = {uid.lower() for uid in listed_uids}
+    local_uids = db_session.query(Event.uid).filter(
+        Event.namespace_id == namespace_id,
+        Event.calendar_id == calendar_id)
+    return [uid for uid, in local_uids if uid.lower() not in listed_uids]
+
+
+def _load_events_by_uid(namespace_id, calendar_id, uids, db_session):
+    """Return a dict mapping those of `uids` that exist in the calendar to
+    their Event. Keys are lowercased, since uids are compared
+    case-insensitively by the database."""
+    uids = list(set(uids))
+    events = {}
+    with db_session.no_autoflush:
+        for i in range(0, len(uids), EVENT_LOAD_CHUNK_SIZE):
+            for event in db_session.query(Event).filter(
+                    Event.namespace_id == namespace_id,
+                    Event.calendar_id == calendar_id,
+                    Event.uid.in_(uids[i:i + EVENT_LOAD_CHUNK_SIZE])):
+                events[event.uid.lower()] = event
+    return events
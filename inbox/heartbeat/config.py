@@ -6,6 +6,9 @@ STATUS_DATABASE = 1
 REPORT_DATABASE = 2
 
 ALIVE_EXPIRY = int(config.get('BASE_ALIVE_THRESHOLD', 480))
+# If set, heartbeats are written to Redis in batches every this many seconds,
+# rather than as they're published.
+HEARTBEAT_FLUSH_INTERVAL = config.get('HEARTBEAT_FLUSH_INTERVAL', 0)
 
 CONTACTS_FOLDER_ID = '-1'
 EVENTS_FOLDER_ID = '-2'
@@ -2,11 +2,17 @@ from datetime import datetime
 import time
 import json
 
+import gevent
+
 from inbox.log import get_logger
 log = get_logger()
 from inbox.heartbeat.config import (CONTACTS_FOLDER_ID, EVENTS_FOLDER_ID,
+                                    HEARTBEAT_FLUSH_INTERVAL,
                                     get_redis_client)
 
+# Seconds between logging HeartbeatAggregator's flush metrics.
+FLUSH_REPORT_INTERVAL = 60
+
 
 def safe_failure(f):
     def wrapper(*args, **kwargs):
@@ -93,9 +99,14 @@ class HeartbeatStatusProxy(object):
                 self.heartbeat_at = time.time()
                 self.value['heartbeat_at'] = str(datetime.fromtimestamp(
                     self.heartbeat_at))
-            self.store.publish(
-                self.key, self.device_id, json.dumps(self.value),
-                self.heartbeat_at)
+            if HEARTBEAT_FLUSH_INTERVAL:
+                HeartbeatAggregator.for_store(self.store).update(
+                    self.key, self.device_id, json.dumps(self.value),
+                    self.heartbeat_at)
+            else:
+                self.store.publish(
+                    self.key, self.device_id, json.dumps(self.value),
+                    self.heartbeat_at)
             if 'action' in self.value:
                 del self.value['action']
         except Exception:
@@ -112,6 +123,97 @@ class HeartbeatStatusProxy(object):
                                   self.device_id)
 
 
+class HeartbeatAggregator(object):
+    """
+    Coalesces the heartbeats published by a process and writes them to the
+    store every `flush_interval` seconds, in one batch. Only the most recent
+    update for each folder and device is written. Enable by setting
+    "HEARTBEAT_FLUSH_INTERVAL" in your config.
+
+    Flush metrics (see metrics_dict) are logged every FLUSH_REPORT_INTERVAL
+    seconds.
+
+    """
+    _instances = {}
+
+    def __init__(self, store, flush_interval=HEARTBEAT_FLUSH_INTERVAL):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.flusher = None
+        # How long the last flush took, in seconds, and how many updates it
+        # wrote.
+        self.flush_latency = None
+        self.flush_size = 0
+        # Since flush metrics were last logged: the number of flushes, the
+        # updates they wrote and the longest one, in seconds.
+        self.flushes = 0
+        self.flushed_updates = 0
+        self.max_flush_latency = 0
+        self.last_report = time.time()
+
+    @classmethod
+    def for_store(cls, store):
+        if id(store) not in cls._instances:
+            cls._instances[id(store)] = cls(store)
+        return cls._instances[id(store)]
+
+    def update(self, key, device_id, value, timestamp):
+        self.pending[(str(key), device_id)] = (key, device_id, value,
+                                               timestamp)
+        if self.flusher is None or self.flusher.ready():
+            self.flusher = gevent.spawn(self._run)
+
+    def discard(self, account_id, folder_id=None, device_id=None):
+        # Drop pending updates for the given account, folder and/or device,
+        # so that a flush doesn't write back heartbeats that were removed.
+        for pending_key, (key, device, _, _) in self.pending.items():
+            if str(key.account_id) != str(account_id):
+                continue
+            if folder_id and str(key.folder_id) != str(folder_id):
+                continue
+            if device_id and str(device) != str(device_id):
+                continue
+            del self.pending[pending_key]
+
+    def _run(self):
+        while True:
+            gevent.sleep(self.flush_interval)
+            self.flush()
+
+    @safe_failure
+    def flush(self):
+        if not self.pending:
+            return
+        updates = self.pending.values()
+        self.pending = {}
+        start = time.time()
+        self.store.publish_many(updates)
+        self.flush_latency = time.time() - start
+        self.flush_size = len(updates)
+        self.flushes += 1
+        self.flushed_updates += self.flush_size
+        self.max_flush_latency = max(self.max_flush_latency,
+                                     self.flush_latency)
+        if self.flush_latency > self.flush_interval:
+            log.warning('Slow heartbeat flush',
+                        flush_latency=self.flush_latency,
+                        flush_size=self.flush_size)
+        if time.time() - self.last_report >= FLUSH_REPORT_INTERVAL:
+            log.info('heartbeat flushes', **self.metrics_dict())
+            self.flushes = 0
+            self.flushed_updates = 0
+            self.max_flush_latency = 0
+            self.last_report = time.time()
+
+    def metrics_dict(self):
+        return dict(flush_latency=self.flush_latency,
+                    flush_size=self.flush_size,
+                    max_flush_latency=self.max_flush_latency,
+                    flushes=self.flushes,
+                    flushed_updates=self.flushed_updates)
+
+
 class HeartbeatStore(object):
     """ Store that proxies requests to Redis with handlers that also
         update indexes and handle scanning through results. """
@@ -130,13 +232,40 @@ class HeartbeatStore(object):
 
     @safe_failure
     def publish(self, key, device_id, value, timestamp=None):
-        if not timestamp:
-            timestamp = time.time()
         # Publish a heartbeat update for the given key and device_id.
-        self.client.hset(key, device_id, value)
-        # Update indexes
-        self.update_folder_index(key, float(timestamp))
-        self.update_accounts_index(key)
+        self.publish_many([(key, device_id, value, timestamp)])
+
+    def publish_many(self, updates):
+        """
+        Publish a list of (key, device_id, value, timestamp) heartbeat
+        updates, and update the indexes accordingly, in two round trips.
+
+        """
+        pipeline = self.client.pipeline()
+        account_ids = []
+        for key, device_id, value, timestamp in updates:
+            if not timestamp:
+                timestamp = time.time()
+            pipeline.hset(key, device_id, value)
+            pipeline.zadd('folder_index', float(timestamp), key)
+            pipeline.zadd(key.account_id, float(timestamp), key.folder_id)
+            if key.account_id not in account_ids:
+                account_ids.append(key.account_id)
+        # Find the oldest heartbeat of each account from the account-folder
+        # index.
+        for account_id in account_ids:
+            pipeline.zrange(account_id, 0, 0, withscores=True)
+        oldest = pipeline.execute()[-len(account_ids):]
+        pipeline.reset()
+
+        for account_id, folders in zip(account_ids, oldest):
+            # If all heartbeats were deleted at the same time as this, there
+            # is no oldest heartbeat -- ignore it.
+            if folders:
+                f, oldest_heartbeat = folders[0]
+                pipeline.zadd('account_index', oldest_heartbeat, account_id)
+        pipeline.execute()
+        pipeline.reset()
 
     def remove(self, key, device_id=None, client=None):
         # Remove a key from the store, or device entry from a key.
@@ -155,6 +284,9 @@ class HeartbeatStore(object):
     @safe_failure
     def remove_folders(self, account_id, folder_id=None, device_id=None):
         # Remove heartbeats for the given account, folder and/or device.
+        aggregator = HeartbeatAggregator._instances.get(id(self))
+        if aggregator is not None:
+            aggregator.discard(account_id, folder_id, device_id)
         if folder_id:
             key = HeartbeatStatusKey(account_id, folder_id)
             self.remove(key, device_id)
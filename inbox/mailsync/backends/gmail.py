@@ -24,7 +24,7 @@ from collections import namedtuple
 from gevent import kill, spawn, sleep
 from sqlalchemy.orm import joinedload, load_only
 
-from inbox.util.itert import chunk, partition
+from inbox.util.itert import partition
 from inbox.util.debug import bind_context
 
 from inbox.crispin import GmailSettingError
@@ -36,7 +36,15 @@ from inbox.mailsync.backends.base import (create_db_objects,
                                           commit_uids,
                                           mailsync_session_scope,
                                           THROTTLE_WAIT)
-from inbox.mailsync.backends.imap.generic import safe_download, UIDStack
+from inbox.mailsync.backends.imap.generic import (safe_download, UIDStack,
+                                                  size_limited_batch,
+                                                  parse_raw_messages,
+                                                  unzip_parsed,
+                                                  DOWNLOAD_BATCH_MAX_UIDS,
+                                                  DOWNLOAD_BATCH_MAX_BYTES)
+from inbox.mailsync.backends.imap.locking import message_lock_keys
+from inbox.mailsync.backends.imap.pipeline import DownloadPipeline
+from inbox.mailsync.backends.imap.uidset import UIDSet
 from inbox.mailsync.backends.imap.condstore import CondstoreFolderSyncEngine
 from inbox.mailsync.backends.imap.monitor import ImapSyncMonitor
 from inbox.mailsync.backends.imap import common
@@ -55,6 +63,7 @@ class GmailSyncMonitor(ImapSyncMonitor):
 
     def sync(self):
         self.start_delete_handler()
+        self.idle_manager.start()
         self.start_new_folder_sync_engines()
         self.folder_monitors.join()
 
@@ -69,9 +78,6 @@ class GmailFolderSyncEngine(CondstoreFolderSyncEngine):
     def is_all_mail(self, crispin_client):
         return self.folder_name == crispin_client.folder_names()['all']
 
-    def should_idle(self, crispin_client):
-        return self.is_all_mail(crispin_client)
-
     def initial_sync_impl(self, crispin_client):
         # We wrap the block in a try/finally because the greenlets like
         # change_poller need to be killed when this greenlet is interrupted
@@ -80,13 +86,13 @@ class GmailFolderSyncEngine(CondstoreFolderSyncEngine):
             with mailsync_session_scope() as db_session:
                 local_uids = common.all_uids(self.account_id, db_session,
                                              self.folder_name)
-            remote_uids = sorted(crispin_client.all_uids(), key=int)
+            remote_uids = UIDSet(crispin_client.all_uids())
             remote_uid_count = len(remote_uids)
-            with self.syncmanager_lock:
+            with self.commit_locks.folder(self.folder_id):
                 with mailsync_session_scope() as db_session:
                     self.remove_deleted_uids(db_session, local_uids,
                                              remote_uids)
-                    unknown_uids = set(remote_uids) - local_uids
+                    unknown_uids = remote_uids - local_uids
                     self.update_uid_counts(
                         db_session, remote_uid_count=remote_uid_count,
                         download_uid_count=len(unknown_uids))
@@ -104,8 +110,8 @@ class GmailFolderSyncEngine(CondstoreFolderSyncEngine):
                 inbox_uid_set = set(inbox_uids)
                 # Note that we have to be checking membership in a /set/ for
                 # performance.
-                ordered_uids_to_sync = [u for u in sorted(remote_uids) if u not
-                                        in inbox_uid_set] + sorted(inbox_uids)
+                ordered_uids_to_sync = [u for u in remote_uids if u not in
+                                        inbox_uid_set] + sorted(inbox_uids)
                 for uid in ordered_uids_to_sync:
                     if uid in remote_g_metadata:
                         metadata = GMetadata(remote_g_metadata[uid].msgid,
@@ -219,7 +225,8 @@ class GmailFolderSyncEngine(CondstoreFolderSyncEngine):
             if crispin_client.selected_folder_name != \
                     crispin_client.folder_names()['all']:
                 add_new_imapuids(crispin_client, remote_g_metadata,
-                                 self.syncmanager_lock, imapuid_only)
+                                 self.commit_locks.folder(self.folder_id),
+                                 imapuid_only)
 
         return full_download
 
@@ -250,9 +257,24 @@ class GmailFolderSyncEngine(CondstoreFolderSyncEngine):
         common.add_any_new_thread_labels(thread, new_uid, db_session)
         return new_uid
 
-    def download_and_commit_uids(self, crispin_client, folder_name, uids):
-        raw_messages = safe_download(crispin_client, uids)
-        with self.syncmanager_lock:
+    def commit_raw_messages(self, folder_name, uids, raw_messages,
+                            parsed_messages=None):
+        if not raw_messages:
+            return 0
+        with mailsync_session_scope() as db_session:
+            keys = message_lock_keys(self.namespace_id, db_session,
+                                     raw_messages)
+            # The ImapUids are created in `folder_name` (usually All Mail),
+            # so lock its UIDs like the other syncs of that folder do.
+            if folder_name == self.folder_name:
+                folder_id = self.folder_id
+            else:
+                folder_id = db_session.query(Folder.id).filter(
+                    Folder.account_id == self.account_id,
+                    Folder.name == folder_name).scalar()
+        if folder_id is not None:
+            keys.add(('folder', folder_id))
+        with self.commit_locks.hold(keys):
             # there is the possibility that another green thread has already
             # downloaded some message(s) from this batch... check within the
             # lock
@@ -263,7 +285,7 @@ class GmailFolderSyncEngine(CondstoreFolderSyncEngine):
                     return 0
                 new_imapuids = create_db_objects(
                     self.account_id, db_session, log, folder_name,
-                    raw_messages, self.create_message)
+                    raw_messages, self._message_creator(parsed_messages))
                 commit_uids(db_session, new_imapuids, self.provider_name)
         self.saved_uids.update(uids)
         return len(new_imapuids)
@@ -333,9 +355,37 @@ class GmailFolderSyncEngine(CondstoreFolderSyncEngine):
         to_download = self.__deduplicate_message_download(
             crispin_client, thread_g_metadata, thread_uids)
         log.debug(deduplicated_message_count=len(to_download))
-        for uids in chunk(to_download, crispin_client.CHUNK_SIZE):
-            self.download_and_commit_uids(
-                crispin_client, crispin_client.selected_folder_name, uids)
+        folder_name = crispin_client.selected_folder_name
+        if len(to_download) <= 1:
+            # Nothing to overlap.
+            if to_download:
+                self.download_and_commit_uids(crispin_client, folder_name,
+                                              to_download)
+            return len(to_download)
+
+        # Overlap fetching the rest of a long thread with committing what
+        # we've already downloaded.
+        sizes = crispin_client.sizes(to_download)
+        remaining = [(uid, None) for uid in to_download]
+
+        def next_batch():
+            batch = size_limited_batch(remaining[:DOWNLOAD_BATCH_MAX_UIDS],
+                                       sizes, DOWNLOAD_BATCH_MAX_BYTES)
+            del remaining[:len(batch)]
+            return batch
+
+        def fetch(batch):
+            return safe_download(crispin_client, [uid for uid, _ in batch])
+
+        def commit(batch, parsed):
+            self.commit_raw_messages(folder_name, [uid for uid, _ in batch],
+                                     *unzip_parsed(parsed))
+
+        pipeline = DownloadPipeline(next_batch, fetch, commit,
+                                    parse=parse_raw_messages)
+        pipeline.run()
+        log.debug('thread download pipeline finished',
+                  **pipeline.metrics_dict())
         return len(to_download)
 
 
@@ -360,8 +410,7 @@ def g_msgids(namespace_id, session, in_):
     return {g_msgid for g_msgid, in query}
 
 
-def add_new_imapuids(crispin_client, remote_g_metadata, syncmanager_lock,
-                     uids):
+def add_new_imapuids(crispin_client, remote_g_metadata, folder_lock, uids):
     """
     Add ImapUid entries only for (already-downloaded) messages.
 
@@ -372,7 +421,7 @@ def add_new_imapuids(crispin_client, remote_g_metadata, syncmanager_lock,
     """
     flags = crispin_client.flags(uids)
 
-    with syncmanager_lock:
+    with folder_lock:
         with mailsync_session_scope() as db_session:
             # Since we prioritize download for messages in certain threads, we
             # may already have ImapUid entries despite calling this method.
@@ -16,15 +16,20 @@ from inbox.contacts.process_mail import update_contacts_from_message
 from inbox.models import Message, Folder
 from inbox.models.backends.imap import ImapUid, ImapFolderInfo
 from inbox.models.util import reconcile_message
+from inbox.mailsync.backends.imap.locking import (CommitLocks,
+                                                  thread_lock_keys)
+from inbox.mailsync.backends.imap.uidset import UIDSet
 
 from inbox.log import get_logger
 log = get_logger()
 
 
 def all_uids(account_id, session, folder_name):
-    return {uid for uid, in session.query(ImapUid.msg_uid).join(Folder).filter(
+    """ The UIDs of the folder's saved messages, as a UIDSet. """
+    query = session.query(ImapUid.msg_uid).join(Folder).filter(
         ImapUid.account_id == account_id,
-        Folder.name == folder_name)}
+        Folder.name == folder_name).order_by(ImapUid.msg_uid)
+    return UIDSet(uid for uid, in query.yield_per(10000))
 
 
 def _folders_for_labels(g_labels, account, db_session):
@@ -129,9 +134,10 @@ def update_metadata(account_id, session, folder_name, folder_id, uids,
     """
     Update flags and labels (the only metadata that can change).
 
-    Make sure you're holding a db write lock on the account. (We don't try
-    to grab the lock in here in case the caller needs to put higher-level
-    functionality in the lock.)
+    Make sure you're holding the folder's commit lock (see
+    inbox.mailsync.backends.imap.locking). (We don't try to grab the lock in
+    here in case the caller needs to put higher-level functionality in the
+    lock.)
 
     """
     if not uids:
@@ -159,11 +165,19 @@ def update_metadata(account_id, session, folder_name, folder_id, uids,
         recompute_thread_labels(thread, session)
 
 
-def remove_deleted_uids(account_id, session, uids, folder_id):
-    """ Make sure you're holding a db write lock on the account. (We don't try
-        to grab the lock in here in case the caller needs to put higher-level
-        functionality in the lock.)
+def remove_deleted_uids(account_id, session, uids, folder_id,
+                        commit_locks=None):
+    """ Make sure you're holding the folder's commit lock (see
+        inbox.mailsync.backends.imap.locking). (We don't try to grab the lock
+        in here in case the caller needs to put higher-level functionality in
+        the lock.)
+
+        The affected messages and threads may be shared with other folders,
+        so the threads' locks are taken from `commit_locks` while updating
+        them.
     """
+    if commit_locks is None:
+        commit_locks = CommitLocks(account_id)
     if uids:
         deletes = session.query(ImapUid).filter(
             ImapUid.account_id == account_id,
@@ -176,26 +190,30 @@ def remove_deleted_uids(account_id, session, uids, folder_id):
             session.delete(uid)
         session.commit()
 
-        messages_to_delete = {m for m in affected_messages if not m.imapuids}
-
         # Because we need to update thread folders and tags, threads are
         # 'affected' even if we're not removing messages from them.
         affected_threads = {m.thread for m in affected_messages}
 
-        # Don't outright delete messages. Just mark them as 'deleted' and wait
-        # for the asynchronous dangling-message-collector to delete them.
-        for message in messages_to_delete:
-            message.mark_for_deletion()
-        session.commit()
+        with commit_locks.hold(thread_lock_keys(affected_threads)):
+            messages_to_delete = {m for m in affected_messages
+                                  if not m.imapuids}
 
-        for thread in affected_threads:
-            # Note that recompute_thread_labels uses all the ImapUids for the
-            # thread to figure out what the thread's tags should be, so at this
-            # point it's necessary (and sufficient) that all the ImapUid rows
-            # that should be deleted actually are deleted.
-            recompute_thread_labels(thread, session)
+            # Don't outright delete messages. Just mark them as 'deleted' and
+            # wait for the asynchronous dangling-message-collector to delete
+            # them.
+            for message in messages_to_delete:
+                message.mark_for_deletion()
+            session.commit()
 
-        session.commit()
+            for thread in affected_threads:
+                # Note that recompute_thread_labels uses all the ImapUids for
+                # the thread to figure out what the thread's tags should be,
+                # so at this point it's necessary (and sufficient) that all
+                # the ImapUid rows that should be deleted actually are
+                # deleted.
+                recompute_thread_labels(thread, session)
+
+            session.commit()
 
 
 def get_folder_info(account_id, session, folder_name):
@@ -232,7 +250,7 @@ def update_folder_info(account_id, session, folder_name, uidvalidity,
     return cached_folder_info
 
 
-def create_imap_message(db_session, log, account, folder, msg):
+def create_imap_message(db_session, log, account, folder, msg, parsed=None):
     """ IMAP-specific message creation logic.
 
     This is the one function in this file that gets to take an account
@@ -240,6 +258,9 @@ def create_imap_message(db_session, log, account, folder, msg):
     account to ImapUids for versioning to work, since it needs to look
     up the namespace.
 
+    `parsed` is the already-parsed message body, if any (see
+    Message.create_from_synced).
+
     Returns
     -------
     imapuid : inbox.models.tables.imap.ImapUid
@@ -249,7 +270,8 @@ def create_imap_message(db_session, log, account, folder, msg):
     new_msg = Message.create_from_synced(account=account, mid=msg.uid,
                                          folder_name=folder.name,
                                          received_date=msg.internaldate,
-                                         body_string=msg.body)
+                                         body_string=msg.body,
+                                         parsed=parsed)
 
     # Check to see if this is a copy of a message that was first created
     # by the Inbox API. If so, don't create a new object; just use the old one.
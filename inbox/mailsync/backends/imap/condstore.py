@@ -8,34 +8,24 @@ Generic IMAP backend with CONDSTORE support.
 No support for server-side threading, so we have to thread messages ourselves.
 
 """
-from gevent import sleep
 from inbox.crispin import retry_crispin
 from inbox.mailsync.backends.base import (save_folder_names, new_or_updated,
                                           mailsync_session_scope)
 from inbox.mailsync.backends.imap import common
 from inbox.mailsync.backends.imap.generic import (FolderSyncEngine,
                                                   uidvalidity_cb, UIDStack)
+from inbox.mailsync.backends.imap.uidset import UIDSet
 from inbox.log import get_logger
 log = get_logger()
 
 
 class CondstoreFolderSyncEngine(FolderSyncEngine):
-    def should_idle(self, crispin_client):
-        return self.folder_name == crispin_client.folder_names()['inbox']
-
     def poll_impl(self):
         with self.conn_pool.get() as crispin_client:
             download_stack = UIDStack()
             self.check_uid_changes(crispin_client, download_stack,
                                    async_download=False)
-            if self.should_idle(crispin_client):
-                idling = True
-                self.idle_wait(crispin_client)
-            else:
-                idling = False
-        # Close IMAP connection before sleeping
-        if not idling:
-            sleep(self.poll_frequency)
+        self.wait_for_changes()
 
     @retry_crispin
     def poll_for_changes(self, download_stack):
@@ -45,14 +35,7 @@ class CondstoreFolderSyncEngine(FolderSyncEngine):
             with self.conn_pool.get() as crispin_client:
                 self.check_uid_changes(crispin_client, download_stack,
                                        async_download=True)
-                if self.should_idle(crispin_client):
-                    idling = True
-                    self.idle_wait(crispin_client)
-                else:
-                    idling = False
-            # Close IMAP connection before sleeping
-            if not idling:
-                sleep(self.poll_frequency)
+            self.wait_for_changes()
 
     def check_uid_changes(self, crispin_client, download_stack,
                           async_download):
@@ -90,7 +73,7 @@ class CondstoreFolderSyncEngine(FolderSyncEngine):
         # Highestmodseq has changed, update accordingly.
         new_uidvalidity = crispin_client.selected_uidvalidity
         changed_uids = crispin_client.new_and_updated_uids(saved_highestmodseq)
-        remote_uids = crispin_client.all_uids()
+        remote_uids = UIDSet(crispin_client.all_uids())
         with mailsync_session_scope() as db_session:
             local_uids = common.all_uids(self.account_id, db_session,
                                          self.folder_name)
@@ -106,7 +89,7 @@ class CondstoreFolderSyncEngine(FolderSyncEngine):
                                         download_stack, async_download)
 
         with mailsync_session_scope() as db_session:
-            with self.syncmanager_lock:
+            with self.commit_locks.folder(self.folder_id):
                 self.remove_deleted_uids(db_session, local_uids, remote_uids)
             self.update_uid_counts(db_session,
                                    remote_uid_count=len(remote_uids))
@@ -121,11 +104,3 @@ class CondstoreFolderSyncEngine(FolderSyncEngine):
             download_stack.put(uid, None)
         if not async_download:
             self.download_uids(crispin_client, download_stack)
-
-    def idle_wait(self, crispin_client):
-        # Idle doesn't pick up flag changes, so we don't want to
-        # idle for very long, or we won't detect things like
-        # messages being marked as read.
-        idle_frequency = 30
-        log.info('idling', timeout=idle_frequency)
-        crispin_client.idle(idle_frequency)
@@ -11,9 +11,11 @@ The IMAP sync engine runs per-folder on each account. This allows behaviour
 like the Inbox to receive new mail via polling while we're still running the
 initial sync on a huge All Mail folder.
 
-Only one initial sync can be running per-account at a time, to avoid
-hammering the IMAP backend too hard (Gmail shards per-user, so parallelizing
-folder download won't actually increase our throughput anyway).
+Only a few initial syncs run per-account at a time (see
+ImapSyncMonitor.initial_sync_budget), to avoid hammering the IMAP backend too
+hard; running more than one mostly means that e.g. the Sent folder doesn't
+wait for the whole Inbox to be downloaded (Gmail shards per-user, so
+parallelizing folder download won't actually increase our throughput much).
 
 Any time we reconnect, we have to make sure the folder's uidvalidity hasn't
 changed, and if it has, we need to update the UIDs for any messages we've
@@ -66,6 +68,7 @@ from __future__ import division
 
 from collections import namedtuple
 from datetime import datetime
+from itertools import islice
 from gevent import Greenlet, kill, spawn, sleep
 from gevent.queue import LifoQueue
 from hashlib import sha256
@@ -77,6 +80,7 @@ from inbox.util.concurrency import retry_and_report_killed
 from inbox.util.debug import bind_context
 from inbox.util.itert import chunk
 from inbox.util.misc import or_none
+from inbox.util.message_parsing import get_parse_pool
 from inbox.util.threading import fetch_corresponding_thread, MAX_THREAD_LENGTH
 from inbox.basicauth import AuthError
 from inbox.log import get_logger
@@ -87,6 +91,9 @@ from inbox.models.backends.imap import (ImapFolderSyncStatus, ImapThread,
                                         ImapUid, ImapFolderInfo)
 from inbox.mailsync.exc import UidInvalid
 from inbox.mailsync.backends.imap import common
+from inbox.mailsync.backends.imap.locking import message_lock_keys
+from inbox.mailsync.backends.imap.pipeline import DownloadPipeline
+from inbox.mailsync.backends.imap.uidset import UIDSet
 from inbox.mailsync.backends.base import (create_db_objects,
                                           commit_uids, MailsyncDone,
                                           mailsync_session_scope,
@@ -96,6 +103,13 @@ from inbox.events.ical import import_attached_events
 
 GenericUIDMetadata = namedtuple('GenericUIDMetadata', 'throttled')
 
+# Upper bounds on how much we fetch and commit at once during initial sync. A
+# batch is cut off at whichever limit is hit first, based on the RFC822.SIZE
+# the server reports; a single message larger than the byte budget is still
+# downloaded on its own.
+DOWNLOAD_BATCH_MAX_UIDS = 50
+DOWNLOAD_BATCH_MAX_BYTES = 10 * 1024 * 1024
+
 
 def _pool(account_id):
     """Get a crispin pool, throwing an error if it's invalid."""
@@ -123,6 +137,24 @@ class UIDStack(object):
         # gevent. Can update with gevent version 1.0.2.
         return self._lifoqueue.queue[-1]
 
+    def peek_n(self, n, exclude=frozenset()):
+        """Up to `n` entries from the top of the stack (most recently put
+        first), without removing them. Entries in `exclude` are skipped."""
+        entries = (item for item in reversed(self._lifoqueue.queue)
+                   if item not in exclude)
+        return list(islice(entries, n))
+
+    def remove(self, objects):
+        """Remove the given entries. They're usually still at the top of the
+        stack, so try that first and only scan the whole stack for any that
+        have been buried by concurrent puts in the meantime."""
+        remaining = set(objects)
+        queue = self._lifoqueue.queue
+        while remaining and queue and queue[-1] in remaining:
+            remaining.discard(queue.pop())
+        if remaining:
+            self.discard(remaining)
+
     def put(self, uid, metadata):
         self._lifoqueue.put((uid, metadata))
 
@@ -142,18 +174,27 @@ class FolderSyncEngine(Greenlet):
     """Base class for a per-folder IMAP sync engine."""
 
     def __init__(self, account_id, folder_name, folder_id, email_address,
-                 provider_name, poll_frequency, syncmanager_lock,
-                 refresh_flags_max, retry_fail_classes):
+                 provider_name, poll_frequency, commit_locks,
+                 refresh_flags_max, retry_fail_classes, idle_manager=None):
         bind_context(self, 'foldersyncengine', account_id, folder_id)
         self.account_id = account_id
         self.folder_name = folder_name
         self.folder_id = folder_id
         self.poll_frequency = poll_frequency
-        self.syncmanager_lock = syncmanager_lock
+        self.commit_locks = commit_locks
         self.refresh_flags_max = refresh_flags_max
         self.retry_fail_classes = retry_fail_classes
+        # Shared by the account's folder sync engines to wait for changes to
+        # their folder (see inbox.mailsync.backends.imap.idle).
+        self.idle_manager = idle_manager
         self.state = None
         self.provider_name = provider_name
+        # The UIDs of the folder's saved messages, and the folder's status as
+        # of the last check for changes, so that polls can tell whether
+        # anything changed without listing the folder's UIDs or querying
+        # ImapUids (see check_uid_changes).
+        self.local_uids = None
+        self.last_status = None
 
         with mailsync_session_scope() as db_session:
             account = db_session.query(Account).get(self.account_id)
@@ -275,17 +316,18 @@ class FolderSyncEngine(Greenlet):
         change_poller = None
         try:
             assert crispin_client.selected_folder_name == self.folder_name
-            remote_uids = crispin_client.all_uids()
-            with self.syncmanager_lock:
+            remote_uids = UIDSet(crispin_client.all_uids())
+            with self.commit_locks.folder(self.folder_id):
                 with mailsync_session_scope() as db_session:
                     local_uids = common.all_uids(self.account_id, db_session,
                                                  self.folder_name)
                     self.remove_deleted_uids(db_session, local_uids,
                                              remote_uids)
+                self.local_uids = local_uids & remote_uids
 
-            new_uids = set(remote_uids) - local_uids
+            new_uids = remote_uids - local_uids
             download_stack = UIDStack()
-            for uid in sorted(new_uids):
+            for uid in new_uids:
                 download_stack.put(
                     uid, GenericUIDMetadata(self.throttled))
 
@@ -312,6 +354,17 @@ class FolderSyncEngine(Greenlet):
             download_stack = UIDStack()
             self.check_uid_changes(crispin_client, download_stack,
                                    async_download=False)
+        self.wait_for_changes()
+
+    def wait_for_changes(self):
+        """Wait until it's time to check the folder for changes again: until
+        a change is reported, if the folder is watched (see
+        inbox.mailsync.backends.imap.idle), or for `poll_frequency` seconds.
+        Don't hold on to a connection while waiting."""
+        if self.idle_manager is None:
+            sleep(self.poll_frequency)
+        else:
+            self.idle_manager.wait(self.folder_name, self.poll_frequency)
 
     def resync_uids_impl(self):
         # NOTE: first, let's check if the UIVDALIDITY change was spurious, if
@@ -368,6 +421,8 @@ class FolderSyncEngine(Greenlet):
                 db_session.delete(message)
             folder_info.uidvalidity = uidvalidity
             folder_info.highestmodseq = None
+            self.local_uids = None
+            self.last_status = None
 
     @retry_crispin
     def poll_for_changes(self, download_stack):
@@ -376,30 +431,71 @@ class FolderSyncEngine(Greenlet):
                 crispin_client.select_folder(self.folder_name, uidvalidity_cb)
                 self.check_uid_changes(crispin_client, download_stack,
                                        async_download=True)
-            sleep(self.poll_frequency)
+            self.wait_for_changes()
 
     def download_uids(self, crispin_client, download_stack):
-        while not download_stack.empty():
-            # Defer removing UID from queue until after it's committed to the
-            # DB' to avoid races with poll_for_changes().
-            uid, metadata = download_stack.peek()
-            self.download_and_commit_uids(crispin_client, self.folder_name,
-                                          [uid])
-            download_stack.get()
-            report_progress(self.account_id, self.folder_name, 1,
+        # Entries handed to the pipeline but not yet committed. We defer
+        # removing them from the stack until after they're committed to the
+        # DB to avoid races with poll_for_changes().
+        in_flight = set()
+
+        def next_batch():
+            batch = self._next_download_batch(crispin_client, download_stack,
+                                              exclude=in_flight)
+            in_flight.update(batch)
+            return batch
+
+        def fetch(batch):
+            return safe_download(crispin_client, [uid for uid, _ in batch])
+
+        def commit(batch, parsed):
+            self.commit_raw_messages(self.folder_name,
+                                     [uid for uid, _ in batch],
+                                     *unzip_parsed(parsed))
+            download_stack.remove(batch)
+            in_flight.difference_update(batch)
+            report_progress(self.account_id, self.folder_name, len(batch),
                             download_stack.qsize())
             self.heartbeat_status.publish()
-            if self.throttled and metadata is not None and metadata.throttled:
-                # Check to see if the account's throttled state has been
-                # modified. If so, immediately accelerate.
-                with mailsync_session_scope() as db_session:
-                    acc = db_session.query(Account).get(self.account_id)
-                    self.throttled = acc.throttled
-                if self.throttled:
-                    log.debug('throttled; sleeping')
-                    sleep(THROTTLE_WAIT)
+            self._throttle(batch)
 
-    def create_message(self, db_session, acct, folder, msg):
+        # poll_for_changes() may push new UIDs after the fetch stage has run
+        # dry, so keep going until the stack is really empty.
+        while not download_stack.empty():
+            pipeline = DownloadPipeline(next_batch, fetch, commit,
+                                        parse=parse_raw_messages)
+            pipeline.run()
+            log.info('download pipeline finished',
+                     **pipeline.metrics_dict())
+
+    def _throttle(self, batch):
+        if self.throttled and any(metadata is not None and
+                                  metadata.throttled
+                                  for _, metadata in batch):
+            # Check to see if the account's throttled state has been
+            # modified. If so, immediately accelerate.
+            with mailsync_session_scope() as db_session:
+                acc = db_session.query(Account).get(self.account_id)
+                self.throttled = acc.throttled
+            if self.throttled:
+                log.debug('throttled; sleeping')
+                sleep(THROTTLE_WAIT)
+
+    def _next_download_batch(self, crispin_client, download_stack,
+                             exclude=frozenset()):
+        """Entries from the top of `download_stack` to fetch and commit
+        together, bounded by DOWNLOAD_BATCH_MAX_UIDS and (using the server's
+        RFC822.SIZE) DOWNLOAD_BATCH_MAX_BYTES."""
+        if self.throttled:
+            # Throttled accounts are deliberately paced one message at a time.
+            return download_stack.peek_n(1, exclude)
+        candidates = download_stack.peek_n(DOWNLOAD_BATCH_MAX_UIDS, exclude)
+        if len(candidates) <= 1:
+            return candidates
+        sizes = crispin_client.sizes([uid for uid, _ in candidates])
+        return size_limited_batch(candidates, sizes, DOWNLOAD_BATCH_MAX_BYTES)
+
+    def create_message(self, db_session, acct, folder, msg, parsed=None):
         assert acct is not None and acct.namespace is not None
 
         # Check if we somehow already saved the imapuid (shouldn't happen, but
@@ -414,7 +510,7 @@ class FolderSyncEngine(Greenlet):
             return None
 
         new_uid = common.create_imap_message(db_session, log, acct, folder,
-                                             msg)
+                                             msg, parsed)
         new_uid = self.add_message_attrs(db_session, new_uid, msg)
 
         # We're calling import_attached_events here instead of some more
@@ -427,6 +523,15 @@ class FolderSyncEngine(Greenlet):
 
         return new_uid
 
+    def _message_creator(self, parsed_messages):
+        if not parsed_messages:
+            return self.create_message
+
+        def create_message(db_session, acct, folder, msg):
+            return self.create_message(db_session, acct, folder, msg,
+                                       parsed_messages.get(msg.uid))
+        return create_message
+
     def _count_thread_messages(self, thread_id, db_session):
         count, = db_session.query(func.count(Message.id)). \
                     filter(Message.thread_id == thread_id).one()
@@ -470,26 +575,44 @@ class FolderSyncEngine(Greenlet):
             3. Purge uids we have locally but not on the server. Ignore
                remote uids that aren't saved locally.
 
-        Make SURE to be holding `syncmanager_lock` when calling this function;
-        we do not grab it here to allow callers to lock higher level
+        Make SURE to be holding the folder's commit lock when calling this
+        function; we do not grab it here to allow callers to lock higher level
         functionality.  """
-        to_delete = set(local_uids) - set(remote_uids)
-        common.remove_deleted_uids(self.account_id, db_session, to_delete,
-                                   self.folder_id)
+        to_delete = UIDSet(local_uids) - remote_uids
+        common.remove_deleted_uids(self.account_id, db_session,
+                                   list(to_delete), self.folder_id,
+                                   self.commit_locks)
 
     def download_and_commit_uids(self, crispin_client, folder_name, uids):
         # Note that folder_name here might *NOT* be equal to self.folder_name,
         # because, for example, we download messages via the 'All Mail' folder
         # in Gmail.
         raw_messages = safe_download(crispin_client, uids)
+        return self.commit_raw_messages(folder_name, uids, raw_messages)
+
+    def commit_raw_messages(self, folder_name, uids, raw_messages,
+                            parsed_messages=None):
+        """Create and commit the messages downloaded for `uids`. Returns the
+        number of new ImapUids.
+
+        `parsed_messages` optionally maps UIDs to their already-parsed
+        message bodies; anything missing is parsed inline."""
         if not raw_messages:
             return 0
-        with self.syncmanager_lock:
+        with mailsync_session_scope() as db_session:
+            keys = message_lock_keys(self.namespace_id, db_session,
+                                     raw_messages)
+        keys.add(('folder', self.folder_id))
+        with self.commit_locks.hold(keys):
             with mailsync_session_scope() as db_session:
                 new_imapuids = create_db_objects(
                     self.account_id, db_session, log, folder_name,
-                    raw_messages, self.create_message)
+                    raw_messages, self._message_creator(parsed_messages))
                 commit_uids(db_session, new_imapuids, self.provider_name)
+                if self.local_uids is not None and \
+                        folder_name == self.folder_name:
+                    self.local_uids.update(uid.msg_uid for uid in
+                                           new_imapuids)
         return len(new_imapuids)
 
     def update_metadata(self, crispin_client, updated):
@@ -501,12 +624,24 @@ class FolderSyncEngine(Greenlet):
             # Messages can disappear in the meantime; we'll update them next
             # sync.
             uids = [uid for uid in uids if uid in new_flags]
-            with self.syncmanager_lock:
+            # Messages flagged \Deleted but not expunged yet are left out of
+            # UID listings (see CrispinClient.all_uids), but a folder whose
+            # status didn't change isn't listed (see new_uids_from_status),
+            # so remove them here.
+            deleted = [uid for uid in uids
+                       if '\\Deleted' in new_flags[uid].flags]
+            with self.commit_locks.folder(self.folder_id):
                 with mailsync_session_scope() as db_session:
                     common.update_metadata(self.account_id, db_session,
                                            self.folder_name, self.folder_id,
                                            uids, new_flags)
                     db_session.commit()
+                    if deleted:
+                        common.remove_deleted_uids(
+                            self.account_id, db_session, deleted,
+                            self.folder_id, self.commit_locks)
+                        if self.local_uids is not None:
+                            self.local_uids = self.local_uids - deleted
 
     def update_uid_counts(self, db_session, **kwargs):
         saved_status = db_session.query(ImapFolderSyncStatus).join(Folder). \
@@ -523,8 +658,37 @@ class FolderSyncEngine(Greenlet):
 
     def check_uid_changes(self, crispin_client, download_stack,
                           async_download):
-        remote_uids = set(crispin_client.all_uids())
-        with self.syncmanager_lock:
+        status = crispin_client.selected_status()
+        new_uids = None
+        if self.local_uids is not None:
+            new_uids = new_uids_from_status(crispin_client, self.last_status,
+                                            status)
+        if new_uids is None:
+            remote_uids = self._diff_uids(crispin_client, download_stack)
+        else:
+            # Nothing was expunged, so the remote UIDs are the ones we know
+            # about plus the new ones.
+            with self.commit_locks.folder(self.folder_id):
+                remote_uids = self.local_uids | new_uids
+                stack_uids = {uid for uid, _ in download_stack}
+                for uid in new_uids:
+                    if uid not in self.local_uids and uid not in stack_uids:
+                        download_stack.put(uid, None)
+        self.last_status = status
+        local_uids = UIDSet(self.local_uids)
+        if not async_download:
+            self.download_uids(crispin_client, download_stack)
+            with mailsync_session_scope() as db_session:
+                self.update_uid_counts(
+                    db_session,
+                    remote_uid_count=len(remote_uids),
+                    download_uid_count=download_stack.qsize())
+        to_refresh = (remote_uids & local_uids)[-self.refresh_flags_max:]
+        self.update_metadata(crispin_client, to_refresh)
+
+    def _diff_uids(self, crispin_client, download_stack):
+        remote_uids = UIDSet(crispin_client.all_uids())
+        with self.commit_locks.folder(self.folder_id):
             with mailsync_session_scope() as db_session:
                 local_uids = common.all_uids(self.account_id, db_session,
                                              self.folder_name)
@@ -534,20 +698,45 @@ class FolderSyncEngine(Greenlet):
                 # filter out messages that have disappeared on the remote side
                 download_stack.discard([item for item in download_stack if
                                         item[0] not in remote_uids])
-                for uid in sorted(remote_uids):
+                for uid in remote_uids:
                     if uid not in local_with_pending_uids:
                         download_stack.put(uid, None)
                 self.remove_deleted_uids(db_session, local_uids, remote_uids)
-        if not async_download:
-            self.download_uids(crispin_client, download_stack)
-            with mailsync_session_scope() as db_session:
-                self.update_uid_counts(
-                    db_session,
-                    remote_uid_count=len(remote_uids),
-                    download_uid_count=download_stack.qsize())
-        to_refresh = sorted(remote_uids &
-                            local_uids)[-self.refresh_flags_max:]
-        self.update_metadata(crispin_client, to_refresh)
+            self.local_uids = local_uids & remote_uids
+        return remote_uids
+
+
+def new_uids_from_status(crispin_client, last_status, status):
+    """
+    Use a folder's status (see CrispinClient.selected_status) to find its new
+    UIDs since `last_status` without listing all of its UIDs, if that's
+    possible: if neither UIDNEXT nor the message count changed, nothing was
+    added or expunged, and if only new messages came in, they are the ones
+    from the old UIDNEXT on.
+
+    Returns
+    -------
+    list
+        The new UIDs, or None if all the UIDs need to be diffed.
+
+    """
+    if last_status is None or \
+            status['UIDVALIDITY'] != last_status['UIDVALIDITY']:
+        return None
+    if status['UIDNEXT'] == last_status['UIDNEXT'] and \
+            status['MESSAGES'] == last_status['MESSAGES']:
+        log.debug('folder unchanged; skipping UID diff')
+        return []
+    if status['UIDNEXT'] > last_status['UIDNEXT'] and \
+            status['MESSAGES'] > last_status['MESSAGES']:
+        new_uids = crispin_client.uids_from(last_status['UIDNEXT'])
+        # Otherwise, some messages were also expunged (or more arrived in
+        # the meantime).
+        if last_status['MESSAGES'] + len(new_uids) == status['MESSAGES']:
+            log.debug('only new messages; skipping UID diff',
+                      new_uid_count=len(new_uids))
+            return new_uids
+    return None
 
 
 def uidvalidity_cb(account_id, folder_name, select_info):
@@ -581,6 +770,45 @@ def safe_download(crispin_client, uids):
     return raw_messages
 
 
+def size_limited_batch(entries, sizes, max_bytes):
+    """ Longest prefix of the (uid, metadata) `entries` whose total size, per
+    `sizes`, stays within `max_bytes`. Always contains at least one entry so
+    that oversized messages still make progress. UIDs missing from `sizes`
+    (e.g. expunged in the meantime) count as empty.
+    """
+    batch = []
+    total_bytes = 0
+    for entry in entries:
+        total_bytes += sizes.get(entry[0], 0)
+        if batch and total_bytes > max_bytes:
+            break
+        batch.append(entry)
+    return batch
+
+
+def parse_raw_messages(raw_messages):
+    """ Parse stage of the download pipeline: parse message bodies in the
+    parse worker pool, if one is configured. Returns (raw message, parsed
+    message or None) pairs.
+    """
+    parse_pool = get_parse_pool()
+    if parse_pool is None:
+        return [(msg, None) for msg in raw_messages]
+    parsed_messages = parse_pool.map([(msg.body, msg.internaldate)
+                                      for msg in raw_messages])
+    return zip(raw_messages, parsed_messages)
+
+
+def unzip_parsed(parsed):
+    """ Split the output of parse_raw_messages() into the raw messages and a
+    dict of the parsed ones by UID, as taken by commit_raw_messages().
+    """
+    raw_messages = [msg for msg, _ in parsed]
+    parsed_messages = {msg.uid: parsed_message for msg, parsed_message in
+                       parsed if parsed_message is not None}
+    return raw_messages, parsed_messages
+
+
 def report_progress(account_id, folder_name, downloaded_uid_count,
                     num_remaining_messages):
     """ Inform listeners of sync progress. """
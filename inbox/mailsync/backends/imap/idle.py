@@ -0,0 +1,228 @@
+"""
+Waiting for changes to an account's folders with IMAP IDLE and NOTIFY.
+
+Folder sync engines check their folder for changes every `poll_frequency`
+seconds. To hear about changes sooner, and check less often, an account's
+IdleManager watches its folders on a few connections of their own (see
+inbox.crispin.idle_connection_pool), and wakes a folder's engine as soon as
+the server reports a change to the folder:
+
+* if the server supports NOTIFY (RFC 5465), a single connection watches all
+  of the folders, the server sending a STATUS response when one of them
+  changes,
+* otherwise each connection IDLEs (RFC 2177) on a folder of its own, folders
+  being watched in the order they were added (i.e. by priority, see
+  ImapSyncMonitor.prioritize_folders) until the connections run out.
+
+Both report new and expunged messages as well as flag changes (with STATUS
+responses for NOTIFY, and FETCH responses for the folder selected for IDLE).
+When nothing is reported, engines of watched folders still check every
+IDLE_POLL_FREQUENCY seconds (or the provider's "idle_poll_frequency"), in
+case a change went unreported. Engines of folders that aren't watched check
+every `poll_frequency` seconds as usual.
+
+"""
+import imaplib
+from contextlib import closing
+
+from gevent.event import Event
+from gevent.pool import Group
+from imapclient.imap_utf7 import decode as decode_utf7
+
+from inbox.config import config
+from inbox.crispin import idle_connection_pool, retry_crispin
+from inbox.log import get_logger
+log = get_logger()
+
+# Maximum number of connections per account for watching folders. Providers
+# can set their own limit with "max_idle_connections" in their provider info
+# (0 turns watching off).
+MAX_IDLE_CONNECTIONS = config.get('IMAP_MAX_IDLE_CONNECTIONS', 1)
+
+# Seconds between checks of a watched folder when no change was reported.
+# Providers can set their own with "idle_poll_frequency" in their provider
+# info.
+IDLE_POLL_FREQUENCY = config.get('IMAP_IDLE_POLL_FREQUENCY', 600)
+
+# Servers may drop connections that have been idling for 30 minutes (see RFC
+# 2177), so restart IDLE more often than that.
+IDLE_TIMEOUT = 20 * 60
+
+# Seconds between checks of whether a connection should watch other folders,
+# while idling.
+IDLE_CHECK_INTERVAL = 10
+
+
+class IdleManager(object):
+    """
+    Watches an account's folders for changes on up to `max_connections`
+    connections, for the account's folder sync engines to wait on (see
+    wait).
+
+    Folders are watched once they're added with add_folders and the manager
+    is started.
+
+    """
+    def __init__(self, account_id, max_connections=MAX_IDLE_CONNECTIONS,
+                 idle_poll_frequency=IDLE_POLL_FREQUENCY):
+        self.account_id = account_id
+        self.max_connections = max_connections
+        self.idle_poll_frequency = idle_poll_frequency
+        # The folders to watch, by priority.
+        self.folders = []
+        # Whether the server supports NOTIFY, once we know.
+        self.supports_notify = None
+        self.wakeups = 0
+        self.watchers = Group()
+        self.conn_pool = None
+        self._started = False
+        # folder name -> Event set when a change to the folder is reported
+        self._changed = {}
+        # watcher number -> [greenlet, folders it watches]
+        self._watchers = {}
+
+    @property
+    def watched(self):
+        return {name for _, folders in self._watchers.itervalues()
+                for name in folders}
+
+    def start(self):
+        self._started = True
+        self._start_watchers()
+
+    def stop(self):
+        self._started = False
+        self.watchers.kill()
+
+    def add_folders(self, folder_names):
+        """ Watch `folder_names` too, after the folders added before. Also
+        restarts watchers that gave up. """
+        for name in folder_names:
+            if name not in self._changed:
+                self.folders.append(name)
+                self._changed[name] = Event()
+        self._start_watchers()
+
+    def wait(self, folder_name, poll_frequency):
+        """
+        Wait for a change to the folder to be reported, for up to
+        `idle_poll_frequency` seconds if it's watched, or `poll_frequency`
+        seconds otherwise. Returns whether a change was reported.
+
+        """
+        changed = self._changed.setdefault(folder_name, Event())
+        timeout = self.idle_poll_frequency if folder_name in self.watched \
+            else poll_frequency
+        reported = changed.wait(timeout)
+        changed.clear()
+        return reported
+
+    def assignment(self, number):
+        """ The folders the `number`th watcher should watch. """
+        if self.supports_notify:
+            return list(self.folders) if number == 0 else []
+        return self.folders[number:number + 1]
+
+    def metrics_dict(self):
+        return dict(watched_folders=len(self.watched),
+                    idle_wakeups=self.wakeups,
+                    supports_notify=self.supports_notify)
+
+    def _start_watchers(self):
+        if not self._started:
+            return
+        # Until the first watcher finds out whether the server supports
+        # NOTIFY, we don't know how many we need.
+        needed = 1 if self.supports_notify is not False else \
+            len(self.folders)
+        for number in range(min(needed, self.max_connections)):
+            if number not in self._watchers and self.assignment(number):
+                self._watchers[number] = [
+                    self.watchers.spawn(self._watch, number), []]
+
+    def _watch(self, number):
+        try:
+            self._watch_folders(number)
+        except Exception:
+            log.error('Error watching folders', account_id=self.account_id,
+                      exc_info=True)
+        finally:
+            _, folders = self._watchers.pop(number)
+            # Don't leave engines waiting for idle_poll_frequency.
+            self._wake(set(folders) - self.watched)
+
+    @retry_crispin
+    def _watch_folders(self, number):
+        if self.conn_pool is None:
+            self.conn_pool = idle_connection_pool(
+                self.account_id, pool_size=self.max_connections)
+        with self.conn_pool.get() as crispin_client:
+            # (We may have missed changes while reconnecting.)
+            self._watchers[number][1] = []
+            if self.supports_notify is None:
+                self.supports_notify = crispin_client.supports_notify()
+                self._start_watchers()
+            while True:
+                folders = self.assignment(number)
+                if not folders:
+                    return
+                self._idle(crispin_client, number, folders)
+
+    def _idle(self, crispin_client, number, folders):
+        """ Watch `folders` until the watcher should watch other folders. """
+        if self.supports_notify:
+            try:
+                crispin_client.notify(folders)
+            except imaplib.IMAP4.error:
+                log.warning('NOTIFY failed, falling back to IDLE',
+                            account_id=self.account_id, exc_info=True)
+                self.supports_notify = False
+                self._start_watchers()
+                return
+            selected = None
+        else:
+            crispin_client.select_folder(folders[0], lambda *args: True)
+            selected = folders[0]
+        new_folders = set(folders) - set(self._watchers[number][1])
+        self._watchers[number][1] = folders
+        # Catch up on changes made before we were watching.
+        self._wake(new_folders)
+
+        while self.assignment(number) == folders:
+            self._wake(changed_folders(crispin_client.pending_responses(),
+                                       selected))
+            with closing(crispin_client.idle_responses(
+                    IDLE_TIMEOUT, IDLE_CHECK_INTERVAL)) as idling:
+                for responses in idling:
+                    self._wake(changed_folders(responses, selected))
+                    if self.assignment(number) != folders:
+                        break
+
+    def _wake(self, folder_names):
+        for name in folder_names:
+            if name in self._changed:
+                self.wakeups += 1
+                self._changed[name].set()
+
+
+def changed_folders(responses, selected_folder):
+    """
+    The folders that untagged `responses` (as parsed by IMAPClient) report
+    changes to: EXISTS, EXPUNGE and FETCH responses are about the selected
+    folder, and STATUS responses (see RFC 5465) name their folder.
+
+    """
+    folders = set()
+    for response in responses:
+        if len(response) < 2:
+            continue
+        if response[0] == 'STATUS':
+            name = response[1]
+            if isinstance(name, (int, long)):
+                # IMAPClient parses numeric folder names as numbers.
+                name = str(name)
+            folders.add(decode_utf7(name))
+        elif response[1] in ('EXISTS', 'EXPUNGE', 'FETCH') and \
+                selected_folder is not None:
+            folders.add(selected_folder)
+    return folders
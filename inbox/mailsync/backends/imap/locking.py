@@ -0,0 +1,180 @@
+"""
+Locks for the database writes of an account's folder sync engines.
+
+An account's folder sync engines used to share a single lock around all of
+their database writes, which serializes them once several folders sync at
+once. Writes only conflict when they touch the same rows though, so instead
+engines lock what they touch:
+
+* a folder's UID bookkeeping (diffing local against remote UIDs, deleting
+  ImapUids and updating their flags) takes the lock of the folder,
+* creating messages takes a lock on each thread the messages may end up in
+  and on each contact they may create, so that two folders don't both create
+  the same thread or contact (or, on Gmail, the same message). See
+  message_lock_keys.
+* deleting ImapUids also updates their messages and threads, which may be
+  shared with other folders, so it takes the threads' locks too, while
+  holding the folder's. See thread_lock_keys.
+
+Locks are always acquired in sorted order, so engines can't deadlock. (Thread
+keys all sort after folder keys, so taking them while holding a folder's lock
+keeps to that order.)
+
+"""
+import time
+from contextlib import contextmanager
+from email.header import decode_header, make_header
+from email.parser import HeaderParser
+from email.utils import getaddresses
+
+from gevent.coros import BoundedSemaphore
+
+from inbox.models import Contact
+from inbox.util.addr import canonicalize_address as canonicalize
+from inbox.util.misc import cleanup_subject
+from inbox.log import get_logger
+log = get_logger()
+
+# Log waits for a lock that take longer than this many seconds.
+SLOW_WAIT_THRESHOLD = 1
+
+ADDRESS_HEADERS = ('from', 'sender', 'reply-to', 'to', 'cc', 'bcc')
+
+
+class CommitLocks(object):
+    """
+    Locks on arbitrary keys, created when first needed and dropped when no
+    longer held or waited for, with contention statistics: the number of
+    acquisitions, how many of them had to wait, and the total time spent
+    waiting.
+
+    """
+    def __init__(self, account_id=None):
+        self.account_id = account_id
+        # key -> [semaphore, number of holders and waiters]
+        self._locks = {}
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_time = 0.0
+
+    def folder(self, folder_id):
+        """ Lock a folder's UIDs. """
+        return self.hold([('folder', folder_id)])
+
+    @contextmanager
+    def hold(self, keys):
+        keys = sorted(set(keys))
+        referenced = []
+        acquired = []
+        try:
+            for key in keys:
+                entry = self._locks.setdefault(key, [BoundedSemaphore(1), 0])
+                entry[1] += 1
+                referenced.append(key)
+                self._acquire(key, entry[0])
+                acquired.append(key)
+            yield
+        finally:
+            for key in reversed(acquired):
+                self._locks[key][0].release()
+            for key in referenced:
+                entry = self._locks[key]
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+    def _acquire(self, key, lock):
+        self.acquisitions += 1
+        if lock.acquire(blocking=False):
+            return
+        self.contended += 1
+        start = time.time()
+        lock.acquire()
+        wait_time = time.time() - start
+        self.wait_time += wait_time
+        if wait_time > SLOW_WAIT_THRESHOLD:
+            log.info('slow commit lock wait', account_id=self.account_id,
+                     lock=key[0], wait_time=wait_time)
+
+    def metrics_dict(self):
+        return dict(lock_acquisitions=self.acquisitions,
+                    lock_contended=self.contended,
+                    lock_wait_time=self.wait_time)
+
+
+def message_lock_keys(namespace_id, db_session, raw_messages):
+    """
+    The keys to lock while creating messages for `raw_messages`:
+
+    * for Gmail messages, their thread id,
+    * otherwise, the keys the messages may be threaded by (see
+      inbox.util.threading): their cleaned-up subject and the Message-IDs
+      they have or refer to, and
+    * the addresses of the messages' participants that don't have a contact
+      yet.
+
+    """
+    keys = set()
+    addresses = set()
+    parser = HeaderParser()
+    for msg in raw_messages:
+        headers = parser.parsestr(msg.body, headersonly=True)
+        if msg.g_thrid is not None:
+            keys.add(('thread', msg.g_thrid))
+        else:
+            keys.add(('subject', cleanup_subject(_decode(
+                headers.get('subject')))))
+            for header in ('message-id', 'in-reply-to', 'references'):
+                for message_id in (headers.get(header) or '').split():
+                    keys.add(('message_id', _text(message_id)))
+        for name, address in getaddresses(
+                [value for header in ADDRESS_HEADERS
+                 for value in headers.get_all(header, [])]):
+            if address:
+                addresses.add(_text(canonicalize(address)))
+
+    if addresses:
+        existing = {address for address, in db_session.query(
+            Contact._canonicalized_address).filter(
+                Contact.namespace_id == namespace_id,
+                Contact._canonicalized_address.in_(addresses))}
+        keys.update(('contact', address) for address in
+                    addresses - existing)
+    return keys
+
+
+def thread_lock_keys(threads):
+    """
+    The keys that message_lock_keys gives messages that may be added to
+    `threads`: for Gmail threads, their thread id, and otherwise the
+    cleaned-up subjects and Message-IDs of their messages.
+
+    """
+    keys = set()
+    for thread in threads:
+        g_thrid = getattr(thread, 'g_thrid', None)
+        if g_thrid is not None:
+            keys.add(('thread', g_thrid))
+            continue
+        for message in thread.messages:
+            keys.add(('subject', cleanup_subject(_text(message.subject))))
+            if message.message_id_header:
+                keys.add(('message_id', _text(message.message_id_header)))
+    return keys
+
+
+# Keys of the same kind must be comparable for sorting, which unicode and
+# non-ASCII byte strings aren't, so make all text keys unicode.
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _decode(header):
+    if header is None:
+        return None
+    try:
+        return unicode(make_header(decode_header(header)))
+    except (UnicodeError, LookupError, ValueError):
+        return _text(header)
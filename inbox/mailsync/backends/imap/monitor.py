@@ -1,10 +1,15 @@
+import time
+from datetime import datetime
+
 from gevent import sleep
 from gevent.pool import Group
-from gevent.coros import BoundedSemaphore
+from sqlalchemy import func, tuple_
 from sqlalchemy.orm.exc import NoResultFound
+from inbox.config import config
 from inbox.log import get_logger
-from inbox.crispin import retry_crispin
-from inbox.models import Folder
+from inbox.crispin import retry_crispin, CONNECTION_POOL_SIZE
+from inbox.models import Folder, Message
+from inbox.models.backends.imap import ImapUid
 from inbox.mailsync.backends.base import BaseMailSyncMonitor
 from inbox.mailsync.backends.base import (save_folder_names,
                                           MailsyncError,
@@ -12,9 +17,29 @@ from inbox.mailsync.backends.base import (save_folder_names,
                                           thread_polling, thread_finished)
 from inbox.mailsync.backends.imap.generic import _pool, FolderSyncEngine
 from inbox.mailsync.backends.imap.condstore import CondstoreFolderSyncEngine
+from inbox.mailsync.backends.imap.idle import (IdleManager,
+                                               MAX_IDLE_CONNECTIONS,
+                                               IDLE_POLL_FREQUENCY)
+from inbox.mailsync.backends.imap.locking import CommitLocks
 from inbox.mailsync.gc import DeleteHandler
 log = get_logger()
 
+# Maximum number of folders of an account to run initial sync for at once.
+# Providers can set a lower (or higher) limit with
+# "max_concurrent_initial_syncs" in their provider info. Either way, each
+# initial sync takes two connections of the account's pool (one to download
+# messages, one for its change poller), and one connection is left for
+# polling folders, so with the default pool of 3 connections initial syncs
+# run one at a time.
+MAX_CONCURRENT_INITIAL_SYNCS = config.get('IMAP_MAX_CONCURRENT_INITIAL_SYNCS',
+                                          2)
+
+# The order in which to start syncing folders, by role. Folders without a
+# role come after 'all', and within a role, folders with the most recent
+# mail come first.
+FOLDER_ROLE_PRIORITY = ('inbox', 'sent', 'drafts', 'important', 'starred',
+                        'archive', 'all', None, 'spam', 'trash')
+
 
 class ImapSyncMonitor(BaseMailSyncMonitor):
     """
@@ -33,13 +58,24 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
         the maximum number of UIDs for which we'll check flags
         periodically.
 
+    Folders are started in order of priority (see FOLDER_ROLE_PRIORITY), and
+    up to `initial_sync_budget` of them run their initial sync at once. The
+    seconds each folder took to get to polling are recorded in
+    `time_to_first_poll`.
+
+    Folder sync engines wait for changes to their folder with the account's
+    IdleManager, which watches up to the provider's "max_idle_connections"
+    folders (all of them, if the server supports NOTIFY), in the same order.
+
     """
     def __init__(self, account,
                  heartbeat=1, refresh_frequency=30, poll_frequency=30,
                  retry_fail_classes=[], refresh_flags_max=2000):
         self.refresh_frequency = refresh_frequency
         self.poll_frequency = poll_frequency
-        self.syncmanager_lock = BoundedSemaphore(1)
+        # Shared by the account's folder sync engines to lock what they write
+        # to (see inbox.mailsync.backends.imap.locking).
+        self.commit_locks = CommitLocks(account.id)
         self.refresh_flags_max = refresh_flags_max
 
         provider_supports_condstore = account.provider_info.get('condstore',
@@ -52,6 +88,17 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
             self.sync_engine_class = FolderSyncEngine
 
         self.folder_monitors = Group()
+        self.initial_sync_budget = max(1, min(
+            account.provider_info.get('max_concurrent_initial_syncs',
+                                      MAX_CONCURRENT_INITIAL_SYNCS),
+            (CONNECTION_POOL_SIZE - 1) // 2))
+        self.time_to_first_poll = {}
+        self.idle_manager = IdleManager(
+            account.id,
+            account.provider_info.get('max_idle_connections',
+                                      MAX_IDLE_CONNECTIONS),
+            account.provider_info.get('idle_poll_frequency',
+                                      IDLE_POLL_FREQUENCY))
 
         BaseMailSyncMonitor.__init__(self, account, heartbeat,
                                      retry_fail_classes)
@@ -82,39 +129,106 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
                                         .format(folder_name, self.account_id))
             return sync_folder_names_ids
 
+    def prioritize_folders(self, folder_names_ids):
+        """Sort (folder_name, folder_id) tuples in the order to sync them:
+        by role, then by the date of their newest synced message."""
+        folder_ids = [id_ for _, id_ in folder_names_ids]
+        if not folder_ids:
+            return []
+        with mailsync_session_scope() as db_session:
+            roles = dict(db_session.query(Folder.id, Folder.canonical_name).
+                         filter(Folder.id.in_(folder_ids)))
+            # The highest UID in a folder is (nearly always) its newest
+            # message.
+            newest_uids = db_session.query(ImapUid.folder_id,
+                                           func.max(ImapUid.msg_uid)). \
+                filter(ImapUid.account_id == self.account_id,
+                       ImapUid.folder_id.in_(folder_ids)). \
+                group_by(ImapUid.folder_id).all()
+            newest = {}
+            if newest_uids:
+                newest = dict(db_session.query(ImapUid.folder_id,
+                                               Message.received_date).
+                              join(Message).
+                              filter(ImapUid.account_id == self.account_id,
+                                     tuple_(ImapUid.folder_id,
+                                            ImapUid.msg_uid).
+                                     in_([tuple(row) for row in
+                                          newest_uids])))
+
+        def role_priority(folder):
+            role = roles.get(folder[1])
+            if role not in FOLDER_ROLE_PRIORITY:
+                role = None
+            return FOLDER_ROLE_PRIORITY.index(role)
+
+        def recency(folder):
+            # Folders with no synced messages go after those with some.
+            received_date = newest.get(folder[1])
+            return (received_date is not None,
+                    received_date or datetime.min)
+        # (Python's sort is stable, so this keeps recency within a role.)
+        by_recency = sorted(folder_names_ids, key=recency, reverse=True)
+        return sorted(by_recency, key=role_priority)
+
     def start_new_folder_sync_engines(self, folders=set()):
-        new_folders = [f for f in self.prepare_sync() if f not in folders]
-        for folder_name, folder_id in new_folders:
-            log.info('Folder sync engine started',
-                     account_id=self.account_id,
-                     folder_id=folder_id,
-                     folder_name=folder_name)
-            thread = self.sync_engine_class(self.account_id,
-                                            folder_name,
-                                            folder_id,
-                                            self.email_address,
-                                            self.provider_name,
-                                            self.poll_frequency,
-                                            self.syncmanager_lock,
-                                            self.refresh_flags_max,
-                                            self.retry_fail_classes)
-            self.folder_monitors.start(thread)
-            while not thread_polling(thread) and \
-                    not thread_finished(thread) and \
-                    not thread.ready():
+        new_folders = self.prioritize_folders(
+            [f for f in self.prepare_sync() if f not in folders])
+        self.idle_manager.add_folders(
+            [folder_name for folder_name, _ in new_folders])
+        # Folder sync engines that haven't reached polling yet, mapped to
+        # their folder and start time.
+        starting = {}
+        while new_folders or starting:
+            for thread, (folder, start_time) in starting.items():
+                folder_name, folder_id = folder
+                # allow individual folder sync monitors to shut themselves
+                # down after completing the initial sync
+                if thread_finished(thread) or thread.ready():
+                    log.info('Folder sync engine finished/killed',
+                             account_id=self.account_id,
+                             folder_id=folder_id,
+                             folder_name=folder_name)
+                    # note: thread is automatically removed from
+                    # self.folder_monitors
+                    del starting[thread]
+                elif thread_polling(thread):
+                    self.time_to_first_poll[folder_name] = \
+                        time.time() - start_time
+                    log.info('Folder sync engine polling',
+                             account_id=self.account_id,
+                             folder_id=folder_id,
+                             folder_name=folder_name,
+                             time_to_first_poll=self.time_to_first_poll[
+                                 folder_name])
+                    folders.add(folder)
+                    del starting[thread]
+
+            while new_folders and len(starting) < self.initial_sync_budget:
+                folder = new_folders.pop(0)
+                starting[self.start_folder_sync_engine(*folder)] = \
+                    (folder, time.time())
+
+            if starting:
                 sleep(self.heartbeat)
 
-            # allow individual folder sync monitors to shut themselves down
-            # after completing the initial sync
-            if thread_finished(thread) or thread.ready():
-                log.info('Folder sync engine finished/killed',
-                         account_id=self.account_id,
-                         folder_id=folder_id,
-                         folder_name=folder_name)
-                # note: thread is automatically removed from
-                # self.folder_monitors
-            else:
-                folders.add((folder_name, folder_id))
+    def start_folder_sync_engine(self, folder_name, folder_id):
+        log.info('Folder sync engine started',
+                 account_id=self.account_id,
+                 folder_id=folder_id,
+                 folder_name=folder_name)
+        thread = self.sync_engine_class(self.account_id,
+                                        folder_name,
+                                        folder_id,
+                                        self.email_address,
+                                        self.provider_name,
+                                        self.poll_frequency,
+                                        self.commit_locks,
+                                        self.refresh_flags_max,
+                                        self.retry_fail_classes,
+                                        self.idle_manager)
+        self.folder_monitors.start(thread)
+        return thread
 
     def start_delete_handler(self):
         self.delete_handler = DeleteHandler(account_id=self.account_id,
@@ -124,8 +238,17 @@ class ImapSyncMonitor(BaseMailSyncMonitor):
 
     def sync(self):
         self.start_delete_handler()
+        self.idle_manager.start()
         folders = set()
         self.start_new_folder_sync_engines(folders)
         while True:
             sleep(self.refresh_frequency)
             self.start_new_folder_sync_engines(folders)
+            log.info('commit lock contention', account_id=self.account_id,
+                     **self.commit_locks.metrics_dict())
+            log.info('folder watching', account_id=self.account_id,
+                     **self.idle_manager.metrics_dict())
+
+    def _cleanup(self):
+        self.idle_manager.stop()
+        BaseMailSyncMonitor._cleanup(self)
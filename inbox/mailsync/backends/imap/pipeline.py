@@ -0,0 +1,165 @@
+"""
+Staged message download pipeline for IMAP sync.
+
+Downloading a message involves an IMAP FETCH, parsing the MIME structure and
+committing the result to the database. Doing those strictly in sequence leaves
+the IMAP connection idle while we parse and write, and the database idle while
+we wait on the network. Instead each step runs in its own greenlet, connected
+by bounded queues:
+
+    fetch --> [queue] --> parse --> [queue] --> commit
+
+The bounded queues provide backpressure: if committing falls behind, the
+fetcher blocks rather than buffering an unbounded number of raw messages in
+memory.
+
+Batches are committed in the order they were fetched.
+
+"""
+import time
+
+from gevent import Greenlet, joinall, killall
+from gevent.queue import Queue
+
+# How many batches may be buffered between two consecutive stages.
+DEFAULT_QUEUE_SIZE = 2
+
+_DONE = object()
+
+
+class StageMetrics(object):
+    """
+    Counters for one pipeline stage.
+
+    `busy` is the time spent doing work, `starved` the time spent waiting for
+    the previous stage and `blocked` the time spent waiting for the next stage
+    to accept output (i.e. backpressure). All times are in seconds.
+
+    """
+    def __init__(self, name):
+        self.name = name
+        self.batches = 0
+        self.messages = 0
+        self.busy = 0.
+        self.starved = 0.
+        self.blocked = 0.
+
+    @property
+    def throughput(self):
+        """Messages processed per second of busy time."""
+        if not self.busy:
+            return None
+        return self.messages / self.busy
+
+    def as_dict(self):
+        return dict(batches=self.batches, messages=self.messages,
+                    busy=round(self.busy, 3), starved=round(self.starved, 3),
+                    blocked=round(self.blocked, 3),
+                    throughput=_round(self.throughput))
+
+
+def _round(value, ndigits=1):
+    return None if value is None else round(value, ndigits)
+
+
+class DownloadPipeline(object):
+    """
+    Run the fetch, parse and commit stages for a stream of batches.
+
+    Parameters
+    ----------
+    next_batch : callable
+        next_batch() -> the next batch to download, or an empty batch once
+        there's nothing left. Called from the fetch stage.
+    fetch : callable
+        fetch(batch) -> list of raw messages.
+    commit : callable
+        commit(batch, parsed) -> commits `parsed` (the output of `parse`).
+    parse : callable, optional
+        parse(raw_messages) -> whatever `commit` expects. By default the raw
+        messages are passed through as-is.
+    queue_size : int
+        Maximum number of batches buffered between stages.
+
+    """
+    def __init__(self, next_batch, fetch, commit, parse=None,
+                 queue_size=DEFAULT_QUEUE_SIZE):
+        self.next_batch = next_batch
+        self.fetch = fetch
+        self.commit = commit
+        self.parse = parse or (lambda raw_messages: raw_messages)
+        self.queue_size = queue_size
+        self.metrics = {name: StageMetrics(name) for name in
+                        ('fetch', 'parse', 'commit')}
+
+    def run(self):
+        """Run until `next_batch` is exhausted and everything fetched has been
+        committed. Re-raises the first exception from any stage, after
+        killing the others."""
+        fetched = Queue(self.queue_size)
+        parsed = Queue(self.queue_size)
+        stages = [Greenlet(self._fetch_stage, fetched),
+                  Greenlet(self._parse_stage, fetched, parsed),
+                  Greenlet(self._commit_stage, parsed)]
+        for stage in stages:
+            stage.start()
+        try:
+            joinall(stages, raise_error=True)
+        finally:
+            killall(stages)
+
+    def metrics_dict(self):
+        return {name: metrics.as_dict() for name, metrics in
+                self.metrics.iteritems()}
+
+    def _fetch_stage(self, out):
+        metrics = self.metrics['fetch']
+        while True:
+            start = time.time()
+            batch = self.next_batch()
+            if not batch:
+                break
+            raw_messages = self.fetch(batch)
+            self._record(metrics, start, raw_messages)
+            self._put(out, (batch, raw_messages), metrics)
+        self._put(out, _DONE, metrics)
+
+    def _parse_stage(self, in_, out):
+        metrics = self.metrics['parse']
+        while True:
+            item = self._get(in_, metrics)
+            if item is _DONE:
+                break
+            batch, raw_messages = item
+            start = time.time()
+            parsed = self.parse(raw_messages)
+            self._record(metrics, start, raw_messages)
+            self._put(out, (batch, parsed), metrics)
+        self._put(out, _DONE, metrics)
+
+    def _commit_stage(self, in_):
+        metrics = self.metrics['commit']
+        while True:
+            item = self._get(in_, metrics)
+            if item is _DONE:
+                break
+            batch, parsed = item
+            start = time.time()
+            self.commit(batch, parsed)
+            self._record(metrics, start, parsed)
+
+    def _record(self, metrics, start, messages):
+        metrics.busy += time.time() - start
+        metrics.batches += 1
+        metrics.messages += len(messages or ())
+
+    def _put(self, queue, item, metrics):
+        start = time.time()
+        queue.put(item)
+        metrics.blocked += time.time() - start
+
+    def _get(self, queue, metrics):
+        start = time.time()
+        item = queue.get()
+        metrics.starved += time.time() - start
+        return item
@@ -0,0 +1,202 @@
+"""
+Compact sets of IMAP UIDs.
+
+Syncing a folder means comparing the UIDs on the server with the UIDs we've
+saved, which for a large folder (think a Gmail All Mail with a million
+messages) are big sets: a Python set of longs takes ~70 bytes per UID. UIDs
+are unsigned 32-bit integers (RFC 3501), so UIDSet keeps them in a sorted
+array of those instead, at 4 bytes per UID.
+
+Set operations between UIDSets merge the two arrays. Folders' UIDs mostly
+come in long runs that the two sides have in common, which the merge skips
+over a chunk at a time, comparing and copying whole slices of the arrays;
+where they differ it jumps ahead with binary search.
+
+"""
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from itertools import islice, izip
+
+# The array type code for unsigned 32-bit integers.
+TYPECODE = 'I'
+
+# Number of UIDs the merge of two UIDSets compares at once, to skip over
+# what they have in common.
+RUN_LENGTH = 256
+
+# Above this many UIDs to add in the middle of a UIDSet, merge them into it
+# right away.
+MAX_INSERTS = 1000
+
+
+class UIDSet(object):
+    """
+    A set of UIDs, stored as a sorted array. Iterates in ascending order.
+
+    Supports membership tests, len(), iteration, indexing and slicing (by
+    position), and the operators -, & and | with other UIDSets or any
+    iterable of UIDs.
+
+    update() appends UIDs above the current ones in place; other UIDs are
+    collected in a small set and merged into the array once there are enough
+    of them to make the merge worth it.
+
+    """
+    __slots__ = ('_uids', '_pending')
+
+    def __init__(self, uids=()):
+        self._pending = set()
+        if isinstance(uids, UIDSet):
+            self._uids = array(TYPECODE, uids._sorted())
+            return
+        uids = array(TYPECODE, uids)
+        # UIDs usually come sorted (from SEARCH or an ordered query).
+        if not _is_sorted(uids):
+            uids = array(TYPECODE, sorted(set(uids)))
+        self._uids = uids
+
+    @classmethod
+    def _from_array(cls, uids):
+        uid_set = cls.__new__(cls)
+        uid_set._uids = uids
+        uid_set._pending = set()
+        return uid_set
+
+    def _sorted(self):
+        if self._pending:
+            self._uids = _union(self._uids,
+                                array(TYPECODE, sorted(self._pending)))
+            self._pending = set()
+        return self._uids
+
+    def __len__(self):
+        return len(self._uids) + len(self._pending)
+
+    def __iter__(self):
+        return iter(self._sorted())
+
+    def __contains__(self, uid):
+        if uid in self._pending:
+            return True
+        i = bisect_left(self._uids, uid)
+        return i < len(self._uids) and self._uids[i] == uid
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return UIDSet._from_array(self._sorted()[index])
+        return self._sorted()[index]
+
+    def __eq__(self, other):
+        if not isinstance(other, UIDSet):
+            return NotImplemented
+        return self._sorted() == other._sorted()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'UIDSet({!r})'.format(self.to_sequence_set())
+
+    def __sub__(self, other):
+        only_self, _, _ = _compare(self._sorted(), _as_array(other))
+        return UIDSet._from_array(only_self)
+
+    def __and__(self, other):
+        _, common, _ = _compare(self._sorted(), _as_array(other))
+        return UIDSet._from_array(common)
+
+    def __or__(self, other):
+        return UIDSet._from_array(_union(self._sorted(), _as_array(other)))
+
+    def update(self, uids):
+        uids = _as_array(uids)
+        if not uids:
+            return
+        if not self._pending and (not self._uids or
+                                  uids[0] > self._uids[-1]):
+            self._uids.extend(uids)
+        elif len(uids) <= MAX_INSERTS:
+            self._pending.update(uid for uid in uids if uid not in self)
+            if len(self._pending) > len(self._uids) // 16 + MAX_INSERTS:
+                self._sorted()
+        else:
+            self._uids = _union(self._sorted(), uids)
+
+    def nbytes(self):
+        """ The memory taken by the UIDs. """
+        self._sorted()
+        return self._uids.buffer_info()[1] * self._uids.itemsize
+
+    def to_sequence_set(self):
+        """ The UIDs as an IMAP sequence set, e.g. '1:3,5'. """
+        ranges = []
+        for uid in self._sorted():
+            if ranges and uid == ranges[-1][1] + 1:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+        return ','.join(str(start) if start == end else
+                        '{}:{}'.format(start, end) for start, end in ranges)
+
+
+def _as_array(uids):
+    if isinstance(uids, UIDSet):
+        return uids._sorted()
+    return UIDSet(uids)._uids
+
+
+def _is_sorted(uids):
+    return all(a < b for a, b in izip(uids, islice(uids, 1, None)))
+
+
+def _compare(a, b):
+    """
+    Split the sorted arrays `a` and `b` into the UIDs only in `a`, the UIDs
+    in both and the UIDs only in `b`.
+
+    """
+    only_a = array(TYPECODE)
+    both = array(TYPECODE)
+    only_b = array(TYPECODE)
+    i = j = 0
+    len_a, len_b = len(a), len(b)
+    while i < len_a and j < len_b:
+        n = min(RUN_LENGTH, len_a - i, len_b - j)
+        run = a[i:i + n]
+        if run == b[j:j + n]:
+            both.extend(run)
+            i += n
+            j += n
+            continue
+        # The run differs somewhere; merge a run's worth of UIDs one by one
+        # before trying again.
+        for _ in xrange(n):
+            if i == len_a or j == len_b:
+                break
+            x, y = a[i], b[j]
+            if x == y:
+                both.append(x)
+                i += 1
+                j += 1
+            elif x < y:
+                end = bisect_left(a, y, i)
+                only_a.extend(a[i:end])
+                i = end
+            else:
+                end = bisect_left(b, x, j)
+                only_b.extend(b[j:end])
+                j = end
+    only_a.extend(a[i:])
+    only_b.extend(b[j:])
+    return only_a, both, only_b
+
+
+def _union(a, b):
+    _, _, new = _compare(a, b)
+    if not new:
+        return array(TYPECODE, a)
+    if not a or new[0] > a[-1]:
+        # The common case: adding UIDs above the ones we have.
+        return a + new
+    return array(TYPECODE, merge(a, new))
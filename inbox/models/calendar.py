@@ -24,6 +24,11 @@ class Calendar(MailSyncBase, HasPublicID, HasRevisions):
 
     read_only = Column(Boolean, nullable=False, default=False)
 
+    # The provider's token for fetching the changes to the calendar's events
+    # since the last sync, if events are synced incrementally. Set with a
+    # bulk UPDATE so that it doesn't generate transactions.
+    sync_token = Column(String(255), nullable=True)
+
     __table_args__ = (UniqueConstraint('namespace_id', 'provider_name',
                                        'name', 'uid', name='uuid'),)
 
@@ -3,8 +3,6 @@ import json
 import datetime
 import base64
 import itertools
-from hashlib import sha256
-from flanker import mime
 from collections import defaultdict
 
 from sqlalchemy import (Column, Integer, BigInteger, String, DateTime,
@@ -12,13 +10,15 @@ from sqlalchemy import (Column, Integer, BigInteger, String, DateTime,
 from sqlalchemy.orm import relationship, backref, validates
 from sqlalchemy.sql.expression import false
 
-from inbox.util.html import plaintext2html, strip_tags
+from inbox.util.html import plaintext2html
 from inbox.sqlalchemy_ext.util import JSON, json_field_too_long
 
 from inbox.config import config
-from inbox.util.addr import parse_mimepart_address_header
 from inbox.util.file import mkdirp
-from inbox.util.misc import parse_references, get_internaldate
+from inbox.util.blockstore import get_blockstore
+from inbox.util.message_parsing import (parse_message, SNIPPET_LENGTH,
+                                        calculate_html_snippet,
+                                        calculate_plaintext_snippet)
 
 from inbox.models.mixins import HasPublicID, HasRevisions
 from inbox.models.base import MailSyncBase
@@ -29,14 +29,6 @@ from inbox.log import get_logger
 log = get_logger()
 
 
-def _trim_filename(s, mid, max_len=64):
-    if s and len(s) > max_len:
-        log.warning('filename is too long, truncating',
-                    mid=mid, max_len=max_len, filename=s)
-        return s[:max_len - 8] + s[-8:]  # Keep extension
-    return s
-
-
 def _get_errfilename(account_id, folder_name, uid):
     try:
         errdir = os.path.join(config['LOGDIR'], str(account_id), 'errors',
@@ -111,7 +103,7 @@ class Message(MailSyncBase, HasRevisions, HasPublicID):
     # NOTE: always HTML :)
     sanitized_body = Column(Text(length=26214400), nullable=False)
     snippet = Column(String(191), nullable=False)
-    SNIPPET_LENGTH = 191
+    SNIPPET_LENGTH = SNIPPET_LENGTH
 
     # A reference to the block holding the full contents of the message
     full_body_id = Column(ForeignKey('block.id', name='full_body_id_fk'),
@@ -166,7 +158,7 @@ class Message(MailSyncBase, HasRevisions, HasPublicID):
 
     @classmethod
     def create_from_synced(cls, account, mid, folder_name, received_date,
-                           body_string):
+                           body_string, parsed=None):
         """
         Parses message data and writes out db metadata and MIME blocks.
 
@@ -184,6 +176,10 @@ class Message(MailSyncBase, HasRevisions, HasPublicID):
         raw_message : str
             The full message including headers (encoded).
 
+        parsed : inbox.util.message_parsing.ParsedMessage, optional
+            The result of parsing `body_string` ahead of time (e.g. in a parse
+            worker process). If not given, the message is parsed inline.
+
         """
         _rqd = [account, mid, folder_name, body_string]
         if not all([v is not None for v in _rqd]):
@@ -194,84 +190,50 @@ class Message(MailSyncBase, HasRevisions, HasPublicID):
         assert account.namespace is not None
         assert not isinstance(body_string, unicode)
 
-        msg = Message()
-
-        try:
-            from inbox.models.block import Block, Part
-            body_block = Block()
-            body_block.namespace_id = account.namespace.id
-            body_block.data = body_string
-            body_block.content_type = "text/plain"
-            msg.full_body = body_block
+        if parsed is None:
+            parsed = parse_message(body_string, received_date)
+        get_blockstore().prepare_put(
+            [parsed.body_sha256] + [part.data_sha256 for part in parsed.parts])
 
-            msg.namespace_id = account.namespace.id
-            parsed = mime.from_string(body_string)
-
-            mime_version = parsed.headers.get('Mime-Version')
-            # sometimes MIME-Version is '1.0 (1.0)', hence the .startswith()
-            if mime_version is not None and not mime_version.startswith('1.0'):
-                log.warning('Unexpected MIME-Version',
-                            account_id=account.id, folder_name=folder_name,
-                            mid=mid, mime_version=mime_version)
-
-            msg.data_sha256 = sha256(body_string).hexdigest()
+        from inbox.models.block import Block, Part
+        msg = Message()
 
-            msg.subject = parsed.subject
-            msg.from_addr = parse_mimepart_address_header(parsed, 'From')
-            msg.sender_addr = parse_mimepart_address_header(parsed, 'Sender')
-            msg.reply_to = parse_mimepart_address_header(parsed, 'Reply-To')
-            msg.to_addr = parse_mimepart_address_header(parsed, 'To')
-            msg.cc_addr = parse_mimepart_address_header(parsed, 'Cc')
-            msg.bcc_addr = parse_mimepart_address_header(parsed, 'Bcc')
+        body_block = Block()
+        body_block.namespace_id = account.namespace.id
+        body_block.set_data(body_string, parsed.body_sha256)
+        body_block.content_type = "text/plain"
+        msg.full_body = body_block
 
-            msg.in_reply_to = parsed.headers.get('In-Reply-To')
-            msg.message_id_header = parsed.headers.get('Message-Id')
+        msg.namespace_id = account.namespace.id
 
-            msg.received_date = received_date if received_date else \
-                get_internaldate(parsed.headers.get('Date'),
-                                 parsed.headers.get('Received'))
+        for level, event, kwargs in parsed.log_events:
+            getattr(log, level)(event, account_id=account.id,
+                                folder_name=folder_name, mid=mid, **kwargs)
 
-            # Custom Inbox header
-            msg.inbox_uid = parsed.headers.get('X-INBOX-ID')
+        for attr, value in parsed.attrs.iteritems():
+            setattr(msg, attr, value)
 
-            # In accordance with JWZ (http://www.jwz.org/doc/threading.html)
-            msg.references = parse_references(
-                parsed.headers.get('References', ''),
-                parsed.headers.get('In-Reply-To', ''))
+        for parsed_part in parsed.parts:
+            block = Block()
+            block.namespace_id = account.namespace.id
+            block.content_type = parsed_part.content_type
+            block.filename = parsed_part.filename
 
-            msg.size = len(body_string)  # includes headers text
+            new_part = Part(block=block, message=msg)
+            new_part.walk_index = parsed_part.walk_index
+            if parsed_part.content_disposition is not None:
+                new_part.content_disposition = parsed_part.content_disposition
+            new_part.content_id = parsed_part.content_id
 
-            i = 0  # for walk_index
+            block.set_data(parsed_part.data, parsed_part.data_sha256)
 
-            # Store all message headers as object with index 0
-            block = Block()
-            block.namespace_id = account.namespace.id
-            block.data = json.dumps(parsed.headers.items())
-
-            headers_part = Part(block=block, message=msg)
-            headers_part.walk_index = i
-
-            for mimepart in parsed.walk(
-                    with_self=parsed.content_type.is_singlepart()):
-                i += 1
-                if mimepart.content_type.is_multipart():
-                    log.warning('multipart sub-part found',
-                                account_id=account.id, folder_name=folder_name,
-                                mid=mid)
-                    continue  # TODO should we store relations?
-                msg._parse_mimepart(mimepart, mid, i, account.namespace.id)
-            msg.calculate_sanitized_body()
-        except (mime.DecodingError, AttributeError, RuntimeError, TypeError,
-                ValueError) as e:
-            # Message parsing can fail for several reasons. Occasionally iconv
-            # will fail via maximum recursion depth. EAS messages may be
-            # missing Date and Received headers. In such cases, we still keep
-            # the metadata and mark it as b0rked.
+        if parsed.error is not None:
             _log_decode_error(account.id, folder_name, mid, body_string)
             err_filename = _get_errfilename(account.id, folder_name, mid)
             log.error('Message parsing error',
                       folder_name=folder_name, account_id=account.id,
-                      err_filename=err_filename, error=e)
+                      err_filename=err_filename, error=parsed.error)
+        if parsed.decode_error:
             msg._mark_error()
 
         # Occasionally people try to send messages to way too many
@@ -290,51 +252,6 @@ class Message(MailSyncBase, HasRevisions, HasPublicID):
 
         return msg
 
-    def _parse_mimepart(self, mimepart, mid, index, namespace_id):
-        """Parse a single MIME part into a Block and Part object linked to this
-        message."""
-        from inbox.models.block import Block, Part
-        disposition, disposition_params = mimepart.content_disposition
-        if (disposition is not None and
-                disposition not in ['inline', 'attachment']):
-            cd = mimepart.content_disposition
-            log.error('Unknown Content-Disposition',
-                      mid=mid, bad_content_disposition=cd,
-                      parsed_content_disposition=disposition)
-            self._mark_error()
-            return
-        block = Block()
-        block.namespace_id = namespace_id
-        block.content_type = mimepart.content_type.value
-        block.filename = _trim_filename(
-            mimepart.content_type.params.get('name'), mid)
-
-        new_part = Part(block=block, message=self)
-        new_part.walk_index = index
-
-        # TODO maybe also trim other headers?
-        if disposition is not None:
-            new_part.content_disposition = disposition
-            if disposition == 'attachment':
-                new_part.block.filename = _trim_filename(
-                    disposition_params.get('filename'), mid)
-
-        if mimepart.body is None:
-            data_to_write = ''
-        elif new_part.block.content_type.startswith('text'):
-            data_to_write = mimepart.body.encode('utf-8', 'strict')
-            # normalize mac/win/unix newlines
-            data_to_write = data_to_write.replace('\r\n', '\n'). \
-                replace('\r', '\n')
-        else:
-            data_to_write = mimepart.body
-        if data_to_write is None:
-            data_to_write = ''
-
-        new_part.content_id = mimepart.headers.get('Content-Id')
-
-        block.data = data_to_write
-
     def _mark_error(self):
         self.decode_error = True
         # fill in required attributes with filler data if could not parse them
@@ -361,11 +278,10 @@ class Message(MailSyncBase, HasRevisions, HasPublicID):
             self.snippet = u''
 
     def calculate_html_snippet(self, text):
-        text = strip_tags(text)
-        return self.calculate_plaintext_snippet(text)
+        return calculate_html_snippet(text)
 
     def calculate_plaintext_snippet(self, text):
-        return ' '.join(text.split())[:self.SNIPPET_LENGTH]
+        return calculate_plaintext_snippet(text)
 
     @property
     def body(self):
@@ -17,11 +17,12 @@ def load_models():
     from inbox.models.secret import Secret
     from inbox.models.tag import Tag
     from inbox.models.thread import Thread, TagItem
+    from inbox.models.threading_key import ThreadingKey
     from inbox.models.transaction import Transaction
     from inbox.models.when import When, Time, TimeSpan, Date, DateSpan
     exports = [Account, MailSyncBase, ActionLog, Block, Part,
                MessageContactAssociation, Contact, Calendar, Event, Folder,
                FolderItem, Message, Namespace, SearchIndexCursor, Secret, Tag,
-               Thread, TagItem, Transaction, When, Time, TimeSpan, Date,
-               DateSpan]
+               Thread, TagItem, ThreadingKey, Transaction, When, Time,
+               TimeSpan, Date, DateSpan]
     return exports
@@ -7,8 +7,11 @@ from inbox.models.transaction import Transaction
 class SearchIndexCursor(MailSyncBase):
     """
     Store the id of the last Transaction indexed into Elasticsearch.
-    Is namespace-agnostic.
+    The search index service shards the transaction log by namespace (see
+    inbox.transactions.search), and keeps one cursor per shard.
 
     """
     transaction_id = Column(Integer, ForeignKey(Transaction.id),
                             nullable=True, index=True)
+    shard_id = Column(Integer, nullable=False, server_default='0',
+                      index=True, unique=True)
@@ -19,8 +19,10 @@ def new_session(engine, versioned=True, ignore_soft_deletes=False):
     """Returns a session bound to the given engine."""
     session = Session(bind=engine, autoflush=True, autocommit=False)
     if versioned:
-        from inbox.models.transaction import (create_revisions,
-                                              increment_versions)
+        from inbox.models.transaction import (
+            create_revisions, increment_versions,
+            publish_transaction_notifications,
+            discard_transaction_notifications)
 
         @event.listens_for(session, 'before_flush')
         def before_flush(session, flush_context, instances):
@@ -33,6 +35,14 @@ def new_session(engine, versioned=True, ignore_soft_deletes=False):
             grab object IDs on new objects.
             """
             create_revisions(session)
+
+        @event.listens_for(session, 'after_commit')
+        def after_commit(session):
+            publish_transaction_notifications(session)
+
+        @event.listens_for(session, 'after_rollback')
+        def after_rollback(session):
+            discard_transaction_notifications(session)
     return session
 
 # Old name for legacy code.
@@ -0,0 +1,103 @@
+from hashlib import sha256
+
+from sqlalchemy import Column, Integer, String, ForeignKey, Index, event
+from sqlalchemy.orm.attributes import get_history
+
+from inbox.models.base import MailSyncBase
+from inbox.models.message import Message
+from inbox.models.namespace import Namespace
+from inbox.util.misc import cleanup_subject
+
+# Kinds of threading keys.
+REFERENCE = 'reference'
+PARTICIPANT = 'participant'
+SENDER = 'sender'
+
+# Don't index more participants than this per message; mass emails aren't
+# threaded by participants anyway.
+MAX_PARTICIPANT_KEYS = 20
+
+# The Message attributes that threading keys are derived from.
+THREADING_ATTRS = ('message_id_header', 'references', 'subject', 'from_addr',
+                   'to_addr', 'cc_addr', 'bcc_addr')
+
+
+class ThreadingKey(MailSyncBase):
+    """
+    Index of the keys used to find the thread a new message belongs to (see
+    inbox.util.threading). Each message gets one row per key:
+
+    * a REFERENCE key for its own Message-ID and for each of its References
+      (JWZ-style, http://www.jwz.org/doc/threading.html),
+    * a PARTICIPANT key for each participant (other than BCCed ones), scoped
+      to the cleaned-up subject, and
+    * a SENDER key for its sender, scoped to the cleaned-up subject, to match
+      messages people send themselves.
+
+    Keys are hashed so that they have a fixed, indexable length.
+
+    """
+    namespace_id = Column(Integer,
+                          ForeignKey(Namespace.id, ondelete='CASCADE'),
+                          nullable=False)
+    message_id = Column(Integer, ForeignKey(Message.id, ondelete='CASCADE'),
+                        nullable=False, index=True)
+    key = Column(String(64), nullable=False)
+
+Index('ix_threadingkey_namespace_id_key', ThreadingKey.namespace_id,
+      ThreadingKey.key)
+
+
+def _hash_key(*parts):
+    return sha256('\0'.join(part.encode('utf-8') if isinstance(part, unicode)
+                            else part for part in parts)).hexdigest()
+
+
+def threading_keys(message):
+    """Return a dict mapping the threading keys of `message` to their
+    kind."""
+    keys = {}
+    message_ids = list(message.references or [])
+    if message.message_id_header:
+        message_ids.append(message.message_id_header)
+    for message_id in message_ids:
+        keys[_hash_key(REFERENCE, message_id.strip())] = REFERENCE
+
+    subject = cleanup_subject(message.subject)
+    # A lot of people BCC some address when sending mass emails so ignore
+    # BCC.
+    bcc = {address for phrase, address in message.bcc_addr or []}
+    emails = sorted({address for phrase, address in message.participants
+                     if address and address not in bcc})
+    for email in emails[:MAX_PARTICIPANT_KEYS]:
+        keys[_hash_key(PARTICIPANT, subject, email)] = PARTICIPANT
+
+    senders = [address for phrase, address in message.from_addr or []
+               if address]
+    if senders:
+        keys[_hash_key(SENDER, subject, *senders)] = SENDER
+    return keys
+
+
+def index_message(connection, message):
+    if message.namespace_id is None:
+        return
+    rows = [dict(namespace_id=message.namespace_id, message_id=message.id,
+                 key=key) for key in threading_keys(message)]
+    if rows:
+        connection.execute(ThreadingKey.__table__.insert(), rows)
+
+
+@event.listens_for(Message, 'after_insert')
+def index_new_message(mapper, connection, target):
+    index_message(connection, target)
+
+
+@event.listens_for(Message, 'after_update')
+def reindex_message(mapper, connection, target):
+    if not any(get_history(target, attr).has_changes()
+               for attr in THREADING_ATTRS):
+        return
+    table = ThreadingKey.__table__
+    connection.execute(table.delete().where(table.c.message_id == target.id))
+    index_message(connection, target)
@@ -1,11 +1,16 @@
 from sqlalchemy import Column, Integer, String, ForeignKey, Index, Enum
 from sqlalchemy.orm import relationship
 
+from inbox.config import config
 from inbox.models.base import MailSyncBase
 from inbox.models.mixins import HasPublicID, HasRevisions
 from inbox.models.namespace import Namespace
 from inbox.sqlalchemy_ext.util import BigJSON
 
+# Whether to leave encoding snapshots to inbox.transactions.snapshots rather
+# than encoding them when transactions are created.
+DEFER_SNAPSHOTS = config.get('DEFER_TRANSACTION_SNAPSHOTS', False)
+
 
 class Transaction(MailSyncBase, HasPublicID):
     """ Transactional log to enable client syncing. """
@@ -20,7 +25,8 @@ class Transaction(MailSyncBase, HasPublicID):
     object_public_id = Column(String(191), nullable=False, index=True)
     command = Column(Enum('insert', 'update', 'delete'), nullable=False)
     # The API representation of the object at the time the transaction is
-    # generated.
+    # generated. Null for deletes, and until it's encoded if snapshots are
+    # deferred.
     snapshot = Column(BigJSON, nullable=True)
 
 
@@ -52,9 +58,25 @@ def create_revision(obj, session, revision_type):
                            object_type=obj.API_OBJECT_NAME,
                            object_public_id=obj.public_id,
                            namespace_id=obj.namespace.id)
-    if revision_type != 'delete':
+    if revision_type != 'delete' and not DEFER_SNAPSHOTS:
         revision.snapshot = encode(obj)
     session.add(revision)
+    # Waiting delta requests are notified once the session commits.
+    session.info.setdefault('transaction_namespace_ids', set()). \
+        add(revision.namespace_id)
+
+
+def publish_transaction_notifications(session):
+    """Notify waiting delta requests of the namespaces that got new
+    transactions in the session's last commit."""
+    from inbox.transactions.notifications import get_notifier
+    namespace_ids = session.info.pop('transaction_namespace_ids', None)
+    if namespace_ids:
+        get_notifier().publish(namespace_ids)
+
+
+def discard_transaction_notifications(session):
+    session.info.pop('transaction_namespace_ids', None)
 
 
 def increment_versions(session):
@@ -39,6 +39,49 @@ def new_connection():
     return elasticsearch.Elasticsearch(hosts=elasticsearch_hosts)
 
 
+def get_connection(connection_map=dict()):
+    """
+    Get the process-wide connection to the Elasticsearch server defined in
+    the config. The client keeps a pool of persistent HTTP connections to
+    each host and is safe to share between greenlets.
+
+    """
+    key = repr(config.get('ELASTICSEARCH_HOSTS'))
+    if key not in connection_map:
+        connection_map[key] = new_connection()
+    return connection_map[key]
+
+
+class IndexStateCache(object):
+    """
+    The indices that this process has created or configured, and which
+    therefore don't need to be checked again when a NamespaceSearchEngine
+    is constructed for them.
+
+    `admin_calls_avoided` counts the index admin requests (a create attempt
+    plus a put_mapping per document type) skipped thanks to the cache.
+
+    """
+    def __init__(self):
+        self._ready = set()
+        self.admin_calls_avoided = 0
+
+    def is_ready(self, index_id):
+        return index_id in self._ready
+
+    def mark_ready(self, index_id):
+        self._ready.add(index_id)
+
+    def invalidate(self, index_id):
+        self._ready.discard(index_id)
+
+    def record_hit(self, mappings):
+        self.admin_calls_avoided += 1 + len(mappings)
+
+
+index_state = IndexStateCache()
+
+
 def wrap_es_errors(func):
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
@@ -49,6 +92,26 @@ def wrap_es_errors(func):
     return wrapper
 
 
+def get_search_engine(namespace_public_id):
+    """
+    Get the search engine for a namespace, using the backend selected by
+    "SEARCH_BACKEND" in the config: "elasticsearch" (the default) or
+    "embedded" (see inbox.search.embedded).
+
+    Engines of every backend expose `create_index`, `delete_index` and
+    `refresh_index`, and `messages` and `threads` adaptors with `index`,
+    `bulk_index` and `search` methods.
+
+    """
+    backend = config.get('SEARCH_BACKEND', 'elasticsearch')
+    if backend == 'embedded':
+        from inbox.search.embedded import EmbeddedNamespaceSearchEngine
+        return EmbeddedNamespaceSearchEngine(namespace_public_id)
+    assert backend == 'elasticsearch', \
+        'Unknown SEARCH_BACKEND {}'.format(backend)
+    return NamespaceSearchEngine(namespace_public_id)
+
+
 class NamespaceSearchEngine(object):
     """
     Interface to create and interact with the Elasticsearch datastore
@@ -60,12 +123,13 @@ class NamespaceSearchEngine(object):
     def __init__(self, namespace_public_id):
         self.index_id = namespace_public_id
 
-        # TODO(emfree): probably want to try to keep persistent connections
-        # around, instead of creating a new one each time.
-        self._connection = new_connection()
+        self._connection = get_connection()
         self.log = log.new(component='search', index=namespace_public_id)
 
-        self.create_index()
+        if index_state.is_ready(self.index_id):
+            index_state.record_hit(self.MAPPINGS)
+        else:
+            self.create_index()
 
         self.messages = MessageSearchAdaptor(index_id=namespace_public_id,
                                              log=self.log)
@@ -84,6 +148,7 @@ class NamespaceSearchEngine(object):
             self._connection.indices.create(
                 index=self.index_id,
                 body={'mappings': NAMESPACE_INDEX_MAPPING})
+            index_state.mark_ready(self.index_id)
         except elasticsearch.exceptions.RequestError:
             self.log.warning('create_index error, will re-configure.')
             # If the index already exists, ensure the right mappings are still
@@ -102,6 +167,7 @@ class NamespaceSearchEngine(object):
             for doc_type, mapping in self.MAPPINGS.items():
                 self._connection.indices.put_mapping(
                     index=self.index_id, doc_type=doc_type, body=mapping)
+            index_state.mark_ready(self.index_id)
         except elasticsearch.exceptions.RequestError:
             self.log.warning('configure_index error, will delete + create.')
             self.delete_index()
@@ -111,6 +177,7 @@ class NamespaceSearchEngine(object):
     def delete_index(self):
         """ Delete the index for the namespace. Obviously use with care. """
         self.log.info('delete_index')
+        index_state.invalidate(self.index_id)
         self._connection.indices.delete(index=[self.index_id])
 
     @wrap_es_errors
@@ -138,9 +205,7 @@ class BaseSearchAdaptor(object):
 
         self.log = log
 
-        # TODO(emfree): probably want to try to keep persistent connections
-        # around, instead of creating a new one each time.
-        self._connection = new_connection()
+        self._connection = get_connection()
 
     @wrap_es_errors
     def _index_document(self, object_repr, **kwargs):
@@ -213,6 +278,9 @@ class BaseSearchAdaptor(object):
             self.log.error('Bulk index failure', error=e.error,
                            doc_type=self.doc_type,
                            object_ids=[i['_id'] for i in index_args])
+            # The index may have been deleted or reconfigured behind our
+            # back, so check it again next time.
+            index_state.invalidate(self.index_id)
             raise SearchEngineError('Bulk index failure!')
         if count != len(objects):
             self.log.error('Bulk index failure',
@@ -222,6 +290,7 @@ class BaseSearchAdaptor(object):
                            failures=failures)
 
             if any(raise_error(f) for f in failures):
+                index_state.invalidate(self.index_id)
                 raise SearchEngineError('Bulk index failure!')
 
         return count
@@ -0,0 +1,274 @@
+"""
+Embedded full-text search backend, as an alternative to Elasticsearch for
+small deployments and for development.
+
+Each namespace gets its own SQLite database, in the directory given by
+"SEARCH_SQLITE_DIR", with an FTS5 table per document type. Select it with
+    "SEARCH_BACKEND": "embedded",
+    "SEARCH_SQLITE_DIR": "/var/lib/inboxapp/search"
+in your config. The directory must be shared by the processes that index
+(the search index service) and search (the API); the special value
+":memory:" keeps each process's indices to itself, and is only useful for
+tests. Documents are fed to it exactly as they are to Elasticsearch
+(see inbox.search.adaptor.get_search_engine), and API queries are
+interpreted using the fields and weights of MessageQuery and ThreadQuery:
+
+* a query for a single field matches the phrase (or, for a list, any of the
+  terms) in that field,
+* a query for 'all' matches in any field, and is ranked with the query's
+  field weights (BM25),
+* a list of queries is or-ed together.
+
+Queries on a field of the other document type (e.g. messages by thread tag)
+aren't supported.
+
+Requires SQLite to be compiled with FTS5 (version 3.9 or later).
+
+"""
+import calendar
+import datetime
+import json
+import os
+import sqlite3
+
+from inbox.config import config, ConfigError
+from inbox.log import get_logger
+log = get_logger()
+from inbox.search.adaptor import SearchEngineError
+from inbox.search.query import MessageQuery, ThreadQuery
+
+SQLITE_DIR = config.get('SEARCH_SQLITE_DIR')
+
+
+class DocType(object):
+    def __init__(self, name, query_class, fields, timestamp_field):
+        self.name = name
+        self.query_class = query_class
+        # The full-text indexed fields, in column order.
+        self.fields = fields
+        self.timestamp_field = timestamp_field
+
+
+DOC_TYPES = {
+    'message': DocType('message', MessageQuery,
+                       ['id', 'thread_id', 'subject', 'from', 'to', 'cc',
+                        'bcc', 'snippet', 'body', 'files'],
+                       'date'),
+    'thread': DocType('thread', ThreadQuery,
+                      ['id', 'subject', 'participants', 'tags', 'snippet'],
+                      'last_message_timestamp'),
+}
+
+
+def _get_connection(index_id, connection_map=dict()):
+    if index_id not in connection_map:
+        if not SQLITE_DIR:
+            raise ConfigError(
+                'Missing config value for SEARCH_SQLITE_DIR.',
+                'The embedded search backend needs a directory for its '
+                'indices, shared by the search index service and the API.')
+        path = ':memory:' if SQLITE_DIR == ':memory:' else \
+            os.path.join(SQLITE_DIR, '{}.db'.format(index_id))
+        connection_map[index_id] = sqlite3.connect(path,
+                                                   check_same_thread=False)
+    return connection_map[index_id]
+
+
+class EmbeddedNamespaceSearchEngine(object):
+    """
+    Embedded counterpart of inbox.search.adaptor.NamespaceSearchEngine for a
+    namespace, identified by the namespace public id.
+
+    """
+    def __init__(self, namespace_public_id):
+        self.index_id = namespace_public_id
+        self._connection = _get_connection(namespace_public_id)
+        self.log = log.new(component='search', index=namespace_public_id)
+
+        self.create_index()
+
+        self.messages = EmbeddedSearchAdaptor(self._connection,
+                                              DOC_TYPES['message'],
+                                              self.log)
+        self.threads = EmbeddedSearchAdaptor(self._connection,
+                                             DOC_TYPES['thread'], self.log)
+
+    def create_index(self):
+        """ Create the tables for the namespace, if they don't exist. """
+        with self._connection:
+            for doc_type in DOC_TYPES.itervalues():
+                self._connection.execute(
+                    'CREATE TABLE IF NOT EXISTS {}_source ('
+                    'rowid INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, '
+                    'timestamp INTEGER, source TEXT NOT NULL)'.
+                    format(doc_type.name))
+                self._connection.execute(
+                    'CREATE VIRTUAL TABLE IF NOT EXISTS {}_fts USING fts5({})'.
+                    format(doc_type.name, ', '.join(
+                        _column(f) for f in doc_type.fields)))
+
+    def delete_index(self):
+        """ Delete the index for the namespace. Obviously use with care. """
+        self.log.info('delete_index')
+        with self._connection:
+            for doc_type in DOC_TYPES:
+                self._connection.execute(
+                    'DROP TABLE IF EXISTS {}_source'.format(doc_type))
+                self._connection.execute(
+                    'DROP TABLE IF EXISTS {}_fts'.format(doc_type))
+
+    def refresh_index(self):
+        """ Changes are searchable as soon as they're made. """
+        pass
+
+
+class EmbeddedSearchAdaptor(object):
+    """ Adaptor for a single document type of a namespace's index. """
+    def __init__(self, connection, doc_type, log):
+        self._connection = connection
+        self.doc_type = doc_type
+        self.log = log
+
+    def index(self, object_repr):
+        self.bulk_index([('index', object_repr)])
+
+    def bulk_index(self, objects):
+        """
+        Perform a batch of index operations, given as (op_type, object)
+        tuples where op_type is 'index' or 'delete'. Returns the number of
+        operations performed.
+
+        """
+        name = self.doc_type.name
+        with self._connection:
+            for op, object_repr in objects:
+                row = self._connection.execute(
+                    'SELECT rowid FROM {}_source WHERE id = ?'.format(name),
+                    (object_repr['id'],)).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        'DELETE FROM {}_fts WHERE rowid = ?'.format(name),
+                        row)
+                    self._connection.execute(
+                        'DELETE FROM {}_source WHERE rowid = ?'.format(name),
+                        row)
+                if op == 'delete':
+                    continue
+
+                timestamp = object_repr.get(self.doc_type.timestamp_field)
+                cursor = self._connection.execute(
+                    'INSERT INTO {}_source (id, timestamp, source) '
+                    'VALUES (?, ?, ?)'.format(name),
+                    (object_repr['id'], _timestamp(timestamp),
+                     json.dumps(object_repr, default=_timestamp)))
+                nested_fields = self.doc_type.query_class.nested_fields
+                values = [_text(object_repr.get(f), nested_fields.get(f))
+                          for f in self.doc_type.fields]
+                self._connection.execute(
+                    'INSERT INTO {}_fts (rowid, {}) VALUES (?, {})'.format(
+                        name,
+                        ', '.join(_column(f) for f in self.doc_type.fields),
+                        ', '.join('?' for f in self.doc_type.fields)),
+                    [cursor.lastrowid] + values)
+        return len(objects)
+
+    def search(self, query, sort, max_results=100, offset=0, explain=True):
+        """ Perform a search and return the results. """
+        name = self.doc_type.name
+        order_by = 'rank' if sort == 'relevance' else 's.timestamp DESC'
+        try:
+            if query is None:
+                total, = self._connection.execute(
+                    'SELECT count(*) FROM {}_source'.format(name)).fetchone()
+                rows = self._connection.execute(
+                    'SELECT s.source, 0 AS rank FROM {}_source s '
+                    'ORDER BY s.timestamp DESC LIMIT ? OFFSET ?'.format(name),
+                    (max_results, offset)).fetchall()
+            else:
+                expression, weights = self._match_expression(query)
+                total, = self._connection.execute(
+                    'SELECT count(*) FROM {}_fts WHERE {}_fts MATCH ?'.
+                    format(name, name), (expression,)).fetchone()
+                rows = self._connection.execute(
+                    'SELECT s.source, bm25({name}_fts, {weights}) AS rank '
+                    'FROM {name}_fts JOIN {name}_source s '
+                    'ON s.rowid = {name}_fts.rowid '
+                    'WHERE {name}_fts MATCH ? '
+                    'ORDER BY {order_by} LIMIT ? OFFSET ?'.format(
+                        name=name, order_by=order_by,
+                        weights=', '.join(str(w) for w in weights)),
+                    (expression, max_results, offset)).fetchall()
+        except sqlite3.Error as e:
+            raise SearchEngineError(e)
+
+        self.log.debug('search query', query=query, total=total)
+        # bm25() scores are negative, lower being better.
+        results = [dict(relevance=-rank, object=json.loads(source))
+                   for source, rank in rows]
+        return dict(total=total, results=results)
+
+    def _match_expression(self, api_query):
+        """
+        Translate an API query (a list of and-queries, to be or-ed together)
+        into an FTS5 MATCH expression, and the column weights to rank it
+        with.
+
+        """
+        assert isinstance(api_query, list)
+        weights = dict((f, 1) for f in self.doc_type.fields)
+        clauses = []
+        for and_query in api_query:
+            assert isinstance(and_query, dict)
+            # Let the query class strip and apply the query's weights, as it
+            # does for Elasticsearch.
+            query = self.doc_type.query_class(dict(and_query))
+            for f in self.doc_type.fields:
+                weights[f] = max(weights[f], query._fields.get(f) or 1)
+
+            terms = []
+            for field, value in query.query.iteritems():
+                if field == 'all':
+                    terms.append(_match_terms(value))
+                elif field in self.doc_type.fields:
+                    terms.append('{} : {}'.format(_column(field),
+                                                  _match_terms(value)))
+                else:
+                    raise SearchEngineError(
+                        'Unsupported search field {}'.format(field))
+            clauses.append('({})'.format(' AND '.join(terms)))
+        return (' OR '.join(clauses),
+                [weights[f] for f in self.doc_type.fields])
+
+
+def _column(field):
+    return 'c_{}'.format(field)
+
+
+def _quote(term):
+    return u'"{}"'.format(term.replace('"', '""'))
+
+
+def _match_terms(value):
+    # Like the Elasticsearch queries: match a string as a phrase, and a list
+    # as any of its terms.
+    if isinstance(value, list):
+        return u'({})'.format(u' OR '.join(_quote(unicode(v)) for v in value))
+    return _quote(unicode(value))
+
+
+def _text(value, sub_fields=None):
+    """ The text to index for a field of a document. """
+    if value is None:
+        return u''
+    if isinstance(value, list):
+        return u' '.join(_text(v, sub_fields) for v in value)
+    if isinstance(value, dict):
+        return u' '.join(_text(value.get(f)) for f in
+                         (sub_fields or value.keys()))
+    return unicode(value)
+
+
+def _timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple())
+    return value
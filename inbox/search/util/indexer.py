@@ -1,6 +1,10 @@
+import json
+import os
+
 import dateutil.parser
 
 import gevent
+from gevent.pool import Pool
 from sqlalchemy.orm import joinedload, subqueryload
 
 from inbox.log import get_logger
@@ -8,18 +12,49 @@ log = get_logger()
 from inbox.models.session import session_scope
 from inbox.models import Namespace, Thread, Message
 from inbox.api.kellogs import encode
-from inbox.search.adaptor import NamespaceSearchEngine
+from inbox.search.adaptor import get_search_engine, SearchEngineError
 from inbox.sqlalchemy_ext.util import safer_yield_per
 from inbox.transactions.search import _process_attributes
 
 CHUNK_SIZE = 500
+# Maximum number of concurrent bulk requests per namespace and document type.
+MAX_CONCURRENT_BULK_REQUESTS = 4
+
 
+class BackfillProgress(object):
+    """
+    Record of the last thread and message id indexed for each namespace,
+    persisted to a JSON file at `path` so that an interrupted backfill can
+    pick up where it left off.
 
-def index_namespaces(namespace_ids=None, created_before=None):
+    """
+    def __init__(self, path):
+        self.path = path
+        self._progress = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._progress = json.load(f)
+
+    def get(self, namespace_id, doc_type):
+        """The last indexed id, or 0 if none."""
+        return self._progress.get(str(namespace_id), {}).get(doc_type, 0)
+
+    def update(self, namespace_id, doc_type, last_id):
+        self._progress.setdefault(str(namespace_id), {})[doc_type] = last_id
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._progress, f)
+        os.rename(tmp_path, self.path)
+
+
+def index_namespaces(namespace_ids=None, created_before=None, progress=None):
     """
     Create an Elasticsearch index for each namespace in the `namespace_ids`
     list (specified by id), and index its threads and messages.
     If `namespace_ids` is None, all namespaces are indexed.
+    If a BackfillProgress is given as `progress`, only threads and messages
+    past the recorded ones are indexed, and progress is recorded as it's
+    made.
 
     """
     pool = []
@@ -34,9 +69,9 @@ def index_namespaces(namespace_ids=None, created_before=None):
 
     for (id_, public_id) in namespaces:
         pool.append(gevent.spawn(index_threads, id_, public_id,
-                                 created_before))
+                                 created_before, progress))
         pool.append(gevent.spawn(index_messages, id_, public_id,
-                                 created_before))
+                                 created_before, progress))
 
     gevent.joinall(pool)
 
@@ -65,13 +100,17 @@ def delete_namespace_indexes(namespace_ids):
     gevent.joinall(pool)
 
 
-def index_threads(namespace_id, namespace_public_id, created_before=None):
+def index_threads(namespace_id, namespace_public_id, created_before=None,
+                  progress=None):
     """ Index the threads of a namespace. """
     if created_before is not None:
         created_before = dateutil.parser.parse(created_before)
 
-    indexed_count = 0
-    search_engine = NamespaceSearchEngine(namespace_public_id)
+    search_engine = get_search_engine(namespace_public_id)
+    start_id = progress.get(namespace_id, 'thread') + 1 if progress else 0
+
+    log.info('Going to index threads', namespace_id=namespace_id,
+             namespace_public_id=namespace_public_id, start_id=start_id)
 
     with session_scope() as db_session:
         query = db_session.query(Thread).filter(
@@ -87,17 +126,11 @@ def index_threads(namespace_id, namespace_public_id, created_before=None):
             subqueryload('tagitems').joinedload('tag').
             load_only('public_id', 'name'))
 
-        encoded = []
-        for obj in safer_yield_per(query, Thread.id, 0, CHUNK_SIZE):
-            encoded_obj = encode(obj, namespace_public_id=namespace_public_id)
-            index_obj = _process_attributes(encoded_obj)
-
-            encoded.append(('index', index_obj))
-
-    log.info('Going to index threads', namespace_id=namespace_id,
-             namespace_public_id=namespace_public_id)
-
-    indexed_count += search_engine.threads.bulk_index(encoded)
+        chunks = _encoded_chunks(query, Thread.id, start_id,
+                                 namespace_public_id)
+        indexed_count = _bulk_index_chunks(
+            chunks, search_engine.threads.bulk_index,
+            _progress_callback(progress, namespace_id, 'thread'))
 
     log.info('Indexed threads', namespace_id=namespace_id,
              namespace_public_id=namespace_public_id,
@@ -106,13 +139,17 @@ def index_threads(namespace_id, namespace_public_id, created_before=None):
     return indexed_count
 
 
-def index_messages(namespace_id, namespace_public_id, created_before=None):
+def index_messages(namespace_id, namespace_public_id, created_before=None,
+                   progress=None):
     """ Index the messages of a namespace. """
     if created_before is not None:
         created_before = dateutil.parser.parse(created_before)
 
-    indexed_count = 0
-    search_engine = NamespaceSearchEngine(namespace_public_id)
+    search_engine = get_search_engine(namespace_public_id)
+    start_id = progress.get(namespace_id, 'message') + 1 if progress else 0
+
+    log.info('Going to index messages', namespace_id=namespace_id,
+             namespace_public_id=namespace_public_id, start_id=start_id)
 
     with session_scope() as db_session:
         query = db_session.query(Message).filter(
@@ -124,17 +161,11 @@ def index_messages(namespace_id, namespace_public_id, created_before=None):
         query = query.options(joinedload(Message.parts).
                               load_only('content_disposition'))
 
-        encoded = []
-        for obj in safer_yield_per(query, Message.id, 0, CHUNK_SIZE):
-            encoded_obj = encode(obj, namespace_public_id=namespace_public_id)
-            index_obj = _process_attributes(encoded_obj)
-
-            encoded.append(('index', index_obj))
-
-    log.info('Going to index messages', namespace_id=namespace_id,
-             namespace_public_id=namespace_public_id)
-
-    indexed_count += search_engine.messages.bulk_index(encoded)
+        chunks = _encoded_chunks(query, Message.id, start_id,
+                                 namespace_public_id)
+        indexed_count = _bulk_index_chunks(
+            chunks, search_engine.messages.bulk_index,
+            _progress_callback(progress, namespace_id, 'message'))
 
     log.info('Indexed messages', namespace_id=namespace_id,
              namespace_public_id=namespace_public_id,
@@ -143,9 +174,83 @@ def index_messages(namespace_id, namespace_public_id, created_before=None):
     return indexed_count
 
 
+def _encoded_chunks(query, id_field, start_id, namespace_public_id):
+    """
+    Yield (last_id, operations) pairs, where operations are the index
+    operations for the next CHUNK_SIZE objects of `query`, and last_id is the
+    id of the last of them.
+
+    """
+    chunk = []
+    for obj in safer_yield_per(query, id_field, start_id, CHUNK_SIZE):
+        encoded_obj = encode(obj, namespace_public_id=namespace_public_id)
+        chunk.append(('index', _process_attributes(encoded_obj)))
+        last_id = obj.id
+        if len(chunk) == CHUNK_SIZE:
+            yield last_id, chunk
+            chunk = []
+    if chunk:
+        yield last_id, chunk
+
+
+def _progress_callback(progress, namespace_id, doc_type):
+    if progress is None:
+        return None
+    return lambda last_id: progress.update(namespace_id, doc_type, last_id)
+
+
+def _bulk_index_chunks(chunks, bulk_index, on_indexed=None,
+                       pool_size=MAX_CONCURRENT_BULK_REQUESTS):
+    """
+    Send each chunk yielded by `chunks` (see _encoded_chunks) to `bulk_index`,
+    with at most `pool_size` requests in flight. The next chunk is only read
+    (and encoded) once a request slot is free, so at most pool_size + 1
+    chunks are held in memory.
+
+    Requests can complete out of order, so `on_indexed` is called with the
+    last id of a chunk once it and every chunk before it have been indexed.
+
+    Returns
+    -------
+    int
+        The number of documents indexed.
+
+    """
+    pool = Pool(pool_size)
+    in_flight = []
+    done = set()
+    counts = []
+    errors = []
+
+    def index_chunk(last_id, operations):
+        try:
+            counts.append(bulk_index(operations))
+        except Exception as e:
+            errors.append(e)
+            return
+        done.add(last_id)
+        while in_flight and in_flight[0] in done:
+            indexed_id = in_flight.pop(0)
+            done.discard(indexed_id)
+            if on_indexed is not None:
+                on_indexed(indexed_id)
+
+    for last_id, operations in chunks:
+        if errors:
+            break
+        in_flight.append(last_id)
+        pool.spawn(index_chunk, last_id, operations)
+    pool.join()
+
+    if errors:
+        log.error('Bulk index failure', error=errors[0])
+        raise SearchEngineError(errors[0])
+    return sum(counts)
+
+
 def delete_index(namespace_id, namespace_public_id):
     """ Delete a namespace index. """
-    search_engine = NamespaceSearchEngine(namespace_public_id)
+    search_engine = get_search_engine(namespace_public_id)
     search_engine.delete_index()
 
     log.info('Deleted namespace index', namespace_id=namespace_id,
@@ -0,0 +1,85 @@
+"""
+Compaction of the transaction log.
+
+Delta sync only ever returns the most recent change to each object, so once an
+object has a newer transaction, the older ones are dead weight: a client
+catching up from a stale cursor still has to page through them. Compaction
+soft-deletes superseded transactions (by setting `deleted_at`, which the
+delta queries already filter on) and drops their snapshots. Afterwards the
+live rows of a namespace are exactly its latest transaction per object.
+
+This is safe to run concurrently with delta requests: a superseded row always
+has a newer row for the same object after it, which any client that hasn't
+seen the superseded row will get instead.
+
+"""
+from datetime import datetime
+
+from sqlalchemy import asc
+
+from inbox.models import Transaction
+from inbox.log import get_logger
+log = get_logger()
+
+# Number of transactions to scan per query.
+SCAN_CHUNK_SIZE = 5000
+# Number of transactions to mark as superseded per UPDATE.
+UPDATE_CHUNK_SIZE = 500
+
+
+def compact_transaction_log(namespace_id, db_session,
+                            scan_chunk_size=SCAN_CHUNK_SIZE,
+                            update_chunk_size=UPDATE_CHUNK_SIZE):
+    """
+    Soft-delete the superseded transactions of a namespace.
+
+    Only (id, object_type, record_id) is loaded for each live transaction,
+    never the snapshot. Since previously compacted rows aren't scanned again,
+    the cost of a pass is proportional to the number of objects in the
+    namespace plus the number of transactions since the last pass.
+
+    Returns
+    -------
+    int
+        The number of transactions marked as superseded.
+
+    """
+    latest = {}
+    superseded = []
+    compacted = 0
+    pointer = 0
+    while True:
+        rows = db_session.query(Transaction.id, Transaction.object_type,
+                                Transaction.record_id). \
+            filter(Transaction.namespace_id == namespace_id,
+                   Transaction.deleted_at.is_(None),
+                   Transaction.id > pointer). \
+            order_by(asc(Transaction.id)).limit(scan_chunk_size).all()
+        if not rows:
+            break
+        for id_, object_type, record_id in rows:
+            previous = latest.get((object_type, record_id))
+            if previous is not None:
+                superseded.append(previous)
+            latest[(object_type, record_id)] = id_
+        pointer = rows[-1][0]
+
+        while len(superseded) >= update_chunk_size:
+            compacted += _mark_superseded(
+                superseded[:update_chunk_size], db_session)
+            superseded = superseded[update_chunk_size:]
+
+    if superseded:
+        compacted += _mark_superseded(superseded, db_session)
+    log.info('compacted transaction log', namespace_id=namespace_id,
+             compacted=compacted, live=len(latest))
+    return compacted
+
+
+def _mark_superseded(transaction_ids, db_session):
+    db_session.query(Transaction). \
+        filter(Transaction.id.in_(transaction_ids)). \
+        update({'deleted_at': datetime.utcnow(), 'snapshot': None},
+               synchronize_session=False)
+    db_session.commit()
+    return len(transaction_ids)
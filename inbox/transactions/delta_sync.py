@@ -1,11 +1,79 @@
 import time
-import gevent
+from collections import OrderedDict
 from datetime import datetime
 
 from sqlalchemy import asc, desc
 from inbox.api.kellogs import APIEncoder
+from inbox.config import config
 from inbox.models import Transaction
 from inbox.models.session import session_scope
+from inbox.transactions.notifications import get_notifier
+from inbox.transactions.snapshots import fill_snapshots
+
+# Maximum number of cursors remembered by `cursor_cache`.
+CURSOR_CACHE_SIZE = config.get('DELTA_CURSOR_CACHE_SIZE', 10000)
+
+
+class CursorCache(object):
+    """
+    A bounded LRU mapping of (namespace_id, cursor) to transaction id.
+
+    The mapping from a transaction's public_id to its id never changes, so
+    entries never go stale. Clients usually pass back the last cursor we gave
+    them, so we remember the cursors of the transactions we return, which
+    makes resolving them free for clients that poll frequently.
+
+    """
+    def __init__(self, max_size=CURSOR_CACHE_SIZE):
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, namespace_id, cursor):
+        key = (namespace_id, cursor)
+        transaction_id = self._cache.pop(key, None)
+        if transaction_id is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._cache[key] = transaction_id
+        return transaction_id
+
+    def put(self, namespace_id, cursor, transaction_id):
+        key = (namespace_id, cursor)
+        self._cache.pop(key, None)
+        self._cache[key] = transaction_id
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+
+cursor_cache = CursorCache()
+
+
+def get_transaction_id_for_cursor(namespace_id, cursor, db_session):
+    """
+    Resolve a cursor (the public_id of a transaction, or '0' for the start of
+    the log) to the id of that transaction.
+
+    Returns
+    -------
+    int or None
+        None if there's no such transaction in the namespace.
+
+    """
+    if cursor == '0':
+        return 0
+    transaction_id = cursor_cache.get(namespace_id, cursor)
+    if transaction_id is not None:
+        return transaction_id
+    query_result = db_session.query(Transaction.id). \
+        filter(Transaction.public_id == cursor,
+               Transaction.namespace_id == namespace_id).first()
+    if query_result is None:
+        return None
+    cursor_cache.put(namespace_id, cursor, query_result[0])
+    return query_result[0]
 
 
 def get_transaction_cursor_near_timestamp(namespace_id, timestamp, db_session):
@@ -60,12 +128,16 @@ def get_transaction_cursor_near_timestamp(namespace_id, timestamp, db_session):
         # to signal 'process from the start of the log'.
         return '0'
 
+    # The client is going to pass this right back to us.
+    cursor_cache.put(namespace_id, latest_transaction.public_id,
+                     latest_transaction.id)
     return latest_transaction.public_id
 
 
 def format_transactions_after_pointer(namespace_id, pointer, db_session,
                                       result_limit, format_transaction_fn,
-                                      exclude_types=None):
+                                      exclude_types=None, shard=None,
+                                      max_pointer=None):
     """
     Return a pair (deltas, new_pointer), where deltas is a list of change
     events, represented as dictionaries:
@@ -93,22 +165,39 @@ def format_transactions_after_pointer(namespace_id, pointer, db_session,
         Function that defines how to format the transactions.
     exclude_types: list, optional
         If given, don't include transactions for these types of objects.
+    shard: (int, int), optional
+        If given as (shard_id, num_shards), only include transactions of
+        namespaces whose id is shard_id modulo num_shards.
+    max_pointer: int, optional
+        If given, only include transactions up to this id.
 
     """
-    filters = [Transaction.id > pointer]
+    # Superseded transactions are soft-deleted by compaction (see
+    # inbox.transactions.compaction), so exclude them.
+    filters = [Transaction.id > pointer, Transaction.deleted_at.is_(None)]
 
     if namespace_id is not None:
-        # deleted_at condition included to allow this query to be satisfied via
+        # The deleted_at condition also allows this query to be satisfied via
         # the legacy index on (namespace_id, deleted_at) for performance.
         # TODO(emfree): Remove this hack and ensure that the right index (on
         # namespace_id only) exists.
         filters.append(Transaction.namespace_id == namespace_id)
-        filters.append(Transaction.deleted_at.is_(None))
 
     if exclude_types is not None:
         filters.append(~Transaction.object_type.in_(exclude_types))
 
-    transactions = db_session.query(Transaction). \
+    if shard is not None:
+        shard_id, num_shards = shard
+        filters.append(Transaction.namespace_id % num_shards == shard_id)
+
+    if max_pointer is not None:
+        filters.append(Transaction.id <= max_pointer)
+
+    # First find out which transactions we're going to return without loading
+    # their snapshots, which can be large and which we'd otherwise decode only
+    # to throw away for every superseded change.
+    rows = db_session.query(Transaction.id, Transaction.object_type,
+                            Transaction.record_id). \
         order_by(asc(Transaction.id)). \
         filter(*filters).limit(result_limit)
 
@@ -116,49 +205,58 @@ def format_transactions_after_pointer(namespace_id, pointer, db_session,
         # Need to explicitly specify the index hint because the query planner
         # is dumb as nails and otherwise would make this super slow for some
         # values of namespace_id and pointer.
-        transactions = transactions. \
-            with_hint(Transaction, 'USE INDEX (namespace_id_deleted_at)')
+        rows = rows.with_hint(Transaction,
+                              'USE INDEX (namespace_id_deleted_at)')
 
-    transactions = transactions.all()
+    rows = rows.all()
 
-    if not transactions:
+    if not rows:
         return ([], pointer)
 
-    deltas = []
     # If there are multiple transactions for the same object, only publish the
     # most recent.
     # Note: Works as is even when we're querying across all namespaces (i.e.
     # namespace_id = None) because the object is identified by its id in
     # addition to type, and all objects are restricted to a single namespace.
-    object_identifiers = set()
-    for transaction in sorted(transactions, key=lambda trx: trx.id,
-                              reverse=True):
-        object_identifier = (transaction.object_type, transaction.record_id)
-        if object_identifier in object_identifiers:
-            continue
+    latest_ids = {}
+    for id_, object_type, record_id in rows:
+        latest_ids[(object_type, record_id)] = id_
 
-        object_identifiers.add(object_identifier)
+    transactions = db_session.query(Transaction). \
+        filter(Transaction.id.in_(latest_ids.values())). \
+        order_by(asc(Transaction.id)).all()
+    # Snapshots may not have been encoded yet if they're deferred.
+    fill_snapshots(transactions, db_session)
 
-        delta = format_transaction_fn(transaction)
-        if not delta:
+    deltas = []
+    for transaction in transactions:
+        if transaction.command != 'delete' and transaction.snapshot is None:
+            # The object has been deleted before its snapshot could be
+            # encoded, and the delete transaction comes later in the log.
             continue
+        delta = format_transaction_fn(transaction)
+        if delta:
+            deltas.append(delta)
+            cursor_cache.put(transaction.namespace_id, transaction.public_id,
+                             transaction.id)
 
-        deltas.append(delta)
-
-    return (list(reversed(deltas)), transactions[-1].id)
+    return (deltas, rows[-1][0])
 
 
 def streaming_change_generator(namespace_id, poll_interval, timeout,
                                transaction_pointer, exclude_types=None):
     """
-    Poll the transaction log for the given `namespace_id` until `timeout`
-    expires, and yield each time new entries are detected.
+    Check the transaction log for the given `namespace_id` until `timeout`
+    expires, and yield each time new entries are detected. The log is checked
+    whenever the namespace gets new transactions (see
+    inbox.transactions.notifications), and at least every `poll_interval`
+    seconds.
     Arguments
     ---------
     namespace_id: int
         Id of the namespace for which to check changes.
     poll_interval: float
-        How often to check for changes.
+        Maximum time between checks for changes.
     timeout: float
         How many seconds to allow the connection to remain open.
     transaction_pointer: int, optional
@@ -167,8 +265,10 @@ def streaming_change_generator(namespace_id, poll_interval, timeout,
 
     """
     encoder = APIEncoder()
+    notifier = get_notifier()
     start_time = time.time()
     while time.time() - start_time < timeout:
+        generation = notifier.generation(namespace_id)
         with session_scope() as db_session:
             deltas, new_pointer = format_transactions_after_pointer(
                 namespace_id, transaction_pointer, db_session, 100,
@@ -178,7 +278,9 @@ def streaming_change_generator(namespace_id, poll_interval, timeout,
             for delta in deltas:
                 yield encoder.cereal(delta) + '\n'
         else:
-            gevent.sleep(poll_interval)
+            remaining = timeout - (time.time() - start_time)
+            notifier.wait(namespace_id, generation,
+                          max(0, min(poll_interval, remaining)))
 
 
 def _format_transaction_for_delta_sync(transaction):
@@ -0,0 +1,149 @@
+"""
+Notifications of new transaction log entries.
+
+Rather than have every waiting delta request poll the transaction table,
+sessions announce the namespaces they've written transactions for when they
+commit, and waiting requests block until their namespace is announced. They
+still check the database every `poll_interval` seconds as a safety net.
+
+By default notifications are only delivered within the process they were
+published in, which means API requests still have to poll for changes made by
+sync processes (every second, as before). To deliver notifications across
+processes, set
+    "TRANSACTION_NOTIFICATION_BACKEND": "redis"
+in your config. Notifications are then published on a Redis pub/sub channel
+(using "REDIS_HOSTNAME" and "REDIS_PORT"), and each API process relays them to
+its waiting requests over a single subscription.
+
+"""
+from collections import defaultdict
+
+import gevent
+from gevent.event import Event
+
+from inbox.config import config
+from inbox.log import get_logger
+log = get_logger()
+
+REDIS_CHANNEL = 'transaction_notifications'
+# How long to wait for a notification before checking the transaction log
+# anyway.
+LOCAL_POLL_INTERVAL = 1
+REDIS_POLL_INTERVAL = 30
+# How long to wait before resubscribing after losing the Redis connection.
+RESUBSCRIBE_INTERVAL = 5
+
+
+class TransactionNotifier(object):
+    """
+    Delivers notifications within this process.
+
+    Each namespace has a generation counter, incremented on every
+    notification. Waiters grab the current generation *before* checking the
+    transaction log, and then wait for it to change, so that a notification
+    that comes in between the two isn't missed.
+
+    """
+    poll_interval = LOCAL_POLL_INTERVAL
+
+    def __init__(self):
+        self._generations = defaultdict(int)
+        self._events = {}
+
+    def generation(self, namespace_id):
+        return self._generations[namespace_id]
+
+    def publish(self, namespace_ids):
+        self._notify(namespace_ids)
+
+    def _notify(self, namespace_ids):
+        for namespace_id in namespace_ids:
+            self._generations[namespace_id] += 1
+            event = self._events.pop(namespace_id, None)
+            if event is not None:
+                event.set()
+
+    def wait(self, namespace_id, generation, timeout=None):
+        """
+        Block until the generation of `namespace_id` has moved past
+        `generation`, or until `timeout` seconds have passed.
+
+        Returns
+        -------
+        bool
+            Whether there was a notification.
+
+        """
+        if timeout is None:
+            timeout = self.poll_interval
+        if self._generations[namespace_id] != generation:
+            return True
+        if namespace_id not in self._events:
+            self._events[namespace_id] = Event()
+        return self._events[namespace_id].wait(timeout)
+
+
+class RedisTransactionNotifier(TransactionNotifier):
+    """
+    Publishes notifications on a Redis channel, and relays the notifications
+    published by any process to waiters in this one.
+
+    """
+    poll_interval = config.get('REDIS_NOTIFICATION_POLL_INTERVAL',
+                               REDIS_POLL_INTERVAL)
+
+    def __init__(self, host, port):
+        from redis import StrictRedis
+        TransactionNotifier.__init__(self)
+        self.client = StrictRedis(host, port)
+        self._listener = None
+
+    def publish(self, namespace_ids):
+        self._notify(namespace_ids)
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for namespace_id in namespace_ids:
+                pipe.publish(REDIS_CHANNEL, namespace_id)
+            pipe.execute()
+        except Exception:
+            # Waiters will pick up the changes the next time they poll.
+            log.error('Error publishing transaction notifications',
+                      exc_info=True)
+
+    def wait(self, namespace_id, generation, timeout=None):
+        if self._listener is None or self._listener.ready():
+            self._listener = gevent.spawn(self._listen)
+        return TransactionNotifier.wait(self, namespace_id, generation,
+                                        timeout)
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(REDIS_CHANNEL)
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self._notify([int(message['data'])])
+            except Exception:
+                log.error('Error listening for transaction notifications',
+                          exc_info=True)
+            gevent.sleep(RESUBSCRIBE_INTERVAL)
+
+
+_notifier = None
+
+
+def get_notifier():
+    """The process-wide notifier, as configured."""
+    global _notifier
+    if _notifier is None:
+        backend = config.get('TRANSACTION_NOTIFICATION_BACKEND', 'local')
+        if backend == 'redis':
+            _notifier = RedisTransactionNotifier(
+                str(config.get_required('REDIS_HOSTNAME')),
+                int(config.get_required('REDIS_PORT')))
+        else:
+            assert backend == 'local', \
+                'Unknown TRANSACTION_NOTIFICATION_BACKEND {}'.format(backend)
+            _notifier = TransactionNotifier()
+    return _notifier
@@ -1,19 +1,29 @@
 import datetime
+import json
 from collections import defaultdict
 import calendar
 
+import gevent
 from gevent import Greenlet, sleep
+from gevent.queue import Queue
+from sqlalchemy import asc, func
 
+from inbox.config import config
 from inbox.log import get_logger
 log = get_logger()
-from inbox.api.kellogs import APIEncoder
 
+from inbox.models import Transaction
 from inbox.models.session import session_scope
 from inbox.models.util import transaction_objects
 from inbox.models.search import SearchIndexCursor
-from inbox.search.adaptor import NamespaceSearchEngine
+from inbox.search.adaptor import get_search_engine, index_state
 from inbox.transactions.delta_sync import format_transactions_after_pointer
 
+# Number of workers to split the transaction log between.
+NUM_SHARDS = config.get('SEARCH_INDEX_SHARDS', 1)
+# Maximum size of the documents sent in a single bulk request.
+MAX_BATCH_BYTES = config.get('SEARCH_INDEX_BATCH_BYTES', 5 * 1024 * 1024)
+
 
 class SearchIndexService(Greenlet):
     """
@@ -21,14 +31,18 @@ class SearchIndexService(Greenlet):
     (inserts, updates, deletes) for all namespaces and perform the
     corresponding Elasticsearch index operations.
 
+    The transaction log is split into `num_shards` shards by namespace id,
+    and each shard is indexed by its own SearchIndexShard, with its own
+    persisted cursor.
+
     """
-    def __init__(self, poll_interval=30, chunk_size=100):
+    def __init__(self, poll_interval=30, chunk_size=1000, num_shards=None,
+                 max_batch_bytes=MAX_BATCH_BYTES):
         self.poll_interval = poll_interval
         self.chunk_size = chunk_size
-
-        self.encoder = APIEncoder()
-
-        self.transaction_pointer = None
+        self.num_shards = num_shards or NUM_SHARDS
+        self.max_batch_bytes = max_batch_bytes
+        self.shards = []
 
         self.log = log.new(component='search-index')
         Greenlet.__init__(self)
@@ -38,41 +52,160 @@ class SearchIndexService(Greenlet):
         Index into Elasticsearch the threads, messages of all namespaces.
 
         """
-        # Indexing is namespace agnostic.
-        # Note that although this means we do not restrict the Transaction
-        # table query (via the format_transactions_after_pointer() call below)
-        # to a namespace, since we pass a `result_limit` (== chunk_size)
-        # argument, the query should still be performant.
-        namespace_id = None
+        pointers = self.load_pointers()
+        self.log.info('Starting search-index service',
+                      transaction_pointers=pointers)
+        self.shards = [SearchIndexShard(shard_id, self.num_shards,
+                                        pointers[shard_id],
+                                        self.poll_interval, self.chunk_size,
+                                        self.max_batch_bytes)
+                       for shard_id in range(self.num_shards)]
+        workers = [gevent.spawn(shard.run) for shard in self.shards]
+        try:
+            gevent.joinall(workers, raise_error=True)
+        finally:
+            gevent.killall(workers)
+
+    def load_pointers(self):
+        """
+        Return the persisted transaction pointer of each shard.
+
+        If the number of shards has changed since the cursors were saved,
+        namespaces have moved between shards, so every shard starts over from
+        the earliest cursor (reindexing documents is idempotent).
+
+        """
+        with session_scope() as db_session:
+            cursors = {cursor.shard_id: cursor for cursor in
+                       db_session.query(SearchIndexCursor)}
+            pointers = {shard_id: cursor.transaction_id or 0
+                        for shard_id, cursor in cursors.iteritems()}
+            if sorted(pointers) == range(self.num_shards):
+                return pointers
+
+            # Update the cursors of the shards that are kept in place, since
+            # shard ids are unique, and the session would insert new cursors
+            # before deleting old ones.
+            start = min(pointers.values()) if pointers else 0
+            for shard_id, cursor in cursors.iteritems():
+                if shard_id >= self.num_shards:
+                    db_session.delete(cursor)
+            for shard_id in range(self.num_shards):
+                cursor = cursors.get(shard_id)
+                if cursor is None:
+                    cursor = SearchIndexCursor(shard_id=shard_id)
+                    db_session.add(cursor)
+                cursor.transaction_id = start or None
+            db_session.commit()
+        return {shard_id: start for shard_id in range(self.num_shards)}
+
+    def lag(self):
+        """The number of seconds each shard is behind the transaction
+        log."""
+        return {shard.shard_id: shard.lag for shard in self.shards}
+
+
+class SearchIndexShard(object):
+    """
+    Index the transactions of the namespaces whose id is `shard_id` modulo
+    `num_shards`.
+
+    Reading transactions and indexing them are pipelined: the next chunk of
+    the transaction log is read while the current one is sent to
+    Elasticsearch. Documents are sent in bulk requests of at most
+    `max_batch_bytes`.
+
+    """
+    def __init__(self, shard_id, num_shards, transaction_pointer,
+                 poll_interval, chunk_size, max_batch_bytes):
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        self.max_batch_bytes = max_batch_bytes
+
+        # The last transaction read, and the last one indexed.
+        self.read_pointer = transaction_pointer
+        self.transaction_pointer = transaction_pointer
+        # How old the last indexed transaction was when it was indexed, in
+        # seconds; 0 when the shard is caught up.
+        self.lag = 0
 
         # Only index messages, threads.
         object_types = transaction_objects()
-        exclude_types = [api_name for model_name, api_name in
-                         object_types.iteritems() if model_name not in
-                         ['message', 'thread']]
+        self.exclude_types = [api_name for model_name, api_name in
+                              object_types.iteritems() if model_name not in
+                              ['message', 'thread']]
+
+        self._chunks = Queue(maxsize=1)
+        self.log = log.new(component='search-index', shard_id=shard_id)
+
+    def run(self):
+        reader = gevent.spawn(self._read)
+        writer = gevent.spawn(self._write)
+        try:
+            gevent.joinall([reader, writer], raise_error=True)
+        finally:
+            gevent.killall([reader, writer])
+
+    def _read(self):
+        while True:
+            chunk = self.read_chunk()
+            if chunk is None:
+                if self._chunks.empty():
+                    self.lag = 0
+                sleep(self.poll_interval)
+                continue
+            _, self.read_pointer, _ = chunk
+            # Blocks until the previous chunk has been indexed.
+            self._chunks.put(chunk)
 
-        with session_scope() as db_session:
-            pointer = db_session.query(SearchIndexCursor).first()
-            self.transaction_pointer = pointer.transaction_id if pointer else 0
+    def read_chunk(self):
+        """
+        Read the shard's next chunk of the transaction log, as a tuple
+        (deltas, new_pointer, created_at), where created_at is the time of
+        the new pointer's transaction. Returns None if there's nothing new.
 
-        self.log.info('Starting search-index service',
-                      transaction_pointer=self.transaction_pointer)
+        Indexing is namespace agnostic, and the shard condition can't use an
+        index, so reads are bounded to a window of the log after the pointer
+        of about a chunk's worth of transactions per shard. If none of them
+        are the shard's, the pointer moves to the end of the window anyway,
+        so that a quiet shard doesn't keep rescanning everything the other
+        shards index.
 
+        """
+        window = self.chunk_size * self.num_shards
+        with session_scope() as db_session:
+            window_end = db_session.query(Transaction.id). \
+                filter(Transaction.id > self.read_pointer). \
+                order_by(asc(Transaction.id)). \
+                offset(window - 1).limit(1).scalar()
+            if window_end is None:
+                window_end = db_session.query(
+                    func.max(Transaction.id)).scalar() or 0
+            if window_end <= self.read_pointer:
+                return None
+            deltas, new_pointer = format_transactions_after_pointer(
+                None, self.read_pointer, db_session, self.chunk_size,
+                _format_transaction_for_search, self.exclude_types,
+                shard=(self.shard_id, self.num_shards),
+                max_pointer=window_end)
+            if new_pointer == self.read_pointer:
+                new_pointer = window_end
+            created_at, = db_session.query(Transaction.created_at). \
+                filter(Transaction.id == new_pointer).one()
+        return deltas, new_pointer, created_at
+
+    def _write(self):
         while True:
-            with session_scope() as db_session:
-                deltas, new_pointer = format_transactions_after_pointer(
-                    namespace_id, self.transaction_pointer, db_session,
-                    self.chunk_size, _format_transaction_for_search,
-                    exclude_types)
-
-            # TODO[k]: We ideally want to index chunk_size at a time.
-            # This currently indexes <= chunk_size, and it varies each time.
-            if new_pointer is not None and \
-                    new_pointer != self.transaction_pointer:
+            deltas, new_pointer, created_at = self._chunks.get()
+            if deltas:
                 self.index(deltas)
-                self.update_pointer(new_pointer)
-            else:
-                sleep(self.poll_interval)
+            self.update_pointer(new_pointer)
+            self.lag = (datetime.datetime.utcnow() -
+                        created_at).total_seconds()
+            self.log.debug('indexed chunk', transaction_pointer=new_pointer,
+                           lag=self.lag)
 
     def index(self, objects):
         """
@@ -93,20 +226,23 @@ class SearchIndexService(Greenlet):
         self.log.info('namespaces to index count', count=len(namespace_map))
 
         for namespace_id in namespace_map:
-            engine = NamespaceSearchEngine(namespace_id)
+            engine = get_search_engine(namespace_id)
 
-            messages = namespace_map[namespace_id]['message']
-            message_count = engine.messages.bulk_index(messages) if messages \
-                else 0
+            message_count = 0
+            for batch in byte_batches(namespace_map[namespace_id]['message'],
+                                      self.max_batch_bytes):
+                message_count += engine.messages.bulk_index(batch)
 
-            threads = namespace_map[namespace_id]['thread']
-            thread_count = engine.threads.bulk_index(threads) if threads \
-                else 0
+            thread_count = 0
+            for batch in byte_batches(namespace_map[namespace_id]['thread'],
+                                      self.max_batch_bytes):
+                thread_count += engine.threads.bulk_index(batch)
 
             self.log.info('per-namespace index counts',
                           namespace_id=namespace_id,
                           message_count=message_count,
-                          thread_count=thread_count)
+                          thread_count=thread_count,
+                          admin_calls_avoided=index_state.admin_calls_avoided)
 
     def update_pointer(self, new_pointer):
         """
@@ -115,9 +251,10 @@ class SearchIndexService(Greenlet):
 
         """
         with session_scope() as db_session:
-            pointer = db_session.query(SearchIndexCursor).first()
+            pointer = db_session.query(SearchIndexCursor). \
+                filter(SearchIndexCursor.shard_id == self.shard_id).first()
             if pointer is None:
-                pointer = SearchIndexCursor()
+                pointer = SearchIndexCursor(shard_id=self.shard_id)
                 db_session.add(pointer)
 
             pointer.transaction_id = new_pointer
@@ -126,6 +263,27 @@ class SearchIndexService(Greenlet):
         self.transaction_pointer = new_pointer
 
 
+def byte_batches(operations, max_bytes):
+    """
+    Split a list of (op_type, object) index operations into lists whose
+    objects add up to at most `max_bytes` of JSON (but at least one
+    operation each).
+
+    """
+    batch = []
+    batch_bytes = 0
+    for operation in operations:
+        size = len(json.dumps(operation[1]))
+        if batch and batch_bytes + size > max_bytes:
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(operation)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
 def _format_transaction_for_search(transaction):
     # In order for Elasticsearch to do the right thing w.r.t
     # creating v/s. updating an index, the op_type must be set to
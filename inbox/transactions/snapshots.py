@@ -0,0 +1,150 @@
+"""
+Deferred encoding of transaction snapshots.
+
+By default, every transaction gets the API representation of its object
+(its snapshot) encoded as part of the flush that creates it. Encoding a
+single object can trigger a number of lazy loads -- a message's thread,
+events and attachments, or every message of a thread -- which adds up to a
+lot of queries per commit during initial sync. With
+    "DEFER_TRANSACTION_SNAPSHOTS": true
+in your config, transactions are instead created without a snapshot, and
+snapshots are encoded in bulk afterwards, using eager-loading queries:
+
+* by the TransactionSnapshotService (bin/transaction-snapshot-service), which
+  follows the transaction log, and
+* on demand, by delta sync, for any transactions it gets to first.
+
+Deferred snapshots reflect the state of the object when they're encoded
+rather than when the transaction was created. Since delta sync only ever
+returns the most recent change to an object, clients can't tell the
+difference.
+
+"""
+from collections import defaultdict
+
+from gevent import Greenlet, sleep
+from sqlalchemy import asc
+from sqlalchemy.orm import joinedload, subqueryload
+
+from inbox.api.kellogs import encode
+from inbox.models import Transaction
+from inbox.models.mixins import HasRevisions
+from inbox.models.session import session_scope
+from inbox.log import get_logger
+log = get_logger()
+
+# Maximum number of objects loaded per query.
+LOAD_CHUNK_SIZE = 100
+
+# The relationships encode() uses for each type of object, so that they can
+# be loaded for a whole batch of objects up front.
+EAGER_LOADS = {
+    'message': lambda: [joinedload('namespace'), joinedload('thread'),
+                        subqueryload('events'),
+                        subqueryload('parts').joinedload('block')],
+    'thread': lambda: [joinedload('namespace'), subqueryload('messages'),
+                       subqueryload('tagitems').joinedload('tag')],
+    'file': lambda: [joinedload('namespace'),
+                     subqueryload('parts').joinedload('message')],
+    'event': lambda: [joinedload('namespace'), joinedload('calendar'),
+                      joinedload('message')],
+}
+
+
+def needs_snapshot(transaction):
+    return (transaction.snapshot is None and
+            transaction.command != 'delete' and
+            transaction.deleted_at is None)
+
+
+def _model_classes():
+    # Subclasses like RecurringEvent share their parent's API_OBJECT_NAME;
+    # querying the base class loads objects of every subclass.
+    classes = HasRevisions.__subclasses__()
+    return {cls.API_OBJECT_NAME: cls for cls in classes
+            if not any(issubclass(cls, other) for other in classes
+                       if other is not cls)}
+
+
+def fill_snapshots(transactions, db_session):
+    """
+    Encode the snapshots of those of `transactions` that don't have one yet.
+    The changes are flushed with the session.
+
+    Returns
+    -------
+    int
+        The number of snapshots encoded.
+
+    """
+    pending = defaultdict(list)
+    for transaction in transactions:
+        if needs_snapshot(transaction):
+            pending[transaction.object_type].append(transaction)
+    if not pending:
+        return 0
+
+    model_classes = _model_classes()
+    filled = 0
+    for object_type, type_transactions in pending.iteritems():
+        cls = model_classes[object_type]
+        options = EAGER_LOADS.get(object_type, lambda: [])()
+        record_ids = sorted({t.record_id for t in type_transactions})
+        objects = {}
+        for i in range(0, len(record_ids), LOAD_CHUNK_SIZE):
+            chunk = record_ids[i:i + LOAD_CHUNK_SIZE]
+            for obj in db_session.query(cls).filter(cls.id.in_(chunk)). \
+                    options(*options):
+                objects[obj.id] = obj
+        for transaction in type_transactions:
+            obj = objects.get(transaction.record_id)
+            if obj is None:
+                # The object has been deleted since, so its delete
+                # transaction supersedes this one. (Delta sync leaves this
+                # one out, even if the delete isn't on the same page.)
+                continue
+            transaction.snapshot = encode(obj)
+            filled += 1
+    return filled
+
+
+class TransactionSnapshotService(Greenlet):
+    """
+    Follow the transaction log and encode the snapshots of new transactions,
+    chunk_size at a time.
+
+    Transactions that commit out of id order may be passed over; delta sync
+    encodes their snapshots when it reads them.
+
+    """
+    def __init__(self, poll_interval=1, chunk_size=500):
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        self.transaction_pointer = 0
+        self.log = log.new(component='transaction-snapshots')
+        Greenlet.__init__(self)
+
+    def _run(self):
+        self.log.info('Starting transaction snapshot service')
+        while True:
+            if not self.process_chunk():
+                sleep(self.poll_interval)
+
+    def process_chunk(self):
+        """Encode the snapshots of the next chunk of pending transactions.
+        Returns the number of transactions processed."""
+        with session_scope(versioned=False) as db_session:
+            transactions = db_session.query(Transaction). \
+                filter(Transaction.id > self.transaction_pointer,
+                       Transaction.snapshot.is_(None),
+                       Transaction.command != 'delete',
+                       Transaction.deleted_at.is_(None)). \
+                order_by(asc(Transaction.id)).limit(self.chunk_size).all()
+            if not transactions:
+                return 0
+            filled = fill_snapshots(transactions, db_session)
+            db_session.commit()
+            self.transaction_pointer = transactions[-1].id
+        self.log.info('Encoded transaction snapshots', filled=filled,
+                      transaction_pointer=self.transaction_pointer)
+        return len(transactions)
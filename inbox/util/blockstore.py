@@ -0,0 +1,391 @@
+"""
+Content-addressed storage for message bodies and parts.
+
+Blocks are immutable and keyed by the sha256 of their contents, which makes
+them easy to cache and means that storing the same data twice is a no-op.
+
+Three backends are available:
+
+* `FilesystemBlockStore`: files under "MSG_PARTS_DIRECTORY" (the default).
+* `S3BlockStore`: an S3 (or S3-compatible) bucket. Enable by defining these in
+  your config:
+      "STORE_MESSAGES_ON_S3": true,
+      "AWS_ACCESS_KEY_ID": "<YOUR_AWS_ACCESS_KEY>",
+      "AWS_SECRET_ACCESS_KEY": "<YOUR_AWS_SECRET_KEY>",
+      "MESSAGE_STORE_BUCKET_NAME": "<YOUR_BUCKET_NAME>",
+  and optionally "MESSAGE_STORE_S3_HOST" for S3-compatible services.
+* `MemoryBlockStore`: a dict, for tests.
+
+`get_blockstore()` returns the configured backend wrapped in a
+`CachingBlockStore`, which keeps recently used blocks in memory (up to
+"BLOCK_CACHE_MAX_BYTES") and verifies the hash of a fraction
+("BLOCK_VERIFY_SAMPLE_RATE") of the blocks it reads from the backend.
+
+"""
+import os
+import random
+from collections import OrderedDict
+from hashlib import sha256
+
+from gevent.pool import Pool
+
+from inbox.config import config
+from inbox.util.file import mkdirp, remove_file
+from inbox.log import get_logger
+log = get_logger()
+
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Size of the chunks returned by `BlockStore.stream`.
+STREAM_CHUNK_SIZE = 64 * 1024
+# How many blocks are checked concurrently by `S3BlockStore.exists_many`.
+S3_EXISTENCE_CHECK_CONCURRENCY = 10
+# How many hashes `S3BlockStore` remembers as being present in the bucket.
+S3_KNOWN_HASHES_MAX = 100000
+
+
+class BlockStore(object):
+    """Interface for block storage backends. Blocks are passed around as
+    encoded byte strings."""
+
+    def get(self, data_sha256):
+        """Return the data for the given hash, or None if there is none."""
+        raise NotImplementedError
+
+    def stream(self, data_sha256, start=0, end=None,
+               chunk_size=STREAM_CHUNK_SIZE):
+        """Return an iterator over the bytes [start, end) of the data for the
+        given hash, in chunks of at most `chunk_size` bytes, or None if there
+        is no such data. Backends that can read ranges without loading the
+        whole block into memory should override this."""
+        data = self.get(data_sha256)
+        if data is None:
+            return None
+        return _chunks(data[start:end], chunk_size)
+
+    def put(self, data_sha256, data):
+        raise NotImplementedError
+
+    def delete(self, data_sha256):
+        raise NotImplementedError
+
+    def exists_many(self, hashes):
+        """Return the subset of `hashes` that are present in the store."""
+        return {h for h in hashes if self.get(h) is not None}
+
+    def prepare_put(self, hashes):
+        """Hint that blocks with the given hashes are about to be stored.
+        Backends where checking for existing blocks is expensive can check
+        them all at once here instead of one by one in `put`."""
+        pass
+
+
+class MemoryBlockStore(BlockStore):
+    def __init__(self):
+        self.blocks = {}
+
+    def get(self, data_sha256):
+        return self.blocks.get(data_sha256)
+
+    def put(self, data_sha256, data):
+        self.blocks[data_sha256] = data
+
+    def delete(self, data_sha256):
+        self.blocks.pop(data_sha256, None)
+
+    def exists_many(self, hashes):
+        return {h for h in hashes if h in self.blocks}
+
+
+class FilesystemBlockStore(BlockStore):
+    def __init__(self, root):
+        self.root = root
+
+    def _directory(self, data_sha256):
+        # Nest it 6 items deep so we don't have folders with too many files.
+        h = data_sha256
+        return os.path.join(self.root, h[0], h[1], h[2], h[3], h[4], h[5])
+
+    def _path(self, data_sha256):
+        return os.path.join(self._directory(data_sha256), data_sha256)
+
+    def get(self, data_sha256):
+        try:
+            with open(self._path(data_sha256), 'rb') as f:
+                return f.read()
+        except Exception:
+            log.error('No data for hash {0}'.format(data_sha256))
+            # XXX should this instead be empty bytes?
+            return None
+
+    def stream(self, data_sha256, start=0, end=None,
+               chunk_size=STREAM_CHUNK_SIZE):
+        try:
+            f = open(self._path(data_sha256), 'rb')
+        except IOError:
+            log.error('No data for hash {0}'.format(data_sha256))
+            return None
+        return _file_chunks(f, start, end, chunk_size)
+
+    def put(self, data_sha256, data):
+        mkdirp(self._directory(data_sha256))
+        with open(self._path(data_sha256), 'wb') as f:
+            f.write(data)
+
+    def delete(self, data_sha256):
+        remove_file(self._path(data_sha256))
+
+    def exists_many(self, hashes):
+        return {h for h in hashes if os.path.exists(self._path(h))}
+
+
+class S3BlockStore(BlockStore):
+    """
+    Blocks stored in an S3 bucket, keyed by hash.
+
+    The connection is created once per store (boto pools the underlying HTTP
+    connections), and hashes known to be in the bucket are remembered so that
+    storing a block we've already seen doesn't cost a round trip. Hashes
+    `exists_many` found missing are remembered until they're stored, so that
+    storing a new block doesn't check for it again.
+
+    """
+    def __init__(self, access_key_id, secret_access_key, bucket_name,
+                 host=None):
+        from boto.s3.connection import S3Connection
+        kwargs = {'host': host} if host else {}
+        self.conn = S3Connection(access_key_id, secret_access_key, **kwargs)
+        self.bucket = self.conn.get_bucket(bucket_name, validate=False)
+        self._known = OrderedDict()
+        self._missing = OrderedDict()
+
+    def _remember(self, data_sha256):
+        self._missing.pop(data_sha256, None)
+        self._known[data_sha256] = True
+        if len(self._known) > S3_KNOWN_HASHES_MAX:
+            self._known.popitem(last=False)
+
+    def _remember_missing(self, data_sha256):
+        self._missing[data_sha256] = True
+        if len(self._missing) > S3_KNOWN_HASHES_MAX:
+            self._missing.popitem(last=False)
+
+    def get(self, data_sha256):
+        data_obj = self.bucket.get_key(data_sha256)
+        if data_obj is None:
+            log.error('No data for hash {0}'.format(data_sha256))
+            return None
+        self._remember(data_sha256)
+        return data_obj.get_contents_as_string()
+
+    def stream(self, data_sha256, start=0, end=None,
+               chunk_size=STREAM_CHUNK_SIZE):
+        data_obj = self.bucket.get_key(data_sha256)
+        if data_obj is None:
+            log.error('No data for hash {0}'.format(data_sha256))
+            return None
+        byte_range = 'bytes={}-{}'.format(start,
+                                          '' if end is None else end - 1)
+        data_obj.open_read(headers={'Range': byte_range})
+        return _key_chunks(data_obj, chunk_size)
+
+    def put(self, data_sha256, data):
+        if data_sha256 in self._known:
+            return
+        if data_sha256 not in self._missing and \
+                self.bucket.get_key(data_sha256) is not None:
+            self._remember(data_sha256)
+            return
+        from boto.s3.key import Key
+        data_obj = Key(self.bucket)
+        data_obj.key = data_sha256
+        data_obj.set_contents_from_string(data)
+        self._remember(data_sha256)
+
+    def delete(self, data_sha256):
+        # TODO: blocks may be shared between messages, so this needs
+        # reference counting before we can actually delete anything.
+        pass
+
+    def exists_many(self, hashes):
+        """Check the given hashes concurrently. Hashes found are remembered,
+        so that a subsequent `put` of those blocks is free, and so are hashes
+        not found, so that a `put` of those uploads without checking again."""
+        unknown = [h for h in set(hashes) if h not in self._known]
+        pool = Pool(S3_EXISTENCE_CHECK_CONCURRENCY)
+        for h, data_obj in zip(unknown, pool.imap(self.bucket.get_key,
+                                                  unknown)):
+            if data_obj is not None:
+                self._remember(h)
+            else:
+                self._remember_missing(h)
+        return {h for h in hashes if h in self._known}
+
+    def prepare_put(self, hashes):
+        self.exists_many(hashes)
+
+
+class CachingBlockStore(BlockStore):
+    """
+    Wraps another store with a size-capped LRU read cache.
+
+    Since blocks are immutable, cached entries never go stale. Data read from
+    the underlying store is checked against its hash with probability
+    `verify_sample_rate`; data served from the cache was either checked or
+    written by us, and isn't checked again.
+
+    """
+    def __init__(self, store, max_bytes=DEFAULT_CACHE_MAX_BYTES,
+                 verify_sample_rate=1.):
+        self.store = store
+        self.max_bytes = max_bytes
+        self.verify_sample_rate = verify_sample_rate
+        self._cache = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, data_sha256):
+        data = self._cache.pop(data_sha256, None)
+        if data is not None:
+            # Move to the most recently used end.
+            self._cache[data_sha256] = data
+            self.hits += 1
+            return data
+        self.misses += 1
+        data = self.store.get(data_sha256)
+        if data is None:
+            return None
+        if random.random() < self.verify_sample_rate:
+            assert sha256(data).hexdigest() == data_sha256, \
+                "Returned data doesn't match stored hash!"
+        self._add(data_sha256, data)
+        return data
+
+    def stream(self, data_sha256, start=0, end=None,
+               chunk_size=STREAM_CHUNK_SIZE):
+        """Stream from the cache if possible, otherwise from the underlying
+        store without caching (streamed blocks are typically large
+        attachments). Only complete blocks can be verified."""
+        data = self._cache.get(data_sha256)
+        if data is not None:
+            self.hits += 1
+            return _chunks(data[start:end], chunk_size)
+        self.misses += 1
+        chunks = self.store.stream(data_sha256, start, end, chunk_size)
+        if chunks is not None and start == 0 and end is None and \
+                random.random() < self.verify_sample_rate:
+            chunks = _verified_chunks(chunks, data_sha256)
+        return chunks
+
+    def put(self, data_sha256, data):
+        self.store.put(data_sha256, data)
+        self._add(data_sha256, data)
+
+    def delete(self, data_sha256):
+        self._discard(data_sha256)
+        self.store.delete(data_sha256)
+
+    def exists_many(self, hashes):
+        cached = {h for h in hashes if h in self._cache}
+        return cached | self.store.exists_many(
+            [h for h in hashes if h not in cached])
+
+    def prepare_put(self, hashes):
+        self.store.prepare_put(hashes)
+
+    def _add(self, data_sha256, data):
+        if len(data) > self.max_bytes:
+            return
+        self._discard(data_sha256)
+        self._cache[data_sha256] = data
+        self.cached_bytes += len(data)
+        while self.cached_bytes > self.max_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self.cached_bytes -= len(evicted)
+
+    def _discard(self, data_sha256):
+        data = self._cache.pop(data_sha256, None)
+        if data is not None:
+            self.cached_bytes -= len(data)
+
+
+def _chunks(data, chunk_size):
+    for i in range(0, len(data), chunk_size):
+        yield data[i:i + chunk_size]
+
+
+def _file_chunks(f, start, end, chunk_size):
+    with f:
+        f.seek(start)
+        remaining = None if end is None else end - start
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else
+                           min(chunk_size, remaining))
+            if not chunk:
+                return
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+def _key_chunks(data_obj, chunk_size):
+    try:
+        while True:
+            chunk = data_obj.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        data_obj.close()
+
+
+def _verified_chunks(chunks, data_sha256):
+    """Pass `chunks` through while hashing them. The last chunk is held back
+    until the hash has been checked, so that corrupt data is never returned
+    in full."""
+    hasher = sha256()
+    previous = None
+    for chunk in chunks:
+        hasher.update(chunk)
+        if previous is not None:
+            yield previous
+        previous = chunk
+    assert hasher.hexdigest() == data_sha256, \
+        "Returned data doesn't match stored hash!"
+    if previous is not None:
+        yield previous
+
+
+_blockstore = None
+
+
+def get_blockstore():
+    """The process-wide block store, as configured."""
+    global _blockstore
+    if _blockstore is None:
+        if config.get('STORE_MESSAGES_ON_S3', None):
+            # TODO: store AWS credentials in a better way.
+            assert 'AWS_ACCESS_KEY_ID' in config, "Need AWS key!"
+            assert 'AWS_SECRET_ACCESS_KEY' in config, "Need AWS secret!"
+            assert 'MESSAGE_STORE_BUCKET_NAME' in config, \
+                "Need bucket name to store message data!"
+            store = S3BlockStore(config.get('AWS_ACCESS_KEY_ID'),
+                                 config.get('AWS_SECRET_ACCESS_KEY'),
+                                 config.get('MESSAGE_STORE_BUCKET_NAME'),
+                                 config.get('MESSAGE_STORE_S3_HOST'))
+        else:
+            store = FilesystemBlockStore(
+                config.get_required('MSG_PARTS_DIRECTORY'))
+        _blockstore = CachingBlockStore(
+            store,
+            max_bytes=config.get('BLOCK_CACHE_MAX_BYTES',
+                                 DEFAULT_CACHE_MAX_BYTES),
+            verify_sample_rate=config.get('BLOCK_VERIFY_SAMPLE_RATE', 1.))
+    return _blockstore
+
+
+def set_blockstore(store):
+    """Replace the process-wide block store (e.g. with a MemoryBlockStore in
+    tests)."""
+    global _blockstore
+    _blockstore = store
@@ -0,0 +1,304 @@
+"""
+MIME parsing for synced messages, independent of the ORM.
+
+`parse_message` turns raw message bytes into a plain, picklable
+`ParsedMessage`, which `Message.create_from_synced` then materializes into
+Message, Part and Block objects. Parsing is CPU-bound (flanker, HTML
+sanitization, hashing), so a sync process can hand it off to a pool of worker
+processes instead of running it on the gevent hub, where one huge message
+would stall every other greenlet. Enable the pool by setting
+"MESSAGE_PARSE_WORKERS" to the number of worker processes in your config.
+
+"""
+import json
+import multiprocessing
+from collections import namedtuple
+from hashlib import sha256
+
+from flanker import mime
+from gevent.pool import Group
+from gevent.queue import Queue
+from gevent.socket import wait_read
+
+from inbox.config import config
+from inbox.util.addr import parse_mimepart_address_header
+from inbox.util.html import plaintext2html, strip_tags
+from inbox.util.misc import parse_references, get_internaldate
+from inbox.log import get_logger
+log = get_logger()
+
+SNIPPET_LENGTH = 191
+
+ADDRESS_HEADERS = [('from_addr', 'From'), ('sender_addr', 'Sender'),
+                   ('reply_to', 'Reply-To'), ('to_addr', 'To'),
+                   ('cc_addr', 'Cc'), ('bcc_addr', 'Bcc')]
+
+# `attrs` maps Message attribute names to values. If parsing fails halfway,
+# it only holds the attributes computed up to that point and `decode_error`
+# is set; `error` holds the repr of the exception, if any. `log_events` are
+# (level, event, kwargs) triples for the caller to log with the appropriate
+# context, since parsing may happen in another process.
+ParsedMessage = namedtuple('ParsedMessage',
+                           'attrs parts body_sha256 decode_error error '
+                           'log_events')
+# The headers of the message are stored as a JSON-encoded part with index 0
+# and no content type.
+ParsedPart = namedtuple('ParsedPart',
+                        'walk_index content_type filename content_disposition '
+                        'content_id data data_sha256')
+
+
+def calculate_plaintext_snippet(text):
+    return ' '.join(text.split())[:SNIPPET_LENGTH]
+
+
+def calculate_html_snippet(text):
+    return calculate_plaintext_snippet(strip_tags(text))
+
+
+def parse_message(body_string, received_date=None):
+    """
+    Parse a raw message.
+
+    Parameters
+    ----------
+    body_string : str
+        The full message including headers (encoded).
+    received_date : datetime, optional
+        If not given, the date is taken from the message headers.
+
+    Returns
+    -------
+    ParsedMessage
+
+    """
+    attrs = {}
+    parts = []
+    log_events = []
+    decode_error = False
+    error = None
+    body_sha256 = sha256(body_string).hexdigest()
+    try:
+        parsed = mime.from_string(body_string)
+
+        mime_version = parsed.headers.get('Mime-Version')
+        # sometimes MIME-Version is '1.0 (1.0)', hence the .startswith()
+        if mime_version is not None and not mime_version.startswith('1.0'):
+            log_events.append(('warning', 'Unexpected MIME-Version',
+                               dict(mime_version=mime_version)))
+
+        attrs['data_sha256'] = body_sha256
+        attrs['subject'] = parsed.subject
+        for attr, header_name in ADDRESS_HEADERS:
+            attrs[attr] = parse_mimepart_address_header(parsed, header_name)
+
+        attrs['in_reply_to'] = parsed.headers.get('In-Reply-To')
+        attrs['message_id_header'] = parsed.headers.get('Message-Id')
+
+        attrs['received_date'] = received_date if received_date else \
+            get_internaldate(parsed.headers.get('Date'),
+                             parsed.headers.get('Received'))
+
+        # Custom Inbox header
+        attrs['inbox_uid'] = parsed.headers.get('X-INBOX-ID')
+
+        # In accordance with JWZ (http://www.jwz.org/doc/threading.html)
+        attrs['references'] = parse_references(
+            parsed.headers.get('References', ''),
+            parsed.headers.get('In-Reply-To', ''))
+
+        attrs['size'] = len(body_string)  # includes headers text
+
+        headers = json.dumps(parsed.headers.items())
+        parts.append(ParsedPart(walk_index=0, content_type=None,
+                                filename=None, content_disposition=None,
+                                content_id=None, data=headers,
+                                data_sha256=sha256(headers).hexdigest()))
+
+        i = 0  # for walk_index
+        for mimepart in parsed.walk(
+                with_self=parsed.content_type.is_singlepart()):
+            i += 1
+            if mimepart.content_type.is_multipart():
+                log_events.append(('warning', 'multipart sub-part found', {}))
+                continue  # TODO should we store relations?
+            part = _parse_mimepart(mimepart, i, log_events)
+            if part is None:
+                decode_error = True
+            else:
+                parts.append(part)
+
+        attrs['sanitized_body'], attrs['snippet'] = \
+            _sanitized_body_and_snippet(parts)
+    except (mime.DecodingError, AttributeError, RuntimeError, TypeError,
+            ValueError) as e:
+        # Message parsing can fail for several reasons. Occasionally iconv
+        # will fail via maximum recursion depth. EAS messages may be
+        # missing Date and Received headers. In such cases, we still keep
+        # the metadata and mark it as b0rked.
+        decode_error = True
+        error = repr(e)
+
+    return ParsedMessage(attrs=attrs, parts=parts, body_sha256=body_sha256,
+                         decode_error=decode_error, error=error,
+                         log_events=log_events)
+
+
+def _trim_filename(s, log_events, max_len=64):
+    if s and len(s) > max_len:
+        log_events.append(('warning', 'filename is too long, truncating',
+                           dict(max_len=max_len, filename=s)))
+        return s[:max_len - 8] + s[-8:]  # Keep extension
+    return s
+
+
+def _parse_mimepart(mimepart, index, log_events):
+    """Parse a single MIME part. Returns None if the part has to be skipped
+    because it's malformed."""
+    disposition, disposition_params = mimepart.content_disposition
+    if (disposition is not None and
+            disposition not in ['inline', 'attachment']):
+        log_events.append(('error', 'Unknown Content-Disposition',
+                           dict(bad_content_disposition=
+                                mimepart.content_disposition,
+                                parsed_content_disposition=disposition)))
+        return None
+
+    content_type = mimepart.content_type.value
+    filename = _trim_filename(mimepart.content_type.params.get('name'),
+                              log_events)
+    # TODO maybe also trim other headers?
+    if disposition == 'attachment':
+        filename = _trim_filename(disposition_params.get('filename'),
+                                  log_events)
+
+    if mimepart.body is None:
+        data = ''
+    elif content_type.startswith('text'):
+        data = mimepart.body.encode('utf-8', 'strict')
+        # normalize mac/win/unix newlines
+        data = data.replace('\r\n', '\n').replace('\r', '\n')
+    else:
+        data = mimepart.body
+    if data is None:
+        data = ''
+
+    return ParsedPart(walk_index=index, content_type=content_type,
+                      filename=filename, content_disposition=disposition,
+                      content_id=mimepart.headers.get('Content-Id'),
+                      data=data, data_sha256=sha256(data).hexdigest())
+
+
+def _sanitized_body_and_snippet(parts):
+    html_part = next((part.data.decode('utf-8').strip() for part in parts
+                      if part.content_type == 'text/html'), None)
+    plain_part = next((part.data.decode('utf-8').strip() for part in parts
+                       if part.content_type == 'text/plain'), None)
+    # TODO: also strip signatures.
+    if html_part:
+        assert '\r' not in html_part, "newlines not normalized"
+        return html_part, calculate_html_snippet(html_part)
+    elif plain_part:
+        return (plaintext2html(plain_part, False),
+                calculate_plaintext_snippet(plain_part))
+    return u'', u''
+
+
+def _parse_worker(requests, results):
+    """Main loop of a parse worker process."""
+    while True:
+        try:
+            request = requests.recv()
+        except EOFError:
+            return
+        body_string, received_date = request
+        try:
+            result = parse_message(body_string, received_date)
+        except Exception:
+            # The parent falls back to parsing inline, which logs the error
+            # properly.
+            result = None
+        results.send(result)
+
+
+class _ParseWorker(object):
+    def __init__(self):
+        # Use a pair of plain pipes rather than a duplex socketpair: sockets
+        # created after gevent's monkey-patching are non-blocking, which the
+        # multiprocessing connection code doesn't expect.
+        requests_in, self.requests = multiprocessing.Pipe(duplex=False)
+        self.results, results_out = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(
+            target=_parse_worker, args=(requests_in, results_out))
+        self.process.daemon = True
+        self.process.start()
+        requests_in.close()
+        results_out.close()
+
+    def parse(self, body_string, received_date):
+        self.requests.send((body_string, received_date))
+        # Yield to other greenlets until the worker has a result for us.
+        wait_read(self.results.fileno())
+        return self.results.recv()
+
+    def terminate(self):
+        self.requests.close()
+        self.results.close()
+        self.process.terminate()
+
+
+class ParseWorkerPool(object):
+    """
+    A fixed-size pool of worker processes running `parse_message`.
+
+    Waiting for a result only blocks the calling greenlet. If a worker dies
+    (e.g. runs out of memory on a pathological message), it's replaced and
+    `parse` returns None, so that callers can fall back to parsing inline.
+
+    """
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        # Workers are started lazily; None stands for a worker that hasn't
+        # been (re)started yet.
+        self._idle = Queue()
+        for _ in range(num_workers):
+            self._idle.put(None)
+
+    def parse(self, body_string, received_date=None):
+        worker = self._idle.get() or _ParseWorker()
+        try:
+            return worker.parse(body_string, received_date)
+        except (EOFError, IOError, OSError) as e:
+            log.error('Message parse worker died', error=e,
+                      exitcode=worker.process.exitcode)
+            worker.terminate()
+            worker = None
+            return None
+        except BaseException:
+            # E.g. we were killed while waiting. The worker may still send a
+            # response nobody is going to read, so don't reuse it.
+            worker.terminate()
+            worker = None
+            raise
+        finally:
+            self._idle.put(worker)
+
+    def map(self, requests):
+        """Parse (body_string, received_date) pairs concurrently, preserving
+        order."""
+        return Group().map(lambda request: self.parse(*request), requests)
+
+
+_parse_pool = None
+
+
+def get_parse_pool():
+    """The process-wide parse pool, or None if MESSAGE_PARSE_WORKERS is not
+    configured (in which case messages are parsed inline)."""
+    global _parse_pool
+    num_workers = config.get('MESSAGE_PARSE_WORKERS', 0)
+    if not num_workers:
+        return None
+    if _parse_pool is None:
+        _parse_pool = ParseWorkerPool(num_workers)
+    return _parse_pool
@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
-from inbox.sqlalchemy_ext.util import safer_yield_per
+from collections import defaultdict
+
+from sqlalchemy import func
+
+from inbox.models.message import Message
 from inbox.models.thread import Thread
-from sqlalchemy import desc
-from inbox.util.misc import cleanup_subject
+from inbox.models.threading_key import (ThreadingKey, threading_keys,
+                                        REFERENCE, PARTICIPANT, SENDER)
 
 
 MAX_THREAD_LENGTH = 500
@@ -10,59 +14,66 @@ MAX_THREAD_LENGTH = 500
 
 def fetch_corresponding_thread(db_session, namespace_id, message):
     """fetch a thread matching the corresponding message. Returns None if
-       there's no matching thread."""
-    # FIXME: for performance reasons, we make the assumption that a reply
-    # to a message always has a similar subject. This is only
-    # right 95% of the time.
-    clean_subject = cleanup_subject(message.subject)
-    threads = db_session.query(Thread).filter(
-        Thread.namespace_id == namespace_id,
-        Thread._cleaned_subject == clean_subject). \
-        order_by(desc(Thread.id))
+       there's no matching thread.
 
-    for thread in safer_yield_per(threads, Thread.id, 0, 100):
-        for match in thread.messages:
-            # A lot of people BCC some address when sending mass
-            # emails so ignore BCC.
-            match_bcc = match.bcc_addr if match.bcc_addr else []
-            message_bcc = message.bcc_addr if message.bcc_addr else []
+    Candidate threads are looked up in the ThreadingKey index, so this takes
+    a single indexed query no matter how many messages the namespace has. In
+    order of preference, a message belongs to:
 
-            match_emails = [t[1] for t in match.participants
-                            if t not in match_bcc]
-            message_emails = [t[1] for t in message.participants
-                              if t not in message_bcc]
+    * a thread containing a message it shares a Message-ID or reference with,
+    * a thread containing a message with the same (cleaned-up) subject and
+      at least two participants in common, or, if the message was sent to
+      oneself, a message with the same subject sent by the same person.
 
-            # A conversation takes place between two or more persons.
-            # Are there more than two participants in common in this
-            # thread? If yes, it's probably a related thread.
-            match_participants_set = set(match_emails)
-            message_participants_set = set(message_emails)
+    If several threads match, the most recent one that hasn't reached
+    MAX_THREAD_LENGTH messages wins.
 
-            if len(match_participants_set & message_participants_set) >= 2:
-                # No need to loop through the rest of the messages
-                # in the thread
-                if len(thread.messages) >= MAX_THREAD_LENGTH:
-                    break
-                else:
-                    return match.thread
+    """
+    keys = threading_keys(message)
+    # Only match on the sender when someone is self-sending an email.
+    message_from = [t[1] for t in message.from_addr or []]
+    message_to = [t[1] for t in message.to_addr or []]
+    if not (len(message_to) == 1 and message_from == message_to):
+        keys = {key: kind for key, kind in keys.iteritems() if kind != SENDER}
+    if not keys:
+        return
 
-            # handle the case where someone is self-sending an email.
-            if not message.from_addr or not message.to_addr:
-                return
+    matches = db_session.query(ThreadingKey.key, ThreadingKey.message_id,
+                               Message.thread_id). \
+        join(Message, Message.id == ThreadingKey.message_id). \
+        filter(ThreadingKey.namespace_id == namespace_id,
+               ThreadingKey.key.in_(keys.keys()),
+               Message.thread_id.isnot(None)).all()
 
-            match_from = [t[1] for t in match.from_addr]
-            match_to = [t[1] for t in match.from_addr]
-            message_from = [t[1] for t in message.from_addr]
-            message_to = [t[1] for t in message.to_addr]
+    referenced = set()
+    similar = set()
+    common_participants = defaultdict(set)
+    for key, message_id, thread_id in matches:
+        if message_id == message.id:
+            continue
+        kind = keys[key]
+        if kind == REFERENCE:
+            referenced.add(thread_id)
+        elif kind == PARTICIPANT:
+            common_participants[(message_id, thread_id)].add(key)
+        else:
+            similar.add(thread_id)
 
-            if (len(message_to) == 1 and message_from == message_to and
-                    match_from == match_to and message_to == match_from):
-                # Check that we're not over max thread length in this case
-                # No need to loop through the rest of the messages
-                # in the thread.
-                if len(thread.messages) >= MAX_THREAD_LENGTH:
-                    break
-                else:
-                    return match.thread
+    # A conversation takes place between two or more persons. Are there
+    # more than two participants in common with a message? If yes, it's
+    # probably a related thread.
+    for (message_id, thread_id), participants in \
+            common_participants.iteritems():
+        if len(participants) >= 2:
+            similar.add(thread_id)
 
-    return
+    candidates = referenced or similar
+    if not candidates:
+        return
+    full_threads = {thread_id for thread_id, in db_session.query(
+        Message.thread_id).filter(Message.thread_id.in_(candidates)).
+        group_by(Message.thread_id).
+        having(func.count(Message.id) >= MAX_THREAD_LENGTH)}
+    candidates -= full_threads
+    if candidates:
+        return db_session.query(Thread).get(max(candidates))
@@ -0,0 +1,47 @@
+"""add threadingkey table
+
+Revision ID: 2f3c8fa3fc3a
+Revises: 3c7f059a68ba
+Create Date: 2015-04-06 17:12:40.174722
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2f3c8fa3fc3a'
+down_revision = '3c7f059a68ba'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'threadingkey',
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('updated_at', sa.DateTime(), nullable=False),
+        sa.Column('deleted_at', sa.DateTime(), nullable=True),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('namespace_id', sa.Integer(), nullable=False),
+        sa.Column('message_id', sa.Integer(), nullable=False),
+        sa.Column('key', sa.String(length=64), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.ForeignKeyConstraint(['namespace_id'], ['namespace.id'],
+                                ondelete='CASCADE'),
+        sa.ForeignKeyConstraint(['message_id'], ['message.id'],
+                                ondelete='CASCADE')
+    )
+    op.create_index('ix_threadingkey_created_at', 'threadingkey',
+                    ['created_at'], unique=False)
+    op.create_index('ix_threadingkey_updated_at', 'threadingkey',
+                    ['updated_at'], unique=False)
+    op.create_index('ix_threadingkey_deleted_at', 'threadingkey',
+                    ['deleted_at'], unique=False)
+    op.create_index('ix_threadingkey_message_id', 'threadingkey',
+                    ['message_id'], unique=False)
+    op.create_index('ix_threadingkey_namespace_id_key', 'threadingkey',
+                    ['namespace_id', 'key'], unique=False)
+    print "\nRun bin/backfill-threading-index to index existing messages."
+
+
+def downgrade():
+    op.drop_table('threadingkey')
@@ -0,0 +1,27 @@
+"""add searchindexcursor.shard_id
+
+Revision ID: 4e6eedda36af
+Revises: 2f3c8fa3fc3a
+Create Date: 2015-04-08 11:42:03.541257
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4e6eedda36af'
+down_revision = '2f3c8fa3fc3a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('searchindexcursor',
+                  sa.Column('shard_id', sa.Integer(), nullable=False,
+                            server_default='0'))
+    op.create_index('ix_searchindexcursor_shard_id', 'searchindexcursor',
+                    ['shard_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_searchindexcursor_shard_id', 'searchindexcursor')
+    op.drop_column('searchindexcursor', 'shard_id')
@@ -0,0 +1,23 @@
+"""add calendar.sync_token
+
+Revision ID: 3b093f2d7419
+Revises: 4e6eedda36af
+Create Date: 2015-04-09 15:20:47.361943
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b093f2d7419'
+down_revision = '4e6eedda36af'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('calendar', sa.Column('sync_token', sa.String(length=255),
+                                        nullable=True))
+
+
+def downgrade():
+    op.drop_column('calendar', 'sync_token')
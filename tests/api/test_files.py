@@ -171,3 +171,36 @@ def test_download(api_client, uploaded_file_ids, filename):
     local_md5 = md5.new(local_data).digest()
     dl_md5 = md5.new(data).digest()
     assert local_md5 == dl_md5
+
+
+def test_download_range_and_etag(api_client, uploaded_file_ids):
+    in_file = api_client.get_data('/files/{}'.format(uploaded_file_ids[0]))
+    path = '/files/{}/download'.format(in_file['id'])
+    full = api_client.get_raw(path)
+    assert full.status_code == 200
+    assert full.headers['Accept-Ranges'] == 'bytes'
+    etag = full.headers['ETag']
+
+    r = api_client.get_raw(path, headers={'Range': 'bytes=10-19'})
+    assert r.status_code == 206
+    assert r.data == full.data[10:20]
+    assert r.headers['Content-Range'] == \
+        'bytes 10-19/{}'.format(len(full.data))
+
+    r = api_client.get_raw(path, headers={'Range': 'bytes=-5'})
+    assert r.status_code == 206
+    assert r.data == full.data[-5:]
+
+    r = api_client.get_raw(path, headers={'Range': 'bytes={}-'.format(
+        len(full.data))})
+    assert r.status_code == 416
+
+    # Multiple ranges aren't supported, so the whole file is sent.
+    r = api_client.get_raw(path, headers={'Range': 'bytes=0-4,10-19'})
+    assert r.status_code == 200
+    assert r.data == full.data
+    assert 'Content-Range' not in r.headers
+
+    r = api_client.get_raw(path, headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.data == ''
@@ -277,8 +277,9 @@ def test_pagination():
         'items': ['D', 'E']
     })
 
-    requests.get = mock.Mock(side_effect=[first_response, second_response])
+    get = mock.Mock(side_effect=[first_response, second_response])
     provider = GoogleEventsProvider(1, 1)
+    provider.session.get = get
     provider._get_access_token = mock.Mock(return_value='token')
     items = provider._get_resource_list('https://googleapis.com/testurl')
     assert items == ['A', 'B', 'C', 'D', 'E']
@@ -294,8 +295,9 @@ def test_handle_http_401():
         'items': ['A', 'B', 'C']
     })
 
-    requests.get = mock.Mock(side_effect=[first_response, second_response])
+    get = mock.Mock(side_effect=[first_response, second_response])
     provider = GoogleEventsProvider(1, 1)
+    provider.session.get = get
     provider._get_access_token = mock.Mock(return_value='token')
     items = provider._get_resource_list('https://googleapis.com/testurl')
     assert items == ['A', 'B', 'C']
@@ -324,9 +326,10 @@ def test_handle_quota_exceeded():
         'items': ['A', 'B', 'C']
     })
 
-    requests.get = mock.Mock(side_effect=[first_response, second_response])
+    get = mock.Mock(side_effect=[first_response, second_response])
     gevent.sleep = mock.Mock()
     provider = GoogleEventsProvider(1, 1)
+    provider.session.get = get
     provider._get_access_token = mock.Mock(return_value='token')
     items = provider._get_resource_list('https://googleapis.com/testurl')
     # Check that we slept, then retried.
@@ -344,9 +347,10 @@ def test_handle_internal_server_error():
         'items': ['A', 'B', 'C']
     })
 
-    requests.get = mock.Mock(side_effect=[first_response, second_response])
+    get = mock.Mock(side_effect=[first_response, second_response])
     gevent.sleep = mock.Mock()
     provider = GoogleEventsProvider(1, 1)
+    provider.session.get = get
     provider._get_access_token = mock.Mock(return_value='token')
     items = provider._get_resource_list('https://googleapis.com/testurl')
     # Check that we slept, then retried.
@@ -369,8 +373,9 @@ def test_handle_api_not_enabled():
         }
     })
 
-    requests.get = mock.Mock(return_value=response)
+    get = mock.Mock(return_value=response)
     provider = GoogleEventsProvider(1, 1)
+    provider.session.get = get
     provider._get_access_token = mock.Mock(return_value='token')
     with pytest.raises(AccessNotEnabledError):
         provider._get_resource_list('https://googleapis.com/testurl')
@@ -380,16 +385,18 @@ def test_handle_other_errors():
     response = requests.Response()
     response.status_code = 403
     response._content = "This is not the JSON you're looking for"
-    requests.get = mock.Mock(return_value=response)
+    get = mock.Mock(return_value=response)
     provider = GoogleEventsProvider(1, 1)
+    provider.session.get = get
     provider._get_access_token = mock.Mock(return_value='token')
     with pytest.raises(requests.exceptions.HTTPError):
         provider._get_resource_list('https://googleapis.com/testurl')
 
     response = requests.Response()
     response.status_code = 404
-    requests.get = mock.Mock(return_value=response)
+    get = mock.Mock(return_value=response)
     provider = GoogleEventsProvider(1, 1)
+    provider.session.get = get
     provider._get_access_token = mock.Mock(return_value='token')
     with pytest.raises(requests.exceptions.HTTPError):
         provider._get_resource_list('https://googleapis.com/testurl')
@@ -536,3 +543,71 @@ def test_cancelled_override_creation():
     deletes, updates = provider.sync_events('uid', 1)
     assert len(deletes) == 0
     assert updates[0].cancelled is True
+
+
+@pytest.yield_fixture
+def fake_calendar():
+    from tests.util.fake_google_calendar import FakeGoogleCalendar
+    fake = FakeGoogleCalendar()
+    fake.start()
+    yield fake
+    fake.stop()
+
+
+def fake_provider(fake_calendar):
+    provider = GoogleEventsProvider(1, 1)
+    provider.api_url = fake_calendar.url
+    provider._get_access_token = mock.Mock(return_value='token')
+    return provider
+
+
+def test_incremental_sync(fake_calendar):
+    fake_calendar.add_calendar('work', 'Work')
+    for uid in ['a', 'b', 'c']:
+        fake_calendar.put_event('work', uid, 'Event {}'.format(uid))
+    provider = fake_provider(fake_calendar)
+
+    deletes, calendars = provider.sync_calendars()
+    assert [c.uid for c in calendars] == ['work']
+
+    (deletes, updates), sync_token, token_invalidated = \
+        provider.sync_events_incrementally('work')
+    assert deletes == []
+    assert sorted(e.uid for e in updates) == ['a', 'b', 'c']
+    assert sync_token is not None
+    assert not token_invalidated
+
+    fake_calendar.put_event('work', 'b', 'Updated event b')
+    fake_calendar.cancel_event('work', 'c')
+    (deletes, updates), sync_token, _ = \
+        provider.sync_events_incrementally('work', sync_token)
+    assert deletes == ['c']
+    assert [(e.uid, e.title) for e in updates] == [('b', 'Updated event b')]
+
+    # Nothing changed since the last sync.
+    (deletes, updates), sync_token, token_invalidated = \
+        provider.sync_events_incrementally('work', sync_token)
+    assert deletes == [] and updates == []
+    assert not token_invalidated
+
+
+def test_invalidated_sync_token_triggers_full_sync(fake_calendar):
+    fake_calendar.add_calendar('work', 'Work')
+    for uid in ['a', 'b', 'c']:
+        fake_calendar.put_event('work', uid, 'Event {}'.format(uid))
+    provider = fake_provider(fake_calendar)
+    _, sync_token, _ = provider.sync_events_incrementally('work')
+
+    fake_calendar.invalidate_sync_tokens()
+    fake_calendar.cancel_event('work', 'c')
+    (deletes, updates), new_sync_token, token_invalidated = \
+        provider.sync_events_incrementally('work', sync_token)
+    # The full listing leaves out the cancelled event, and says so, so that
+    # the caller deletes local events that aren't listed.
+    assert deletes == []
+    assert sorted(e.uid for e in updates) == ['a', 'b']
+    assert token_invalidated
+    assert new_sync_token != sync_token
+    # The token was tried, then the events were refetched without it.
+    assert fake_calendar.requests[-2][1]['syncToken'] == sync_token
+    assert 'syncToken' not in fake_calendar.requests[-1][1]
@@ -3,11 +3,14 @@ import arrow
 from dateutil import tz
 from dateutil.rrule import rrulestr
 from datetime import timedelta
+from itertools import islice
 from inbox.models.event import Event, RecurringEvent, RecurringEventOverride
 from inbox.models.when import Date, Time, DateSpan, TimeSpan
 from inbox.events.remote_sync import handle_event_updates, handle_event_deletes
 from inbox.events.recurring import (link_events, get_start_times,
-                                    parse_exdate, rrule_to_json)
+                                    parse_exdate, rrule_to_json,
+                                    ExpansionCache, iter_events,
+                                    count_events)
 
 from inbox.log import get_logger
 log = get_logger()
@@ -453,6 +456,119 @@ def test_master_cancelled(db, default_account, calendar):
     assert find_override is None
 
 
+def test_master_and_override_in_same_batch(db, default_account, calendar):
+    # The override comes before its master; they still get linked.
+    master_uid = 'batchuid'
+    kwargs = dict(title='batched', description='', location='', busy=False,
+                  read_only=False, reminders='', all_day=False,
+                  is_owner=False, participants=[], provider_name='inbox',
+                  raw_data='', original_start_tz='America/Los_Angeles',
+                  source='local',
+                  start=arrow.get(2014, 8, 14, 20, 30, 00),
+                  end=arrow.get(2014, 8, 14, 21, 30, 00))
+    override = Event(uid=master_uid + '_20140814T203000Z',
+                     recurrence=None, master_event_uid=master_uid,
+                     original_start_time=arrow.get(2014, 8, 14, 20, 30, 00),
+                     **kwargs)
+    master = Event(uid=master_uid, recurrence=TEST_RRULE,
+                   master_event_uid=None, original_start_time=None, **kwargs)
+    handle_event_updates(default_account.namespace.id, calendar.id,
+                         [override, master], log, db.session)
+    db.session.commit()
+    find_override = db.session.query(Event).filter_by(
+        uid=override.uid).one()
+    find_master = db.session.query(Event).filter_by(uid=master_uid).one()
+    assert find_override.master_event_id == find_master.id
+
+
+def test_expansion_cache(monkeypatch):
+    cache = ExpansionCache(max_size=1)
+    monkeypatch.setattr('inbox.events.recurring.expansion_cache', cache)
+    event = Event(namespace_id=0, uid='myuid', recurrence=TEST_EXDATE_RULE,
+                  start=arrow.get(2014, 8, 7, 20, 30, 00),
+                  end=arrow.get(2014, 8, 7, 21, 30, 00), all_day=False,
+                  original_start_tz='America/Los_Angeles')
+    event.id = 1
+    # Six Thursdays, less the excluded Sept 4.
+    assert len(get_start_times(event)) == 6
+    assert cache.misses == 1
+
+    # Narrower windows are answered from the first expansion.
+    g = get_start_times(event, start=arrow.get(2014, 8, 20),
+                        end=arrow.get(2014, 9, 12))
+    assert [t.day for t in g] == [21, 28, 11]
+    g = get_start_times(event, start=arrow.get(2014, 9, 18, 20, 30, 00))
+    assert len(g) == 1
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # Changing the recurrence invalidates the expansion.
+    event.exdate = None
+    assert len(get_start_times(event)) == 7
+    assert (cache.hits, cache.misses) == (2, 2)
+
+    # The cache is bounded.
+    other = Event(namespace_id=0, uid='otheruid', recurrence=TEST_RRULE,
+                  start=arrow.get(2014, 8, 7, 20, 30, 00),
+                  end=arrow.get(2014, 8, 7, 21, 30, 00), all_day=False)
+    other.id = 2
+    assert len(get_start_times(other)) == 7
+    assert len(get_start_times(event)) == 7
+    assert (cache.hits, cache.misses) == (2, 4)
+
+
+def test_iter_and_count_events():
+    master = Event(namespace_id=0, uid='myuid', recurrence=TEST_RRULE,
+                   start=arrow.get(2014, 8, 7, 20, 30, 00),
+                   end=arrow.get(2014, 8, 7, 21, 30, 00), all_day=False)
+    master.id = 3
+    # Move the Aug 21 instance to the morning, and cancel the Sept 4 one.
+    moved = Event(namespace_id=0, master_event_uid='myuid',
+                  uid='myuid_20140821T203000Z',
+                  start=arrow.get(2014, 8, 21, 9, 00, 00),
+                  end=arrow.get(2014, 8, 21, 10, 00, 00), all_day=False)
+    cancelled = Event(namespace_id=0, master_event_uid='myuid',
+                      uid='myuid_20140904T203000Z', status='cancelled',
+                      start=arrow.get(2014, 9, 4, 20, 30, 00),
+                      end=arrow.get(2014, 9, 4, 21, 30, 00), all_day=False)
+    overrides = [moved, cancelled]
+
+    events = list(iter_events(master, overrides))
+    assert [e.start.day for e in events] == [7, 14, 21, 28, 11, 18]
+    assert events[2] is moved
+    assert count_events(master, overrides) == 6
+
+    # Consuming part of the events only expands that far.
+    first = list(islice(iter_events(master, overrides), 2))
+    assert [e.start.day for e in first] == [7, 14]
+
+    start = arrow.get(2014, 9, 1)
+    assert [e.start.day for e in iter_events(master, [], start=start)] == \
+        [4, 11, 18]
+    assert count_events(master, [], start=start) == 3
+
+
+def test_overrides_by_master_window(db, default_account, calendar):
+    from inbox.api.filtering import _overrides_by_master
+    event = recurring_event(db, default_account, calendar, TEST_RRULE)
+    early = recurring_override(db, event,
+                               arrow.get(2014, 8, 14, 20, 30, 00),
+                               arrow.get(2014, 8, 14, 21, 30, 00),
+                               arrow.get(2014, 8, 14, 22, 30, 00))
+    late = recurring_override(db, event,
+                              arrow.get(2014, 9, 4, 20, 30, 00),
+                              arrow.get(2014, 9, 4, 21, 30, 00),
+                              arrow.get(2014, 9, 4, 22, 30, 00))
+    assert _overrides_by_master([event], db.session) == \
+        {event.id: [early, late]}
+    # Overrides outside the window aren't loaded at all.
+    assert _overrides_by_master([event], db.session,
+                                start=arrow.get(2014, 9, 1)) == \
+        {event.id: [late]}
+    assert _overrides_by_master([event], db.session,
+                                end=arrow.get(2014, 9, 1)) == \
+        {event.id: [early]}
+
+
 def test_when_delta():
     # Test that the event length is calculated correctly
     ev = Event(namespace_id=0)
@@ -164,3 +164,35 @@ def test_handle_changes(db, new_account):
     # calendar still survive.
     assert db.session.query(Event).filter(
         Event.namespace_id == namespace_id).count() == 2
+
+
+def test_invalidated_sync_token_deletes_unlisted_events(db, new_account,
+                                                        monkeypatch):
+    monkeypatch.setattr('inbox.events.remote_sync.INCREMENTAL_EVENT_SYNC',
+                        True)
+    namespace_id = new_account.namespace.id
+    event_sync = EventSync(new_account.email_address, 'google', new_account.id,
+                           namespace_id)
+    event_sync.provider.sync_calendars = calendar_response
+
+    def full_listing(calendar_uid, sync_token):
+        return event_response(calendar_uid, None), 'token', False
+    event_sync.provider.sync_events_incrementally = full_listing
+    event_sync.sync()
+
+    # The sync token was invalidated, and an event was deleted since.
+    def listing_after_invalidation(calendar_uid, sync_token):
+        deletes, updates = event_response(calendar_uid, None)
+        if calendar_uid == 'first_calendar_uid':
+            updates = [e for e in updates if e.uid != 'first_event_uid']
+        return (deletes, updates), 'new_token', True
+    event_sync.provider.sync_events_incrementally = listing_after_invalidation
+    event_sync.sync()
+
+    assert sorted(uid for uid, in db.session.query(Event.uid).join(Calendar).
+                  filter(Event.namespace_id == namespace_id,
+                         Calendar.uid == 'first_calendar_uid')) == \
+        ['second_event_uid', 'third_event_uid']
+    assert db.session.query(Event).join(Calendar).filter(
+        Event.namespace_id == namespace_id,
+        Calendar.uid == 'second_calendar_uid').count() == 2
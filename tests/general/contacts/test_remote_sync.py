@@ -90,6 +90,36 @@ def test_deletes(contacts_provider, contact_sync, db):
     assert num_current_contacts == num_original_contacts
 
 
+def test_contact_sync_batches(contacts_provider, contact_sync, db,
+                              monkeypatch):
+    monkeypatch.setattr('inbox.contacts.remote_sync.CONTACT_BATCH_SIZE', 2)
+    for i in range(5):
+        contacts_provider.supply_contact('Contact {}'.format(i),
+                                         'contact{}@example.com'.format(i))
+    contact_sync.provider = contacts_provider
+    contact_sync.sync()
+
+    def synced_contacts():
+        return db.session.query(Contact).filter(
+            Contact.namespace_id == NAMESPACE_ID,
+            Contact.provider_name == contacts_provider.PROVIDER_NAME)
+
+    assert synced_contacts().count() == 5
+
+    # Feed the provider an update to contact 1 and a deletion of contact 2.
+    updates_provider = ContactsProviderStub()
+    updates_provider.supply_contact('Renamed', 'contact0@example.com')
+    updates_provider.supply_contact('Contact 1', 'contact1@example.com',
+                                    deleted=True)
+    contact_sync.provider = updates_provider
+    contact_sync.sync()
+    db.session.expire_all()
+
+    assert synced_contacts().count() == 4
+    assert synced_contacts().filter(Contact.uid == '1').one().name == \
+        'Renamed'
+
+
 def test_auth_error_handling(contact_sync, db):
     """Test that the contact sync greenlet stops if account credentials are
     invalid."""
@@ -0,0 +1,88 @@
+from hashlib import sha256
+
+import mock
+import pytest
+
+from inbox.util.blockstore import (MemoryBlockStore, FilesystemBlockStore,
+                                   CachingBlockStore, S3BlockStore)
+
+
+def block(data):
+    return sha256(data).hexdigest(), data
+
+
+def test_filesystem_blockstore(tmpdir):
+    store = FilesystemBlockStore(str(tmpdir))
+    h, data = block('hello')
+    assert store.get(h) is None
+    store.put(h, data)
+    assert store.get(h) == data
+    assert store.exists_many([h, sha256('other').hexdigest()]) == {h}
+    assert list(store.stream(h, chunk_size=2)) == ['he', 'll', 'o']
+    assert list(store.stream(h, 1, 4, chunk_size=2)) == ['el', 'l']
+    store.delete(h)
+    assert store.get(h) is None
+
+
+def test_cache_evicts_least_recently_used():
+    backend = MemoryBlockStore()
+    store = CachingBlockStore(backend, max_bytes=10)
+    blocks = [block(c * 4) for c in 'abc']
+    for h, data in blocks:
+        backend.put(h, data)
+
+    store.get(blocks[0][0])
+    store.get(blocks[1][0])
+    # Touch the first block so that the second one is evicted.
+    store.get(blocks[0][0])
+    store.get(blocks[2][0])
+    assert store.cached_bytes == 8
+    assert (store.hits, store.misses) == (1, 3)
+
+    backend.blocks.clear()
+    assert store.get(blocks[0][0]) == blocks[0][1]
+    assert store.get(blocks[2][0]) == blocks[2][1]
+    assert store.get(blocks[1][0]) is None
+
+
+def test_cache_verifies_hashes():
+    backend = MemoryBlockStore()
+    h, _ = block('expected')
+    backend.put(h, 'corrupted')
+    with pytest.raises(AssertionError):
+        CachingBlockStore(backend).get(h)
+    # Verification can be turned off.
+    assert CachingBlockStore(backend, verify_sample_rate=0).get(h) == \
+        'corrupted'
+
+
+def test_streaming_verifies_hashes():
+    backend = MemoryBlockStore()
+    h, _ = block('expected')
+    backend.put(h, 'corrupted')
+    chunks = CachingBlockStore(backend).stream(h, chunk_size=4)
+    # The last chunk isn't returned until the hash has been checked.
+    assert next(chunks) == 'corr'
+    with pytest.raises(AssertionError):
+        list(chunks)
+    # Ranges can't be verified, so they're passed through as-is.
+    assert list(CachingBlockStore(backend).stream(h, 0, 4)) == ['corr']
+
+
+def test_s3_put_trusts_existence_checks():
+    with mock.patch('boto.s3.connection.S3Connection'):
+        store = S3BlockStore('key', 'secret', 'bucket')
+    stored, new = block('stored'), block('new')
+    store.bucket.get_key.side_effect = \
+        lambda h: mock.Mock() if h == stored[0] else None
+
+    store.prepare_put([stored[0], new[0]])
+    assert store.bucket.get_key.call_count == 2
+    with mock.patch('boto.s3.key.Key.set_contents_from_string') as upload:
+        store.put(*stored)
+        store.put(*new)
+        # Once stored, a block isn't uploaded again.
+        store.put(*new)
+    # Neither block was checked again.
+    assert store.bucket.get_key.call_count == 2
+    upload.assert_called_once_with(new[1])
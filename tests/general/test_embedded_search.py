@@ -0,0 +1,86 @@
+import pytest
+
+from inbox.config import ConfigError
+from inbox.search.adaptor import SearchEngineError
+from inbox.search.embedded import EmbeddedNamespaceSearchEngine
+
+
+def message(id_, subject, body, date, sender='alice@example.com'):
+    return {'id': id_, 'object': 'message', 'namespace_id': 'ns',
+            'thread_id': 't' + id_, 'subject': subject, 'body': body,
+            'snippet': body[:10], 'date': date,
+            'from': [{'name': 'Alice', 'email': sender}],
+            'to': [{'name': 'Ben', 'email': 'ben@example.com'}],
+            'cc': [], 'bcc': [], 'files': [], 'unread': True}
+
+
+@pytest.yield_fixture
+def engine():
+    engine = EmbeddedNamespaceSearchEngine('embedded-search-test')
+    engine.messages.bulk_index([
+        ('index', message('1', 'Quarterly report', 'numbers attached', 100)),
+        ('index', message('2', 'Lunch', 'the quarterly report is late',
+                          200, sender='carol@example.com')),
+        ('index', message('3', 'Dinner', 'pizza?', 300))])
+    yield engine
+    engine.delete_index()
+
+
+def test_field_and_phrase_queries(engine):
+    results = engine.messages.search([{'subject': 'quarterly report'}],
+                                     sort='datetime')
+    assert results['total'] == 1
+    assert results['results'][0]['object']['id'] == '1'
+
+    results = engine.messages.search([{'from': 'carol@example.com'}],
+                                     sort='datetime')
+    assert [r['object']['id'] for r in results['results']] == ['2']
+
+    # Lists match any of their terms; queries in a list are or-ed.
+    results = engine.messages.search([{'subject': ['lunch', 'dinner']}],
+                                     sort='datetime')
+    assert [r['object']['id'] for r in results['results']] == ['3', '2']
+    results = engine.messages.search([{'subject': 'lunch'},
+                                      {'body': 'pizza'}], sort='datetime')
+    assert results['total'] == 2
+
+
+def test_all_query_uses_weights(engine):
+    results = engine.messages.search([{'all': 'quarterly'}],
+                                     sort='relevance')
+    assert sorted(r['object']['id'] for r in results['results']) == \
+        ['1', '2']
+    results = engine.messages.search(
+        [{'all': 'quarterly', 'weights': {'subject': 10, 'body': 1}}],
+        sort='relevance')
+    assert [r['object']['id'] for r in results['results']] == ['1', '2']
+    results = engine.messages.search(
+        [{'all': 'quarterly', 'weights': {'subject': 1, 'body': 10}}],
+        sort='relevance')
+    assert [r['object']['id'] for r in results['results']] == ['2', '1']
+
+
+def test_updates_and_deletes(engine):
+    engine.messages.bulk_index([('index', message('3', 'Dinner', 'sushi?',
+                                                  300)),
+                                ('delete', {'id': '1'})])
+    assert engine.messages.search([{'body': 'pizza'}], 'datetime')['total'] \
+        == 0
+    assert engine.messages.search([{'body': 'sushi'}], 'datetime')['total'] \
+        == 1
+    results = engine.messages.search(None, 'datetime', max_results=1,
+                                     offset=1)
+    assert results['total'] == 2
+    assert [r['object']['id'] for r in results['results']] == ['2']
+
+
+def test_unsupported_field(engine):
+    with pytest.raises(SearchEngineError):
+        engine.messages.search([{'tags': 'inbox'}], sort='datetime')
+
+
+def test_requires_sqlite_dir(monkeypatch):
+    # Otherwise each process would search its own, empty, in-memory index.
+    monkeypatch.setattr('inbox.search.embedded.SQLITE_DIR', None)
+    with pytest.raises(ConfigError):
+        EmbeddedNamespaceSearchEngine('embedded-search-no-dir')
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 """Sanity-check our construction of a Message object from raw synced data."""
+import cPickle as pickle
 import datetime
 import os
 import pytest
@@ -7,6 +8,7 @@ from flanker import mime
 from inbox.models import Message
 from inbox.models.message import _get_errfilename
 from inbox.util.addr import parse_mimepart_address_header
+from inbox.util.message_parsing import parse_message, ParseWorkerPool
 from tests.util.base import default_account, default_namespace, thread
 
 __all__ = ['default_namespace', 'thread']
@@ -207,3 +209,33 @@ def test_calculate_snippet():
                        'voces coniurationis tuae potest, si illustrantur,'
     assert len(expected_snippet) == 191
     assert m.calculate_html_snippet(body) == expected_snippet
+
+
+def test_parse_message(raw_message):
+    received_date = datetime.datetime(2014, 9, 22, 17, 25, 46)
+    parsed = parse_message(raw_message, received_date)
+    assert not parsed.decode_error
+    assert parsed.attrs['received_date'] == received_date
+    assert sorted(parsed.attrs['to_addr']) == [
+        (u'', u'csail-all.lists@mit.edu'),
+        (u'', u'csail-announce@csail.mit.edu'),
+        (u'', u'csail-related@csail.mit.edu')]
+    assert len(parsed.parts) == 4
+    assert 'Attached Message Part' in [part.filename for part in
+                                       parsed.parts]
+    # Parsed messages are shipped between processes.
+    assert pickle.loads(pickle.dumps(parsed, 2)) == parsed
+
+
+def test_parse_message_with_bad_date(raw_message_with_bad_date):
+    parsed = parse_message(raw_message_with_bad_date)
+    assert parsed.decode_error
+    assert parsed.error is not None
+    assert 'received_date' not in parsed.attrs
+
+
+def test_parse_worker_pool(raw_message):
+    received_date = datetime.datetime(2014, 9, 22, 17, 25, 46)
+    pool = ParseWorkerPool(2)
+    results = pool.map([(raw_message, received_date)] * 3)
+    assert results == [parse_message(raw_message, received_date)] * 3
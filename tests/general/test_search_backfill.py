@@ -0,0 +1,45 @@
+import gevent
+import pytest
+
+from inbox.search.adaptor import SearchEngineError
+from inbox.search.util.indexer import BackfillProgress, _bulk_index_chunks
+
+
+def test_progress_is_recorded_in_order():
+    chunks = [(10, [('index', {'id': 'a'})] * 3),
+              (20, [('index', {'id': 'b'})] * 2),
+              (30, [('index', {'id': 'c'})])]
+    delays = {10: 0.03, 20: 0.01, 30: 0}
+    indexed = []
+
+    def bulk_index(operations):
+        last_id = [c[0] for c in chunks if c[1] is operations][0]
+        gevent.sleep(delays[last_id])
+        return len(operations)
+
+    assert _bulk_index_chunks(iter(chunks), bulk_index, indexed.append) == 6
+    assert indexed == [10, 20, 30]
+
+
+def test_progress_stops_at_failed_chunk():
+    chunks = [(10, ['first']), (20, ['second']), (30, ['third'])]
+    indexed = []
+
+    def bulk_index(operations):
+        if operations == ['second']:
+            raise SearchEngineError('Bulk index failure!')
+        return len(operations)
+
+    with pytest.raises(SearchEngineError):
+        _bulk_index_chunks(iter(chunks), bulk_index, indexed.append,
+                           pool_size=1)
+    assert indexed == [10]
+
+
+def test_backfill_progress(tmpdir):
+    path = str(tmpdir.join('progress.json'))
+    progress = BackfillProgress(path)
+    assert progress.get(1, 'message') == 0
+    progress.update(1, 'message', 42)
+    assert BackfillProgress(path).get(1, 'message') == 42
+    assert BackfillProgress(path).get(1, 'thread') == 0
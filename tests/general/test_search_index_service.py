@@ -0,0 +1,73 @@
+from sqlalchemy import desc
+
+from inbox.models import Transaction
+from inbox.models.search import SearchIndexCursor
+from inbox.transactions.search import (SearchIndexService, SearchIndexShard,
+                                      byte_batches)
+from tests.util.base import add_fake_thread
+
+NAMESPACE_ID = 1
+
+
+def test_byte_batches():
+    operations = [('index', {'id': str(i), 'body': 'x' * 10})
+                  for i in range(5)]
+    size = len('{"body": "xxxxxxxxxx", "id": "0"}')
+    batches = list(byte_batches(operations, 2 * size))
+    assert batches == [operations[0:2], operations[2:4], operations[4:]]
+    # Oversized documents still get sent, on their own.
+    assert list(byte_batches(operations[:2], 1)) == [operations[:1],
+                                                     operations[1:2]]
+    assert list(byte_batches([], 1)) == []
+
+
+def test_load_pointers_when_shards_change(db):
+    add_fake_thread(db.session, NAMESPACE_ID)
+    transaction_id, = db.session.query(Transaction.id). \
+        order_by(desc(Transaction.id)).first()
+    db.session.query(SearchIndexCursor).delete()
+    db.session.add(SearchIndexCursor(shard_id=0,
+                                     transaction_id=transaction_id))
+    db.session.commit()
+
+    def saved_cursors():
+        db.session.expire_all()
+        return sorted((cursor.shard_id, cursor.transaction_id)
+                      for cursor in db.session.query(SearchIndexCursor))
+
+    # The existing shard's cursor is kept, and a new one added.
+    assert SearchIndexService(num_shards=2).load_pointers() == \
+        {0: transaction_id, 1: transaction_id}
+    assert saved_cursors() == [(0, transaction_id), (1, transaction_id)]
+    # Unchanged shards keep their cursors.
+    assert SearchIndexService(num_shards=2).load_pointers() == \
+        {0: transaction_id, 1: transaction_id}
+
+    assert SearchIndexService(num_shards=1).load_pointers() == \
+        {0: transaction_id}
+    assert saved_cursors() == [(0, transaction_id)]
+
+
+def test_quiet_shard_pointer_moves_forward(db):
+    add_fake_thread(db.session, NAMESPACE_ID)
+    pointer, = db.session.query(Transaction.id). \
+        order_by(desc(Transaction.id)).first()
+    for _ in range(4):
+        add_fake_thread(db.session, NAMESPACE_ID)
+    ids = [id_ for id_, in db.session.query(Transaction.id).
+           filter(Transaction.id > pointer).order_by(Transaction.id)]
+
+    # With a chunk size of 1, each read scans two transactions.
+    quiet_shard = SearchIndexShard((NAMESPACE_ID + 1) % 2, 2, pointer, 1, 1,
+                                   1000)
+    deltas, new_pointer, _ = quiet_shard.read_chunk()
+    assert deltas == []
+    assert new_pointer == ids[1]
+
+    busy_shard = SearchIndexShard(NAMESPACE_ID % 2, 2, pointer, 1, 1, 1000)
+    deltas, new_pointer, _ = busy_shard.read_chunk()
+    assert len(deltas) == 1
+    assert new_pointer == ids[0]
+
+    quiet_shard.read_pointer = ids[-1]
+    assert quiet_shard.read_chunk() is None
@@ -0,0 +1,35 @@
+from inbox.search import adaptor
+from inbox.search.adaptor import NamespaceSearchEngine, index_state
+
+
+class FakeIndices(object):
+    def __init__(self):
+        self.calls = []
+
+    def create(self, index, body):
+        self.calls.append(('create', index))
+
+    def delete(self, index):
+        self.calls.append(('delete', index))
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.indices = FakeIndices()
+
+
+def test_known_good_indices_are_not_reconfigured(monkeypatch):
+    connection = FakeConnection()
+    monkeypatch.setattr(adaptor, 'get_connection', lambda: connection)
+    avoided = index_state.admin_calls_avoided
+
+    engine = NamespaceSearchEngine('index-state-test')
+    NamespaceSearchEngine('index-state-test')
+    assert connection.indices.calls == [('create', 'index-state-test')]
+    assert index_state.admin_calls_avoided == \
+        avoided + 1 + len(NamespaceSearchEngine.MAPPINGS)
+
+    engine.delete_index()
+    NamespaceSearchEngine('index-state-test')
+    assert connection.indices.calls[-1] == ('create', 'index-state-test')
+    engine.delete_index()
@@ -2,6 +2,9 @@
 import pytest
 from inbox.util.threading import fetch_corresponding_thread
 from inbox.util.misc import cleanup_subject
+from inbox.models import Message
+from inbox.models.threading_key import (threading_keys, REFERENCE,
+                                        PARTICIPANT, SENDER)
 from tests.util.base import (add_fake_message, add_fake_thread,
                              add_fake_imapuid)
 
@@ -71,5 +74,49 @@ def test_self_send(db, default_namespace):
     assert matched_thread is first_thread, "Should match on self-send"
 
 
+def test_threading_keys():
+    message = Message(message_id_header='<b@example.com>',
+                      references=['<a@example.com>'],
+                      subject='Re: Lunch',
+                      from_addr=[('', 'ben@example.com')],
+                      to_addr=[('', 'alice@example.com')],
+                      cc_addr=[],
+                      bcc_addr=[('', 'archive@example.com')])
+    keys = threading_keys(message).values()
+    assert sorted(keys) == sorted([REFERENCE, REFERENCE, PARTICIPANT,
+                                   PARTICIPANT, SENDER])
+
+    # Replies share keys with the message they reply to, whatever their
+    # subject prefix.
+    parent = Message(message_id_header='<a@example.com>', subject='Lunch',
+                     from_addr=[('', 'alice@example.com')],
+                     to_addr=[('', 'ben@example.com')], cc_addr=[],
+                     bcc_addr=[])
+    shared = set(threading_keys(message)) & set(threading_keys(parent))
+    assert sorted(threading_keys(parent)[key] for key in shared) == \
+        [PARTICIPANT, PARTICIPANT, REFERENCE]
+
+
+def test_reference_threading(db, default_namespace):
+    first_thread = add_fake_thread(db.session, default_namespace.id)
+    first_thread.subject = 'Plans'
+    parent = add_fake_message(db.session, default_namespace.id,
+                              thread=first_thread, subject='Plans',
+                              from_addr=[('', 'alice@example.com')],
+                              to_addr=[('', 'ben@example.com')])
+    parent.message_id_header = '<plans@example.com>'
+    db.session.commit()
+
+    # Only the References header connects the reply to its parent.
+    reply = add_fake_message(db.session, default_namespace.id, thread=None,
+                             subject='Change of plans',
+                             from_addr=[('', 'carol@example.com')],
+                             to_addr=[('', 'dave@example.com')])
+    reply.references = ['<plans@example.com>']
+    matched_thread = fetch_corresponding_thread(db.session,
+                                                default_namespace.id, reply)
+    assert matched_thread is first_thread, "Should match on references"
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
@@ -0,0 +1,42 @@
+from inbox.models import Tag, Transaction
+from inbox.transactions.compaction import compact_transaction_log
+from inbox.transactions.delta_sync import (format_transactions_after_pointer,
+                                           _format_transaction_for_delta_sync)
+from tests.util.base import add_fake_thread
+
+NAMESPACE_ID = 1
+
+
+def get_deltas(db_session):
+    deltas, _ = format_transactions_after_pointer(
+        NAMESPACE_ID, 0, db_session, 1000, _format_transaction_for_delta_sync)
+    return deltas
+
+
+def test_compaction_keeps_latest_transaction_per_object(db):
+    thr = add_fake_thread(db.session, NAMESPACE_ID)
+    tag = Tag(name='foo', namespace_id=NAMESPACE_ID)
+    db.session.add(tag)
+    db.session.commit()
+    thr.apply_tag(tag)
+    db.session.commit()
+
+    thread_deltas = [delta for delta in get_deltas(db.session)
+                     if delta['id'] == thr.public_id]
+    assert len(thread_deltas) == 1
+    latest = thread_deltas[0]
+
+    assert compact_transaction_log(NAMESPACE_ID, db.session) > 0
+    # Compaction is idempotent.
+    assert compact_transaction_log(NAMESPACE_ID, db.session) == 0
+
+    live = db.session.query(Transaction).filter(
+        Transaction.namespace_id == NAMESPACE_ID,
+        Transaction.object_type == 'thread',
+        Transaction.record_id == thr.id,
+        Transaction.deleted_at.is_(None)).all()
+    assert [t.public_id for t in live] == [latest['cursor']]
+
+    # Clients get the same result as before compaction.
+    assert [delta for delta in get_deltas(db.session)
+            if delta['id'] == thr.public_id] == [latest]
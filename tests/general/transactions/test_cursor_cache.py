@@ -0,0 +1,19 @@
+from inbox.transactions.delta_sync import (CursorCache,
+                                           get_transaction_id_for_cursor)
+
+
+def test_cursor_cache_evicts_least_recently_used():
+    cache = CursorCache(max_size=2)
+    cache.put(1, 'a', 10)
+    cache.put(1, 'b', 11)
+    assert cache.get(1, 'a') == 10
+    cache.put(1, 'c', 12)
+    assert cache.get(1, 'b') is None
+    assert cache.get(1, 'a') == 10
+    assert cache.get(1, 'c') == 12
+    # Cursors are scoped to their namespace.
+    assert cache.get(2, 'a') is None
+
+
+def test_start_cursor_needs_no_lookup():
+    assert get_transaction_id_for_cursor(1, '0', db_session=None) == 0
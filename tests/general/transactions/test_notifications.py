@@ -0,0 +1,26 @@
+import gevent
+
+from inbox.transactions.notifications import TransactionNotifier
+
+
+def test_wait_wakes_up_on_notification():
+    notifier = TransactionNotifier()
+    generation = notifier.generation(1)
+    gevent.spawn_later(0.01, notifier.publish, {1})
+    assert notifier.wait(1, generation, timeout=5)
+    assert notifier.generation(1) == generation + 1
+
+
+def test_wait_times_out_without_notification():
+    notifier = TransactionNotifier()
+    generation = notifier.generation(1)
+    gevent.spawn_later(0.01, notifier.publish, {2})
+    assert not notifier.wait(1, generation, timeout=0.05)
+
+
+def test_notification_before_wait_is_not_missed():
+    notifier = TransactionNotifier()
+    generation = notifier.generation(1)
+    # E.g. a change committed while the waiter was querying the log.
+    notifier.publish({1})
+    assert notifier.wait(1, generation, timeout=0)
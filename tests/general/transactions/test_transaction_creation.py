@@ -135,3 +135,72 @@ def test_object_deletions_create_transaction(db):
         assert transaction.record_id == thr.id
         assert transaction.object_type == 'thread'
         assert transaction.command == 'delete'
+
+
+def test_commit_publishes_notification(db, monkeypatch):
+    published = []
+    monkeypatch.setattr('inbox.transactions.notifications.'
+                        'TransactionNotifier.publish',
+                        lambda self, namespace_ids:
+                        published.append(namespace_ids))
+    add_fake_thread(db.session, NAMESPACE_ID)
+    assert published == [{NAMESPACE_ID}]
+
+
+def test_deferred_snapshots(db, monkeypatch):
+    from inbox.api.kellogs import encode
+    from inbox.transactions.snapshots import fill_snapshots
+    monkeypatch.setattr('inbox.models.transaction.DEFER_SNAPSHOTS', True)
+    with db.session.no_autoflush:
+        thr = add_fake_thread(db.session, NAMESPACE_ID)
+        msg = add_fake_message(db.session, NAMESPACE_ID, thr)
+        transactions = [
+            get_latest_transaction(db.session, 'thread', thr.id,
+                                   NAMESPACE_ID),
+            get_latest_transaction(db.session, 'message', msg.id,
+                                   NAMESPACE_ID)]
+        assert all(t.snapshot is None for t in transactions)
+
+        assert fill_snapshots(transactions, db.session) == 2
+        assert transactions[0].snapshot == encode(thr)
+        assert transactions[1].snapshot == encode(msg)
+        # Nothing's left to do.
+        assert fill_snapshots(transactions, db.session) == 0
+
+
+def test_deferred_event_snapshot(db, monkeypatch):
+    from inbox.api.kellogs import encode
+    from inbox.transactions.snapshots import fill_snapshots
+    monkeypatch.setattr('inbox.models.transaction.DEFER_SNAPSHOTS', True)
+    with db.session.no_autoflush:
+        event = add_fake_event(db.session, NAMESPACE_ID)
+        transaction = get_latest_transaction(db.session, 'event', event.id,
+                                             NAMESPACE_ID)
+        assert transaction.snapshot is None
+
+        assert fill_snapshots([transaction], db.session) == 1
+        assert transaction.snapshot == encode(event)
+
+
+def test_deferred_snapshot_of_deleted_object(db, monkeypatch):
+    from inbox.transactions.delta_sync import (
+        format_transactions_after_pointer, _format_transaction_for_delta_sync)
+    monkeypatch.setattr('inbox.models.transaction.DEFER_SNAPSHOTS', True)
+    thr = add_fake_thread(db.session, NAMESPACE_ID)
+    insert = get_latest_transaction(db.session, 'thread', thr.id,
+                                    NAMESPACE_ID)
+    db.session.delete(thr)
+    db.session.commit()
+
+    # The delete is on the next page, so the insert is left out rather than
+    # returned without attributes.
+    deltas, pointer = format_transactions_after_pointer(
+        NAMESPACE_ID, insert.id - 1, db.session, 1,
+        _format_transaction_for_delta_sync)
+    assert deltas == []
+    assert pointer == insert.id
+
+    deltas, _ = format_transactions_after_pointer(
+        NAMESPACE_ID, pointer, db.session, 1,
+        _format_transaction_for_delta_sync)
+    assert [delta['event'] for delta in deltas] == ['delete']
@@ -1,10 +1,11 @@
 import pytest
 import json
+import mock
 import time
 from datetime import datetime, timedelta
 
 from inbox.heartbeat.store import (HeartbeatStore, HeartbeatStatusProxy,
-                                   HeartbeatStatusKey)
+                                   HeartbeatStatusKey, HeartbeatAggregator)
 from inbox.heartbeat.status import (clear_heartbeat_status, list_all_accounts,
                                     list_alive_accounts, list_dead_accounts,
                                     heartbeat_summary, get_account_metadata,
@@ -317,3 +318,58 @@ def test_missing_status(store):
     assert status.keys() == [12]
     assert status[12].missing
     assert not status[12].alive
+
+
+def test_aggregator_coalesces_updates(redis_client, store):
+    aggregator = HeartbeatAggregator(store, flush_interval=60)
+    key = HeartbeatStatusKey(1, 2)
+    aggregator.update(key, 0, json.dumps({'state': 'old'}), time.time())
+    aggregator.update(key, 0, json.dumps({'state': 'new'}), time.time())
+    aggregator.update(HeartbeatStatusKey(1, 3), 0, '{}', time.time())
+    # Nothing is written until the aggregator flushes.
+    assert redis_client.keys() == []
+
+    aggregator.flush()
+    assert aggregator.flush_size == 2
+    assert aggregator.flush_latency is not None
+    assert json.loads(redis_client.hget('1:2', 0)) == {'state': 'new'}
+    assert sorted(f for f, ts in store.get_account_folders(1)) == ['2', '3']
+    assert store.get_account_timestamp(1) is not None
+    aggregator.flusher.kill()
+
+
+def test_aggregator_reports_flushes(monkeypatch, store):
+    monkeypatch.setattr('inbox.heartbeat.store.FLUSH_REPORT_INTERVAL', 0)
+    log = mock.Mock()
+    monkeypatch.setattr('inbox.heartbeat.store.log', log)
+    aggregator = HeartbeatAggregator(store, flush_interval=60)
+    aggregator.update(HeartbeatStatusKey(1, 2), 0, '{}', time.time())
+    aggregator.update(HeartbeatStatusKey(1, 3), 0, '{}', time.time())
+    aggregator.flush()
+    assert log.info.call_count == 1
+    reported = log.info.call_args[1]
+    assert reported['flush_size'] == reported['flushed_updates'] == 2
+    assert reported['flushes'] == 1
+    assert reported['flush_latency'] is not None
+    # The counts start over after each report.
+    assert aggregator.flushes == aggregator.flushed_updates == 0
+    aggregator.flusher.kill()
+
+
+def test_clear_discards_pending_updates(monkeypatch, redis_client, store):
+    monkeypatch.setattr('inbox.heartbeat.store.HEARTBEAT_FLUSH_INTERVAL', 60)
+    monkeypatch.setattr(HeartbeatAggregator, '_instances', {})
+    proxy_for(1, 2).publish(state='poll')
+    proxy_for(1, 3).publish(state='poll')
+    proxy_for(2, 2).publish(state='poll')
+    aggregator = HeartbeatAggregator.for_store(store)
+    assert len(aggregator.pending) == 3
+
+    # Clearing before a flush doesn't let the flush write the folder back.
+    proxy_for(1, 2).clear()
+    store.remove_folders(2)
+    aggregator.flush()
+    assert redis_client.keys('1:2') == []
+    assert redis_client.keys('2:*') == []
+    assert json.loads(redis_client.hget('1:3', 0))['state'] == 'poll'
+    aggregator.flusher.kill()
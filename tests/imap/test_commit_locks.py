@@ -0,0 +1,85 @@
+import gevent
+import mock
+from gevent import sleep
+
+from inbox.crispin import RawMessage
+from inbox.mailsync.backends.imap.locking import (CommitLocks,
+                                                  message_lock_keys,
+                                                  thread_lock_keys)
+
+
+def test_disjoint_keys_dont_contend():
+    locks = CommitLocks()
+    running = []
+
+    def commit(folder_id):
+        with locks.folder(folder_id):
+            running.append(folder_id)
+            sleep(0.01)
+
+    gevent.joinall([gevent.spawn(commit, 1), gevent.spawn(commit, 2)])
+    assert sorted(running) == [1, 2]
+    assert locks.contended == 0
+    assert locks.acquisitions == 2
+    # Locks are dropped once nobody needs them.
+    assert locks._locks == {}
+
+
+def test_overlapping_keys_serialize():
+    locks = CommitLocks()
+    events = []
+
+    def commit(name, keys):
+        with locks.hold(keys):
+            events.append(('start', name))
+            sleep(0.01)
+            events.append(('end', name))
+
+    gevent.joinall([
+        gevent.spawn(commit, 'a', [('thread', 1), ('contact', u'x@y.com')]),
+        gevent.spawn(commit, 'b', [('contact', u'x@y.com'), ('thread', 2)])])
+    assert events == [('start', 'a'), ('end', 'a'),
+                      ('start', 'b'), ('end', 'b')]
+    assert locks.contended == 1
+    assert locks.metrics_dict()['lock_wait_time'] > 0
+    assert locks._locks == {}
+
+
+def raw_message(headers, g_thrid=None):
+    body = '\r\n'.join('{}: {}'.format(*h) for h in headers) + '\r\n\r\nhi'
+    return RawMessage(uid=1, internaldate=None, flags=(), body=body,
+                      g_thrid=g_thrid, g_msgid=None, g_labels=None)
+
+
+def test_message_lock_keys():
+    db_session = mock.Mock()
+    db_session.query.return_value.filter.return_value = [(u'known@a.com',)]
+    reply = raw_message([('Subject', 'Re: Lunch'),
+                         ('From', 'New Person <New.Person@a.com>'),
+                         ('To', 'known@a.com'),
+                         ('Message-ID', '<2@a.com>'),
+                         ('In-Reply-To', '<1@a.com>')])
+    assert message_lock_keys(1, db_session, [reply]) == {
+        ('subject', u'Lunch'), ('message_id', u'<2@a.com>'),
+        ('message_id', u'<1@a.com>'), ('contact', u'new.person@a.com')}
+
+    gmail = raw_message([('Subject', 'Lunch'), ('From', 'known@a.com')],
+                        g_thrid=123)
+    assert message_lock_keys(1, db_session, [gmail]) == {('thread', 123)}
+
+
+def test_thread_lock_keys():
+    # Deleting from a thread locks what adding a message to it locks.
+    original = mock.Mock(subject='Lunch', message_id_header='<1@a.com>')
+    thread = mock.Mock(g_thrid=None, messages=[original])
+    assert thread_lock_keys([thread]) == {('subject', u'Lunch'),
+                                          ('message_id', u'<1@a.com>')}
+    reply = raw_message([('Subject', 'Re: Lunch'),
+                         ('Message-ID', '<2@a.com>'),
+                         ('In-Reply-To', '<1@a.com>')])
+    db_session = mock.Mock()
+    assert thread_lock_keys([thread]) <= \
+        message_lock_keys(1, db_session, [reply])
+
+    gmail_thread = mock.Mock(g_thrid=123)
+    assert thread_lock_keys([gmail_thread]) == {('thread', 123)}
@@ -123,6 +123,16 @@ def test_flags(generic_client, constants):
     assert generic_client.flags([uid]) == {uid: Flags(flags)}
 
 
+def test_sizes(generic_client, constants):
+    expected_resp = '{seq} (RFC822.SIZE {body_size} ' \
+                    'UID {uid} MODSEQ ({modseq}))'.format(**constants)
+    unsolicited_resp = '1198 (UID 1731 MODSEQ (95244) FLAGS (\\Seen))'
+    patch_imap4(generic_client, [expected_resp, unsolicited_resp])
+    uid = constants['uid']
+    body_size = constants['body_size']
+    assert generic_client.sizes([uid]) == {uid: body_size}
+
+
 def test_body(generic_client, constants):
     expected_resp = ('{seq} (UID {uid} MODSEQ ({modseq}) '
                      'INTERNALDATE "{internaldate}" FLAGS {flags} '
@@ -175,3 +185,29 @@ def test_internaldate(generic_client, constants):
                        g_thrid=None,
                        g_msgid=None)
         ]
+
+
+def test_selected_status(generic_client):
+    generic_client.selected_folder = ('INBOX', {'UIDVALIDITY': 1L,
+                                                'UIDNEXT': 120,
+                                                'EXISTS': 100})
+    assert generic_client.selected_status() == \
+        {'UIDVALIDITY': 1, 'UIDNEXT': 120, 'MESSAGES': 100}
+
+    # Fall back to STATUS if SELECT didn't give us UIDNEXT.
+    generic_client.selected_folder = ('INBOX', {'UIDVALIDITY': 1L,
+                                                'EXISTS': 100})
+    generic_client.conn.folder_status = mock.Mock(return_value={
+        'UIDVALIDITY': '1', 'UIDNEXT': '121', 'MESSAGES': '101'})
+    assert generic_client.selected_status() == \
+        {'UIDVALIDITY': 1, 'UIDNEXT': 121, 'MESSAGES': 101}
+
+
+def test_uids_from(generic_client):
+    # The server always includes the highest UID in a 'UID n:*' search.
+    generic_client.conn.search = mock.Mock(return_value=[119])
+    assert generic_client.uids_from(120) == []
+    generic_client.conn.search = mock.Mock(return_value=[121, 120])
+    assert generic_client.uids_from(120) == [120, 121]
+    generic_client.conn.search.assert_called_once_with(
+        ['UNDELETED', 'UID', '120:*'])
@@ -1,10 +1,15 @@
 from datetime import datetime, timedelta
+import mock
 import pytest
 from sqlalchemy.orm.exc import ObjectDeletedError
-from inbox.crispin import GmailFlags
+from inbox.crispin import Flags, GmailFlags
 from inbox.mailsync.backends.imap.common import (remove_deleted_uids,
                                                  update_metadata)
+from inbox.mailsync.backends.imap.generic import FolderSyncEngine
+from inbox.mailsync.backends.imap.locking import CommitLocks
+from inbox.mailsync.backends.imap.uidset import UIDSet
 from inbox.mailsync.gc import DeleteHandler
+from inbox.models.backends.imap import ImapUid
 from tests.util.base import add_fake_imapuid, add_fake_message
 
 
@@ -117,3 +122,25 @@ def test_deletion_deferred_with_longer_ttl(db, default_account,
     # Would raise ObjectDeletedError if objects were deleted
     marked_deleted_message.id
     thread.id
+
+
+def test_deleted_flag_removes_uid(db, default_account, message, imapuid,
+                                  folder):
+    """Messages flagged \\Deleted but not yet expunged are removed when
+    their flags are refreshed, since folders that didn't change aren't
+    listed."""
+    engine = FolderSyncEngine(default_account.id, folder.name, folder.id,
+                              default_account.email_address, 'custom', 30,
+                              CommitLocks(), 20, None)
+    engine.local_uids = UIDSet([imapuid.msg_uid, 2223])
+    imapuid_id = imapuid.id
+    crispin_client = mock.Mock(CHUNK_SIZE=100)
+    crispin_client.flags.return_value = {
+        imapuid.msg_uid: Flags(('\\Seen', '\\Deleted')),
+        2223: Flags(('\\Seen',))}
+
+    engine.update_metadata(crispin_client, [imapuid.msg_uid, 2223])
+    assert list(engine.local_uids) == [2223]
+    db.session.expire_all()
+    assert db.session.query(ImapUid).get(imapuid_id) is None
+    assert message.deleted_at is not None
@@ -0,0 +1,28 @@
+from inbox.mailsync.backends.imap.generic import (UIDStack,
+                                                  size_limited_batch)
+
+
+def test_size_limited_batch():
+    entries = [(5, None), (4, None), (3, None), (2, None)]
+    sizes = {5: 400, 4: 400, 3: 400, 2: 400}
+    assert size_limited_batch(entries, sizes, 1000) == entries[:2]
+    assert size_limited_batch(entries, sizes, 10000) == entries
+    # A single oversized message is still downloaded on its own.
+    assert size_limited_batch(entries, {5: 5000}, 1000) == entries[:1]
+    # UIDs that have disappeared from the remote don't count towards the
+    # budget.
+    assert size_limited_batch(entries, {}, 1000) == entries
+
+
+def test_uid_stack_peek_and_remove():
+    stack = UIDStack()
+    for uid in range(1, 6):
+        stack.put(uid, None)
+    batch = stack.peek_n(3)
+    assert [uid for uid, _ in batch] == [5, 4, 3]
+    assert stack.qsize() == 5
+
+    # Entries pushed while the batch was being committed must survive.
+    stack.put(6, None)
+    stack.remove(batch)
+    assert [uid for uid, _ in stack.peek_n(10)] == [6, 2, 1]
@@ -0,0 +1,58 @@
+import pytest
+from gevent import sleep
+
+from inbox.mailsync.backends.imap.pipeline import DownloadPipeline
+
+
+def make_pipeline(batches, committed, commit_delay=0, parse=None,
+                  queue_size=1):
+    batches = list(batches)
+
+    def next_batch():
+        return batches.pop(0) if batches else []
+
+    def fetch(batch):
+        return ['raw {}'.format(uid) for uid in batch]
+
+    def commit(batch, parsed):
+        sleep(commit_delay)
+        committed.append((batch, parsed))
+
+    return DownloadPipeline(next_batch, fetch, commit, parse=parse,
+                            queue_size=queue_size)
+
+
+def test_batches_committed_in_order():
+    committed = []
+    pipeline = make_pipeline([[1, 2], [3], [4, 5]], committed,
+                             parse=lambda raw: [r.upper() for r in raw])
+    pipeline.run()
+    assert committed == [([1, 2], ['RAW 1', 'RAW 2']),
+                         ([3], ['RAW 3']),
+                         ([4, 5], ['RAW 4', 'RAW 5'])]
+    metrics = pipeline.metrics_dict()
+    for stage in ('fetch', 'parse', 'commit'):
+        assert metrics[stage]['batches'] == 3
+        assert metrics[stage]['messages'] == 5
+
+
+def test_slow_commit_applies_backpressure():
+    committed = []
+    pipeline = make_pipeline([[uid] for uid in range(6)], committed,
+                             commit_delay=0.01)
+    pipeline.run()
+    assert len(committed) == 6
+    # The fetcher had to wait for the committer to catch up.
+    assert pipeline.metrics['fetch'].blocked > 0
+    assert pipeline.metrics['commit'].busy >= 0.05
+
+
+def test_stage_errors_propagate():
+    def parse(raw_messages):
+        raise ValueError('unparseable')
+
+    committed = []
+    pipeline = make_pipeline([[1], [2]], committed, parse=parse)
+    with pytest.raises(ValueError):
+        pipeline.run()
+    assert committed == []
@@ -0,0 +1,106 @@
+from datetime import datetime
+
+import gevent
+import mock
+from gevent import sleep
+
+from inbox.mailsync.backends.imap.monitor import ImapSyncMonitor
+from inbox.models import Folder
+from tests.util.base import add_fake_imapuid, add_fake_message
+
+
+class FakeFolderSyncEngine(gevent.Greenlet):
+    """Gets to polling after a short initial sync (longer for the Inbox)."""
+    running = 0
+    max_running = 0
+    started = []
+
+    def __init__(self, account_id, folder_name, *args):
+        self.folder_name = folder_name
+        self.state = 'initial'
+        gevent.Greenlet.__init__(self)
+
+    def _run(self):
+        cls = FakeFolderSyncEngine
+        cls.started.append(self.folder_name)
+        cls.running += 1
+        cls.max_running = max(cls.max_running, cls.running)
+        sleep(0.05 if self.folder_name == 'INBOX' else 0.01)
+        cls.running -= 1
+        self.state = 'poll'
+        sleep(10)
+
+
+def make_monitor(provider_info, account_id=1):
+    account = mock.Mock(id=account_id, email_address='test@example.com',
+                        provider='custom', provider_info=provider_info,
+                        supports_condstore=False)
+    account.namespace.id = 1
+    monitor = ImapSyncMonitor(account, heartbeat=0.005)
+    monitor.sync_engine_class = FakeFolderSyncEngine
+    return monitor
+
+
+@mock.patch('inbox.mailsync.backends.imap.monitor.CONNECTION_POOL_SIZE', 5)
+def test_concurrent_initial_syncs():
+    FakeFolderSyncEngine.started = []
+    FakeFolderSyncEngine.max_running = 0
+    folders = [('INBOX', 1), ('Sent', 2), ('Archive', 3), ('Trash', 4)]
+    monitor = make_monitor({})
+    assert monitor.initial_sync_budget == 2
+    monitor.prepare_sync = lambda: folders
+    monitor.prioritize_folders = lambda folders: folders
+
+    synced = set()
+    monitor.start_new_folder_sync_engines(synced)
+    try:
+        assert synced == set(folders)
+        assert FakeFolderSyncEngine.max_running == 2
+        # The other folders didn't wait for the Inbox.
+        assert FakeFolderSyncEngine.started == ['INBOX', 'Sent', 'Archive',
+                                                'Trash']
+        assert monitor.time_to_first_poll['INBOX'] >= 0.05
+        assert monitor.time_to_first_poll['Trash'] < 0.05
+    finally:
+        monitor.folder_monitors.kill()
+
+
+def test_initial_sync_budget():
+    with mock.patch('inbox.mailsync.backends.imap.monitor.'
+                    'CONNECTION_POOL_SIZE', 7):
+        assert make_monitor(
+            {'max_concurrent_initial_syncs': 1}).initial_sync_budget == 1
+        # Each initial sync takes two connections, and one connection is
+        # always left for polling.
+        assert make_monitor(
+            {'max_concurrent_initial_syncs': 10}).initial_sync_budget == 3
+    # There's always room for one.
+    with mock.patch('inbox.mailsync.backends.imap.monitor.'
+                    'CONNECTION_POOL_SIZE', 2):
+        assert make_monitor({}).initial_sync_budget == 1
+
+
+def test_prioritize_folders(db, default_account):
+    def add_folder(name, role=None, received_date=None):
+        folder = Folder.create(default_account, name, db.session, role)
+        db.session.commit()
+        if received_date is not None:
+            message = add_fake_message(db.session,
+                                       default_account.namespace.id,
+                                       received_date=received_date)
+            add_fake_imapuid(db.session, default_account.id, message, folder,
+                             1)
+        return (folder.name, folder.id)
+
+    # Mix folders with and without synced messages, within and across roles.
+    trash = add_folder('Sched Trash', 'trash', datetime(2015, 3, 1))
+    empty = add_folder('Sched Empty')
+    old = add_folder('Sched Old', received_date=datetime(2014, 1, 1))
+    inbox = add_folder('Sched Inbox', 'inbox')
+    new = add_folder('Sched New', received_date=datetime(2015, 2, 1))
+    sent = add_folder('Sched Sent', 'sent', datetime(2013, 1, 1))
+
+    monitor = make_monitor({}, default_account.id)
+    assert monitor.prioritize_folders(
+        [trash, empty, old, inbox, new, sent]) == \
+        [inbox, sent, new, old, empty, trash]
@@ -0,0 +1,114 @@
+import time
+from contextlib import contextmanager
+
+from gevent import sleep
+
+from inbox.mailsync.backends.imap.idle import IdleManager, changed_folders
+
+
+class FakeCrispinClient(object):
+    """Reports the untagged responses put in `responses` while idling."""
+    def __init__(self, supports_notify):
+        self._supports_notify = supports_notify
+        self.responses = []
+        self.notified = None
+        self.selected = None
+
+    def supports_notify(self):
+        return self._supports_notify
+
+    def notify(self, folders):
+        self.notified = folders
+
+    def select_folder(self, folder, uidvalidity_cb):
+        self.selected = folder
+
+    def pending_responses(self):
+        return []
+
+    def idle_responses(self, timeout, check_interval):
+        while True:
+            yield self.responses.pop(0) if self.responses else []
+            sleep(0.005)
+
+
+class FakePool(object):
+    def __init__(self, clients):
+        self.clients = clients
+
+    @contextmanager
+    def get(self):
+        yield self.clients.pop(0)
+
+
+def make_manager(clients, max_connections):
+    manager = IdleManager(1, max_connections, idle_poll_frequency=1)
+    manager.conn_pool = FakePool(clients)
+    return manager
+
+
+def consume(manager, folders):
+    # Watching starts by waking the folders' engines, to catch up.
+    for folder in folders:
+        assert manager.wait(folder, 30)
+
+
+def test_changed_folders():
+    assert changed_folders([('OK', 'Still here'), (3, 'EXISTS'),
+                            (2, 'RECENT')], 'INBOX') == {'INBOX'}
+    assert changed_folders([(5, 'FETCH', ('FLAGS', ('\\Seen',)))],
+                           None) == set()
+    assert changed_folders([('STATUS', 'Sent', ('MESSAGES', 3)),
+                            ('STATUS', 'Entw&APw-rfe', ('MESSAGES', 1)),
+                            ('STATUS', 2015, ('MESSAGES', 1))],
+                           None) == {u'Sent', u'Entw\xfcrfe', u'2015'}
+
+
+def test_notify_watches_all_folders():
+    client = FakeCrispinClient(supports_notify=True)
+    manager = make_manager([client], max_connections=2)
+    manager.add_folders(['INBOX', 'Sent'])
+    manager.start()
+    try:
+        consume(manager, ['INBOX', 'Sent'])
+        assert client.notified == ['INBOX', 'Sent']
+        assert manager.watched == {'INBOX', 'Sent'}
+
+        client.responses.append([('STATUS', 'Sent', ('MESSAGES', 3))])
+        assert manager.wait('Sent', 30)
+        assert not manager._changed['INBOX'].is_set()
+
+        manager.add_folders(['Trash'])
+        consume(manager, ['Trash'])
+        assert client.notified == ['INBOX', 'Sent', 'Trash']
+        assert len(manager.watchers) == 1
+    finally:
+        manager.stop()
+
+
+def test_idle_watches_a_folder_per_connection():
+    clients = [FakeCrispinClient(supports_notify=False),
+               FakeCrispinClient(supports_notify=False)]
+    inbox_client, sent_client = clients
+    manager = make_manager(list(clients), max_connections=2)
+    manager.add_folders(['INBOX', 'Sent', 'Trash'])
+    manager.start()
+    try:
+        consume(manager, ['INBOX', 'Sent'])
+        assert (inbox_client.selected, sent_client.selected) == \
+            ('INBOX', 'Sent')
+        assert manager.watched == {'INBOX', 'Sent'}
+
+        inbox_client.responses.append([(3, 'EXISTS')])
+        assert manager.wait('INBOX', 30)
+        inbox_client.responses.append([(5, 'FETCH', ('FLAGS', ('\\Seen',)))])
+        assert manager.wait('INBOX', 30)
+        # Watched folders are checked every idle_poll_frequency seconds when
+        # nothing is reported...
+        start = time.time()
+        assert not manager.wait('INBOX', 0.01)
+        assert time.time() - start >= 1
+        # ...but Trash isn't watched, so it's polled as usual.
+        assert not manager.wait('Trash', 0.01)
+    finally:
+        manager.stop()
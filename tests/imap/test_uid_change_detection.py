@@ -0,0 +1,44 @@
+import mock
+
+from inbox.mailsync.backends.imap.generic import new_uids_from_status
+
+
+def status(uidnext, messages, uidvalidity=1):
+    return {'UIDVALIDITY': uidvalidity, 'UIDNEXT': uidnext,
+            'MESSAGES': messages}
+
+
+def test_unchanged_folder():
+    crispin_client = mock.Mock()
+    assert new_uids_from_status(crispin_client, status(120, 100),
+                                status(120, 100)) == []
+    assert not crispin_client.uids_from.called
+
+
+def test_only_new_messages():
+    crispin_client = mock.Mock()
+    crispin_client.uids_from.return_value = [120, 125]
+    assert new_uids_from_status(crispin_client, status(120, 100),
+                                status(126, 102)) == [120, 125]
+    crispin_client.uids_from.assert_called_once_with(120)
+
+
+def test_new_and_expunged_messages():
+    crispin_client = mock.Mock()
+    crispin_client.uids_from.return_value = [120, 125]
+    assert new_uids_from_status(crispin_client, status(120, 100),
+                                status(126, 101)) is None
+
+
+def test_full_diff_needed():
+    crispin_client = mock.Mock()
+    # No previous status.
+    assert new_uids_from_status(crispin_client, None,
+                                status(120, 100)) is None
+    # UIDVALIDITY changed.
+    assert new_uids_from_status(crispin_client, status(120, 100),
+                                status(120, 100, uidvalidity=2)) is None
+    # Messages were expunged.
+    assert new_uids_from_status(crispin_client, status(120, 100),
+                                status(120, 99)) is None
+    assert not crispin_client.uids_from.called
@@ -0,0 +1,47 @@
+import random
+
+from inbox.mailsync.backends.imap.uidset import UIDSet
+
+
+def test_set_operations():
+    rand = random.Random(0)
+    for _ in range(100):
+        a = set(rand.sample(xrange(1, 2000), rand.randint(0, 500)))
+        b = set(rand.sample(xrange(1, 2000), rand.randint(0, 500)))
+        uids_a, uids_b = UIDSet(a), UIDSet(b)
+        assert list(uids_a - uids_b) == sorted(a - b)
+        assert list(uids_a & uids_b) == sorted(a & b)
+        assert list(uids_a | uids_b) == sorted(a | b)
+        # The other operand can be any iterable.
+        assert list(uids_a - list(b)) == sorted(a - b)
+        for uid in rand.sample(xrange(2000), 20):
+            assert (uid in uids_a) == (uid in a)
+
+
+def test_long_common_runs():
+    local = UIDSet(xrange(1, 100001))
+    remote = UIDSet([uid for uid in xrange(1, 100101) if uid % 1000])
+    assert list(local - remote) == range(1000, 100001, 1000)
+    assert list(remote - local) == [uid for uid in xrange(100001, 100101)
+                                    if uid % 1000]
+    assert len(local & remote) == 99900
+
+
+def test_update():
+    uids = UIDSet([5, 3, 3, 1])
+    assert list(uids) == [1, 3, 5]
+    # Appending above the current UIDs.
+    uids.update([6, 7])
+    # Adding below them, a batch at a time (as downloads do).
+    for batch in ([4, 2], [0], [3, 9]):
+        uids.update(batch)
+        assert len(uids) == len(set(uids))
+    assert 2 in uids and 8 not in uids
+    assert list(uids) == [0, 1, 2, 3, 4, 5, 6, 7, 9]
+    assert list(uids[-2:]) == [7, 9]
+
+
+def test_sequence_set():
+    assert UIDSet([1, 2, 3, 5, 7, 8]).to_sequence_set() == '1:3,5,7:8'
+    assert UIDSet().to_sequence_set() == ''
+    assert UIDSet(xrange(10)).nbytes() == 40
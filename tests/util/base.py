@@ -115,9 +115,9 @@ class TestAPIClient(object):
             self.ns_public_ids[ns_id] = ns_public_id
         return '/n/{}'.format(ns_public_id) + path
 
-    def get_raw(self, short_path, ns_id=1):
+    def get_raw(self, short_path, ns_id=1, headers=None):
         path = self.full_path(short_path, ns_id)
-        return self.client.get(path)
+        return self.client.get(path, headers=headers)
 
     def get_data(self, short_path, ns_id=1):
         path = self.full_path(short_path, ns_id)
@@ -0,0 +1,107 @@
+"""
+A minimal fake of the Google Calendar API, for running event sync against
+without hitting Google. It supports listing calendars and events (with
+pagination), and incremental sync with sync tokens:
+
+* every change to an event bumps a global change counter,
+* the sync token returned with the last page of an events list is the value
+  of that counter, and listing with `syncToken` returns only the events
+  changed since, including cancelled (deleted) ones,
+* `invalidate_sync_tokens()` makes all previously issued tokens return
+  410 Gone, as Google does when it expires them.
+
+Point a GoogleEventsProvider at it by setting its `api_url` to the server's
+`url`.
+
+"""
+import json
+
+from flask import Flask, request, Response
+from gevent.pywsgi import WSGIServer
+
+
+class FakeGoogleCalendar(object):
+    def __init__(self, page_size=2):
+        self.page_size = page_size
+        self.calendars = {}
+        self.requests = []
+        self._changes = 0
+        self._min_sync_token = 0
+        self._server = None
+        self.app = self._make_app()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_port)
+
+    def start(self):
+        self._server = WSGIServer(('127.0.0.1', 0), self.app, log=None)
+        self._server.start()
+
+    def stop(self):
+        self._server.stop()
+
+    def add_calendar(self, uid, summary):
+        self.calendars[uid] = dict(summary=summary, events={})
+
+    def put_event(self, calendar_uid, uid, summary, **fields):
+        self._changes += 1
+        event = dict(id=uid, summary=summary, status='confirmed',
+                     updated='2015-03-01T00:00:00.000Z',
+                     start={'dateTime': '2015-03-02T10:00:00Z'},
+                     end={'dateTime': '2015-03-02T11:00:00Z'},
+                     attendees=[], **fields)
+        self.calendars[calendar_uid]['events'][uid] = (self._changes, event)
+
+    def cancel_event(self, calendar_uid, uid):
+        self._changes += 1
+        _, event = self.calendars[calendar_uid]['events'][uid]
+        event = dict(event, status='cancelled')
+        self.calendars[calendar_uid]['events'][uid] = (self._changes, event)
+
+    def invalidate_sync_tokens(self):
+        self._changes += 1
+        self._min_sync_token = self._changes
+
+    def _page(self, items, sync_token=None):
+        start = int(request.args.get('pageToken', 0))
+        end = start + self.page_size
+        data = dict(items=items[start:end])
+        if end < len(items):
+            data['nextPageToken'] = str(end)
+        elif sync_token is not None:
+            data['nextSyncToken'] = str(sync_token)
+        return Response(json.dumps(data), mimetype='application/json')
+
+    def _make_app(self):
+        app = Flask(__name__)
+
+        @app.before_request
+        def record_request():
+            self.requests.append((request.path, request.args.to_dict()))
+
+        @app.route('/users/me/calendarList')
+        def calendar_list():
+            items = [dict(id=uid, summary=calendar['summary'],
+                          accessRole='owner')
+                     for uid, calendar in sorted(self.calendars.items())]
+            return self._page(items)
+
+        @app.route('/calendars/<calendar_uid>/events')
+        def events_list(calendar_uid):
+            events = self.calendars[calendar_uid]['events'].values()
+            sync_token = request.args.get('syncToken')
+            if sync_token is None:
+                # Like Google, leave out deleted events from a full sync.
+                changed = [event for _, event in events
+                           if event['status'] != 'cancelled']
+            elif int(sync_token) < self._min_sync_token:
+                return Response(json.dumps({'error': {'code': 410}}),
+                                status=410, mimetype='application/json')
+            else:
+                changed = [event for change, event in events
+                           if change > int(sync_token)]
+            return self._page(sorted(changed, key=lambda e: e['id']),
+                              self._changes)
+
+        return app